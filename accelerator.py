@@ -1,81 +1,442 @@
+import heapq
+import math
+import sys
+from itertools import product
+from operator import itemgetter
+from typing import Callable
+
 from entities import Object
-from utils import clamp
+
+_get_value = itemgetter(1)
 
 
-class Grid:
-    def __init__(self, width, height, cellcount):
-        self.width = int(width)
-        self.height = int(height)
-        self.cellcount = cellcount
-        self.cellwidth = self.width // self.cellcount
-        self.cellheight = self.height // self.cellcount
-        self.cells = [[set() for x in range(self.cellcount)] for y in range(self.cellcount)]
-        self._max_index = self.cellcount - 1
+class SpatialHash:
+    """
+    Uniform grid of cells for finding objects by position. The cells are in a dict, keyed by their (x, y) index,
+    and only exist while objects are in them. Every object is in all cells its bounding box overlaps.
+    There are no borders: cells go on in every direction, so the world can have any size, and can grow.
+    Memory depends on the area the objects cover, not on the size of the world.
+    """
+    def __init__(self, cellwidth: float, cellheight: float):
+        self.cellwidth = cellwidth
+        self.cellheight = cellheight
+        # (x index, y index) -> objects overlapping the cell, never empty
+        self.cells: dict[tuple[int, int], set[Object]] = {}
+        # The cell index range each object was added with. Objects can change position and radius
+        # at any time, so we can't recompute which cells they are in when removing them.
+        self._obj_indices: dict[Object, tuple[int, int, int, int]] = {}
+
+    def _get_obj_indices(self, obj: Object):
+        radius = obj.radius
+        return self._map_coords_to_indices(obj.pos_x - radius, obj.pos_y - radius, radius * 2, radius * 2)
 
     def add(self, obj: Object):
-        left = obj.pos_x - obj.radius
-        top = obj.pos_y - obj.radius
-        width = obj.radius * 2
-        height = width
-        left_index, right_index, top_index, bottom_index = self._map_coords_to_indices(left, top, width, height)
-
-        for y in range(top_index, bottom_index + 1):
-            for x in range(left_index, right_index + 1):
-                self.cells[x][y].add(obj)
-
-    def remove(self, obj: Object, pos_x, pos_y, radius):
-        left = pos_x - radius
-        top = pos_y - radius
-        width = radius * 2
-        height = width
-        left_index, right_index, top_index, bottom_index = self._map_coords_to_indices(left, top, width, height)
-
-        for y in range(top_index, bottom_index + 1):
-            for x in range(left_index, right_index + 1):
-                try:
-                    self.cells[x][y].remove(obj)
-                except KeyError:
-                    pass
-
-    # TODO Maybe rename this, as it doesn't return only the objects in the rect, but also
-    #  objects around it (from the cells the rect lies in)
+        self._add_to_cells(obj, self._get_obj_indices(obj))
+
+    def _add_to_cells(self, obj: Object, indices: tuple[int, int, int, int]):
+        self._obj_indices[obj] = indices
+        left_index, right_index, top_index, bottom_index = indices
+
+        cells = self.cells
+        # Most objects are small and in a single cell
+        if left_index == right_index and top_index == bottom_index:
+            keys = ((left_index, top_index),)
+        else:
+            keys = product(range(left_index, right_index + 1), range(top_index, bottom_index + 1))
+        for key in keys:
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = {obj}
+            else:
+                cell.add(obj)
+
+    def add_all(self, objs: list[Object]):
+        """
+        Like add() for each object, in the same order, but without a method call per object,
+        for many objects at once (e.g. when restoring a snapshot).
+        """
+        cells = self.cells
+        obj_indices = self._obj_indices
+        cellwidth = self.cellwidth
+        cellheight = self.cellheight
+        for obj in objs:
+            # Same as _get_obj_indices()
+            radius = obj.radius
+            size = radius * 2
+            left = obj.pos_x - radius
+            top = obj.pos_y - radius
+            left_index = int(left // cellwidth)
+            right_index = int((left + size) // cellwidth)
+            top_index = int(top // cellheight)
+            bottom_index = int((top + size) // cellheight)
+            obj_indices[obj] = (left_index, right_index, top_index, bottom_index)
+
+            if left_index == right_index and top_index == bottom_index:
+                keys = ((left_index, top_index),)
+            else:
+                keys = product(range(left_index, right_index + 1), range(top_index, bottom_index + 1))
+            for key in keys:
+                cell = cells.get(key)
+                if cell is None:
+                    cells[key] = {obj}
+                else:
+                    cell.add(obj)
+
+    def add_all_saved(self, objs: list[Object], index_ranges, cells: dict[tuple[int, int], list[int]]):
+        """
+        Like add_all(), with the index that a SpatialHash with the same cell size had for the objects,
+        so nothing has to be computed per object (e.g. when restoring a snapshot).
+        :param index_ranges: The cell index range of each object, see get_index_ranges()
+        :param cells: (x index, y index) -> positions in objs of the objects in the cell
+        """
+        self._obj_indices.update(zip(objs, index_ranges))
+        get_obj = objs.__getitem__
+        for key, positions in cells.items():
+            cell = self.cells.get(key)
+            if cell is None:
+                self.cells[key] = set(map(get_obj, positions))
+            else:
+                cell.update(map(get_obj, positions))
+
+    def get_index_ranges(self, objs: list[Object]) -> list[tuple[int, int, int, int]]:
+        """
+        The cell index range of each object, in the same order.
+        """
+        return list(map(self._obj_indices.__getitem__, objs))
+
+    def remove(self, obj: Object):
+        left_index, right_index, top_index, bottom_index = self._obj_indices.pop(obj)
+
+        cells = self.cells
+        if left_index == right_index and top_index == bottom_index:
+            keys = ((left_index, top_index),)
+        else:
+            keys = product(range(left_index, right_index + 1), range(top_index, bottom_index + 1))
+        for key in keys:
+            cell = cells[key]
+            cell.remove(obj)
+            if not cell:
+                del cells[key]
+
+    def move(self, obj: Object):
+        """
+        Call after an object changed its position or radius.
+        Cheap if the object is still in the same cells, which is the common case.
+        """
+        # Same as _get_obj_indices(), without two method calls per object
+        radius = obj.radius
+        size = radius * 2
+        left = obj.pos_x - radius
+        top = obj.pos_y - radius
+        cellwidth = self.cellwidth
+        cellheight = self.cellheight
+        if (int(left // cellwidth), int((left + size) // cellwidth), int(top // cellheight),
+                int((top + size) // cellheight)) != self._obj_indices[obj]:
+            self.remove(obj)
+            self.add(obj)
+
+    def move_all(self, objs: list[Object]):
+        """
+        Like move() for each object, but without a method call per object.
+        """
+        obj_indices = self._obj_indices
+        cellwidth = self.cellwidth
+        cellheight = self.cellheight
+        for obj in objs:
+            # Same as _get_obj_indices(). The indices are whole floats here, which compare equal to the ints.
+            radius = obj.radius
+            size = radius * 2
+            left = obj.pos_x - radius
+            top = obj.pos_y - radius
+            indices = (left // cellwidth, (left + size) // cellwidth, top // cellheight, (top + size) // cellheight)
+            if indices != obj_indices[obj]:
+                self.remove(obj)
+                self._add_to_cells(obj, tuple(map(int, indices)))
+
+    def _get_cells(self, left_index, right_index, top_index, bottom_index) -> list[set[Object]]:
+        """
+        :return: The cells in the index range that have objects in them. If the range has more cells than there
+                 are cells with objects (e.g. for a huge rect), it's cheaper to go through those instead.
+        """
+        cells = self.cells
+        if (right_index - left_index + 1) * (bottom_index - top_index + 1) <= len(cells):
+            return [cell for cell in map(cells.get, product(range(left_index, right_index + 1),
+                                                            range(top_index, bottom_index + 1))) if cell]
+        return [cell for (x, y), cell in cells.items()
+                if left_index <= x <= right_index and top_index <= y <= bottom_index]
+
     def get_objs_in_rect(self, left, top, width, height):
-        left_index, right_index, top_index, bottom_index = self._map_coords_to_indices(left, top, width, height)
+        """
+        Every object overlapping the rect, and also objects around it (from the cells the rect lies in).
+        """
+        objs = set()
+        for cell in self._get_cells(*self._map_coords_to_indices(left, top, width, height)):
+            objs |= cell
+        return objs
 
+    def get_objs_in_radius(self, x, y, radius, kind: type = None, predicate: Callable[[Object], bool] = None):
+        """
+        Exact, unlike get_objs_in_rect(): every object whose center is within the radius around (x, y).
+        :param kind: Only objects of this class, cheaper than checking it in the predicate
+        :param predicate: Only objects for which it returns True, e.g. "larger than 20"
+        """
+        radius_squared = radius * radius
+        left = x - radius
+        right = x + radius
         objs = set()
+        for cell in self._get_cells(*self._map_coords_to_indices(left, y - radius, radius * 2, radius * 2)):
+            for obj in cell:
+                # The cells are usually much bigger than the radius, most objects in them are far off to the side
+                if not left <= obj.pos_x <= right:
+                    continue
+                dx = obj.pos_x - x
+                dy = obj.pos_y - y
+                if (dx * dx + dy * dy <= radius_squared and (kind is None or isinstance(obj, kind))
+                        and (predicate is None or predicate(obj))):
+                    objs.add(obj)
+        return objs
+
+    def has_obj_in_radius(self, x, y, radius, exclude: Object = None) -> bool:
+        """
+        If get_objs_in_radius() would find any object other than the excluded one. Stops at the first one found.
+        """
+        radius_squared = radius * radius
+        left = x - radius
+        right = x + radius
+        for cell in self._get_cells(*self._map_coords_to_indices(left, y - radius, radius * 2, radius * 2)):
+            for obj in cell:
+                if not left <= obj.pos_x <= right:
+                    continue
+                dx = obj.pos_x - x
+                dy = obj.pos_y - y
+                if dx * dx + dy * dy <= radius_squared and obj is not exclude:
+                    return True
+        return False
+
+    def get_nearest(self, x, y, k: int = 1, max_distance: float = math.inf, kind: type = None,
+                    predicate: Callable[[Object], bool] = None) -> list[Object]:
+        """
+        The k objects whose centers are nearest to (x, y), nearest first. Objects at the same distance are
+        ordered by uid, so the result doesn't depend on how the cells store them.
+        Searches the cells in rings around the point, and stops once no object in the next ring could be nearer
+        than the k found so far. In a crowded area that's only the cells right around the point.
+        Without borders, the rings could go on forever. Once a ring has more cells than there are cells
+        with objects, the cells with objects that are outside the rings searched so far are checked instead.
+        :param max_distance: Only objects within this distance, fewer than k if there aren't enough
+        :param kind: Only objects of this class
+        :param predicate: Only objects for which it returns True, e.g. "nearest edible object"
+        """
+        cells = self.cells
+        cellwidth = self.cellwidth
+        cellheight = self.cellheight
+        center_x = int(x // cellwidth)
+        center_y = int(y // cellheight)
+        limit_squared = max_distance * max_distance
+
+        # Object -> (distance squared, uid), the uid breaks ties. Objects are in every cell they overlap,
+        # so the same object can come up more than once.
+        found = {}
+        ring = 0
+        while True:
+            is_last_ring = ring * 8 > len(cells)
+            if is_last_ring:
+                # All the rest at once
+                search_cells = [(key, cell) for key, cell in cells.items()
+                                if max(abs(key[0] - center_x), abs(key[1] - center_y)) >= ring]
+            else:
+                search_cells = [(key, cells[key]) for key in self._get_ring_cells(center_x, center_y, ring)
+                                if key in cells]
+            for (cell_x, cell_y), cell in search_cells:
+                if self._get_cell_dist_squared(cell_x, cell_y, x, y) > limit_squared:
+                    continue
+                for obj in cell:
+                    dx = obj.pos_x - x
+                    dy = obj.pos_y - y
+                    dist_squared = dx * dx + dy * dy
+                    if (dist_squared <= limit_squared and obj not in found and (kind is None or isinstance(obj, kind))
+                            and (predicate is None or predicate(obj))):
+                        found[obj] = (dist_squared, obj.uid)
+            if is_last_ring:
+                break
+
+            # Every object not seen yet is outside the cells searched so far
+            min_unseen_dist = min(x - (center_x - ring) * cellwidth, (center_x + ring + 1) * cellwidth - x,
+                                  y - (center_y - ring) * cellheight, (center_y + ring + 1) * cellheight - y)
+            if min_unseen_dist > max_distance:
+                break
+            if k and len(found) >= k:
+                # Only the k nearest so far can still be in the result
+                found = dict(heapq.nsmallest(k, found.items(), key=_get_value))
+                limit_squared = max(found.values())[0]
+                if limit_squared <= min_unseen_dist * min_unseen_dist:
+                    break
+            ring += 1
+
+        return [obj for obj, dist_and_uid in heapq.nsmallest(k, found.items(), key=_get_value)]
+
+    def _get_cell_dist_squared(self, cell_x, cell_y, x, y):
+        """
+        :return: Distance from (x, y) to the nearest point of the cell, squared. 0 if the point is in the cell.
+        """
+        left = cell_x * self.cellwidth
+        top = cell_y * self.cellheight
+        dx = max(left - x, x - left - self.cellwidth, 0)
+        dy = max(top - y, y - top - self.cellheight, 0)
+        return dx * dx + dy * dy
 
-        for y in range(top_index, bottom_index + 1):
-            for x in range(left_index, right_index + 1):
-                objs |= self.cells[x][y]
+    @staticmethod
+    def _get_ring_cells(center_x, center_y, ring):
+        """
+        :return: Generator of the indices of the cells that are ring cells away from the center cell,
+                 in x or y or both
+        """
+        if ring == 0:
+            yield center_x, center_y
+            return
+        for y in (center_y - ring, center_y + ring):
+            for x in range(center_x - ring, center_x + ring + 1):
+                yield x, y
+        for x in (center_x - ring, center_x + ring):
+            for y in range(center_y - ring + 1, center_y + ring):
+                yield x, y
 
+    def get_objs_on_segment(self, x0, y0, x1, y1):
+        """
+        Every object whose circle the segment from (x0, y0) to (x1, y1) touches, and others from the same cells.
+        Only the cells the segment crosses are visited.
+        """
+        cells = self.cells
+        objs = set()
+        for x, y, t_exit in self._walk_segment(x0, y0, x1, y1):
+            cell = cells.get((x, y))
+            if cell:
+                objs |= cell
+        return objs
+
+    def get_objs_on_swept_circle(self, x0, y0, x1, y1, radius):
+        """
+        Every object that a circle touches while moving from (x0, y0) to (x1, y1), for continuous collision
+        detection. Within each cell the segment crosses, the cells around that piece of the segment are
+        collected. Usually the radius is small compared to the cells, so these are only one or two.
+        """
+        dx = x1 - x0
+        dy = y1 - y0
+        t_enter = 0
+        objs = set()
+        for x, y, t_exit in self._walk_segment(x0, y0, x1, y1):
+            t_exit = min(t_exit, 1)
+            start_x = x0 + dx * t_enter
+            start_y = y0 + dy * t_enter
+            end_x = x0 + dx * t_exit
+            end_y = y0 + dy * t_exit
+            left = min(start_x, end_x) - radius
+            top = min(start_y, end_y) - radius
+            for cell in self._get_cells(*self._map_coords_to_indices(
+                    left, top, abs(end_x - start_x) + radius * 2, abs(end_y - start_y) + radius * 2)):
+                objs |= cell
+            t_enter = t_exit
         return objs
 
+    def _walk_segment(self, x0, y0, x1, y1):
+        """
+        Visit the cells the segment from (x0, y0) to (x1, y1) crosses, in order
+        (DDA traversal, see Amanatides & Woo, "A Fast Voxel Traversal Algorithm").
+        :return: Generator of (x index, y index, t where the segment leaves the cell),
+                 where t goes from 0 at the start of the segment to 1 at its end
+        """
+        x = int(x0 // self.cellwidth)
+        y = int(y0 // self.cellheight)
+        dx = x1 - x0
+        dy = y1 - y0
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+
+        if dx:
+            t_max_x = ((x + (step_x > 0)) * self.cellwidth - x0) / dx
+            t_delta_x = self.cellwidth / abs(dx)
+        else:
+            t_max_x = t_delta_x = math.inf
+        if dy:
+            t_max_y = ((y + (step_y > 0)) * self.cellheight - y0) / dy
+            t_delta_y = self.cellheight / abs(dy)
+        else:
+            t_max_y = t_delta_y = math.inf
+
+        while True:
+            if t_max_x < t_max_y:
+                yield x, y, t_max_x
+                if t_max_x > 1:
+                    return
+                x += step_x
+                t_max_x += t_delta_x
+            else:
+                yield x, y, t_max_y
+                if t_max_y > 1:
+                    return
+                y += step_y
+                t_max_y += t_delta_y
+
     def _map_coords_to_indices(self, left, top, width, height):
-        left = int(left)
-        top = int(top)
-        width = int(width)
-        height = int(height)
+        # Round the edges, not the size, or an object could reach up to 2 pixels beyond its cells
+        return (int(left // self.cellwidth), int((left + width) // self.cellwidth),
+                int(top // self.cellheight), int((top + height) // self.cellheight))
 
-        left_index = clamp(left // self.cellwidth, 0, self._max_index)
-        right_index = clamp((left + width) // self.cellwidth, 0, self._max_index)
-        top_index = clamp(top // self.cellheight, 0, self._max_index)
-        bottom_index = clamp((top + height) // self.cellheight, 0, self._max_index)
+    def get_stats(self, check_entries: bool = True):
+        """
+        Size of the index and its consistency, to see what an optimization costs in memory,
+        and whether it leaves stale entries behind.
+        :param check_entries: Also count stale and missing entries (see count_bad_entries()), which is slow
+        """
+        cell_entries = 0
+        max_cell_entries = 0
+        # All keys are tuples of two ints, of the same size
+        memory_bytes = (sys.getsizeof(self.cells) + sys.getsizeof(self._obj_indices)
+                        + len(self.cells) * sys.getsizeof((0, 0)))
+        for cell in self.cells.values():
+            memory_bytes += sys.getsizeof(cell)
+            cell_entries += len(cell)
+            max_cell_entries = max(max_cell_entries, len(cell))
+        stats = {
+            "objects": len(self._obj_indices),
+            "cell_entries": cell_entries,
+            "occupied_cells": len(self.cells),
+            "max_cell_entries": max_cell_entries,
+            "memory_bytes": memory_bytes,
+        }
+        if check_entries:
+            stats["stale_entries"], stats["missing_entries"] = self.count_bad_entries()
+        return stats
 
-        return left_index, right_index, top_index, bottom_index
+    def count_bad_entries(self):
+        """
+        Check the index against where the objects are now. Slow, for tests and debugging.
+        :return: Number of stale entries (objects in cells they don't overlap, or that were removed, and empty cells
+                 that weren't deleted), and number of missing entries (objects not in cells they overlap). Both are 0,
+                 unless an object changed its position or radius without move() being called, or the index is broken.
+        """
+        current_indices = {obj: self._get_obj_indices(obj) for obj in self._obj_indices}
+        stale_entries = 0
+        for (x, y), cell in self.cells.items():
+            if not cell:
+                stale_entries += 1
+            for obj in cell:
+                indices = current_indices.get(obj)
+                if indices is None or not (indices[0] <= x <= indices[1] and indices[2] <= y <= indices[3]):
+                    stale_entries += 1
+        missing_entries = 0
+        for obj, (left_index, right_index, top_index, bottom_index) in current_indices.items():
+            for key in product(range(left_index, right_index + 1), range(top_index, bottom_index + 1)):
+                if obj not in self.cells.get(key, ()):
+                    missing_entries += 1
+        return stale_entries, missing_entries
 
     def debug_draw(self, window):
+        # Only the cell borders, the cells might be changing while this is drawn (see render.RenderPipeline)
         import pygame
-        for y in range(self.cellcount):
-            for x in range(self.cellcount):
-                coord_x = x * self.cellwidth
-                coord_y = y * self.cellheight
-
-                # Vertical line
-                start = (coord_x, 0)
-                end = (coord_x, self.height)
-                pygame.draw.line(window, (0, 0, 0), start, end)
-
-                # Horizontal line
-                start = (0, coord_y)
-                end = (self.width, coord_y)
-                pygame.draw.line(window, (0, 0, 0), start, end)
+        width, height = window.get_size()
+        for x in range(0, math.ceil(width / self.cellwidth)):
+            coord_x = x * self.cellwidth
+            pygame.draw.line(window, (0, 0, 0), (coord_x, 0), (coord_x, height))
+        for y in range(0, math.ceil(height / self.cellheight)):
+            coord_y = y * self.cellheight
+            pygame.draw.line(window, (0, 0, 0), (0, coord_y), (width, coord_y))
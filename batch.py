@@ -0,0 +1,176 @@
+"""
+Runs many headless matches between bots, to tune the balance constants. Each match runs in its own worker
+process, so the matches run in parallel on all cores. Every match gets a new state.World.
+
+Example: python batch.py --matches 1000 --bots 8 --set entities.GravityGrenade.ARMING_DURATION=1.5
+"""
+import argparse
+import ast
+import importlib
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from time import perf_counter
+
+
+@dataclass
+class MatchConfig:
+    seed: int
+    bot_count: int = 8
+    # Simulated game time, in seconds
+    duration: float = 120
+    dt: float = 1 / 60
+    window_size: tuple[int, int] = (1920, 1080)
+    # Balance constants to change for this match, by dotted path, e.g. {"state.COLLISION_RADIUS_RATIO": 0.75}
+    constants: dict[str, object] = field(default_factory=dict)
+
+
+@dataclass
+class MatchResult:
+    seed: int
+    ticks: int
+    # Radius of each bot's amoeba at the end, by player id. Missing for bots that were waiting for respawn.
+    final_radii: dict[int, float]
+    # Amoebae that were eaten or cut down
+    deaths: int
+    # Objects eaten by amoebae, food, powerups and other amoebae
+    eaten: int
+    # Real time the match took
+    elapsed: float
+
+    @property
+    def max_radius(self) -> float:
+        return max(self.final_radii.values(), default=0)
+
+
+def run_match(config: MatchConfig) -> MatchResult:
+    """
+    Simulate a match as fast as possible. The same config always gives the same result, also in another process.
+    """
+    import pygame
+    import state
+
+    if not pygame.display.get_init():
+        # Only once per process, for pygame. The matches don't share anything else.
+        state.init_system(config.window_size, headless=True)
+    previous_world = state.world
+    originals = _set_constants(config.constants)
+    try:
+        world = state.World(config.window_size, config.seed)
+        state.set_world(world)
+        state.start_timers()
+        # Like init_board_and_players(), but only bots, all the same size, so no one starts with an advantage
+        state.add_bots(config.bot_count)
+        state.spawn_food(100)
+        state.spawn_powerup(1)
+
+        start = perf_counter()
+        ticks = round(config.duration / config.dt)
+        deaths = 0
+        dead_players = set()
+        for i in range(ticks):
+            state.update(config.dt)
+            # Dead players stay in the queue until they respawn, which takes longer than a tick
+            if world.respawn_queue.keys() != dead_players:
+                deaths += len(world.respawn_queue.keys() - dead_players)
+                dead_players = set(world.respawn_queue)
+
+        final_radii = {amoeba.player_id: amoeba.radius for amoeba in world.entities.player_amoebae}
+        return MatchResult(config.seed, ticks, final_radii, deaths, world.eaten_count, perf_counter() - start)
+    finally:
+        state.set_world(previous_world)
+        for (target, name), value in originals.items():
+            setattr(target, name, value)
+
+
+def run_matches(configs: list[MatchConfig], workers: int = None) -> list[MatchResult]:
+    """
+    :param workers: Number of worker processes, defaults to the number of cores
+    :return: The results in the order of the configs
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        # Matches take long compared to sending them to a worker, so hand them out one by one,
+        # which keeps all workers busy until the end
+        return list(executor.map(run_match, configs, chunksize=1))
+
+
+def aggregate(results: list[MatchResult]) -> dict[str, dict[str, float]]:
+    """
+    :return: Statistic name -> {"mean", "stdev", "min", "max"}, over all matches
+    """
+    samples = {
+        "max_radius": [result.max_radius for result in results],
+        "mean_radius": [statistics.fmean(result.final_radii.values()) if result.final_radii else 0
+                        for result in results],
+        "deaths": [result.deaths for result in results],
+        "eaten": [result.eaten for result in results],
+        "elapsed": [result.elapsed for result in results],
+    }
+    return {name: {
+        "mean": statistics.fmean(values),
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0,
+        "min": min(values),
+        "max": max(values),
+    } for name, values in samples.items()}
+
+
+def _set_constants(constants: dict[str, object]) -> dict[tuple[object, str], object]:
+    """
+    :return: The original values, to restore them after the match
+    """
+    originals = {}
+    try:
+        for path, value in constants.items():
+            module_name, *attributes = path.split(".")
+            if not attributes:
+                raise ValueError(f"Not a constant: {path}, expected e.g. state.MAX_FOOD")
+            target = importlib.import_module(module_name)
+            for attribute in attributes[:-1]:
+                target = getattr(target, attribute)
+            name = attributes[-1]
+            # Fails for names that don't exist, so a typo doesn't go unnoticed
+            originals.setdefault((target, name), getattr(target, name))
+            setattr(target, name, value)
+    except Exception:
+        for (target, name), value in originals.items():
+            setattr(target, name, value)
+        raise
+    return originals
+
+
+def _parse_constant(text: str) -> tuple[str, object]:
+    path, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Expected NAME=VALUE: {text}")
+    try:
+        return path.strip(), ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        raise argparse.ArgumentTypeError(f"Not a number or other Python literal: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many headless bot matches and report statistics")
+    parser.add_argument("--matches", type=int, default=100, help="Number of matches")
+    parser.add_argument("--bots", type=int, default=8, help="Number of bots per match")
+    parser.add_argument("--duration", type=float, default=120, metavar="SECONDS",
+                        help="Game time per match")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first match, the others count up from it")
+    parser.add_argument("--workers", type=int, help="Number of worker processes, defaults to the number of cores")
+    parser.add_argument("--set", type=_parse_constant, action="append", default=[], metavar="NAME=VALUE",
+                        dest="constants", help="Change a balance constant, e.g. state.COLLISION_RADIUS_RATIO=0.75")
+    args = parser.parse_args()
+
+    constants = dict(args.constants)
+    configs = [MatchConfig(args.seed + i, args.bots, args.duration, constants=constants)
+               for i in range(args.matches)]
+    start = perf_counter()
+    results = run_matches(configs, args.workers)
+    elapsed = perf_counter() - start
+
+    print(f"{len(results)} matches in {round(elapsed, 1)} s ({round(len(results) / elapsed, 2)} matches/s)")
+    for name, stats in aggregate(results).items():
+        print(f"{name:>12}: " + ", ".join(f"{key} {value:.2f}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import math
+from random import Random
+
+from input import InputState, NO_INPUT
+from entities import PlayerAmoeba
+from powerups import Powerup
+import state
+import utils
+
+
+class BotController:
+    """
+    A controller driven by an AI instead of a human. Plugs into state.World.player_to_controller_map like any
+    other controller. Decisions are made by BotPool.update(), sample() just returns the latest one.
+    """
+    # How far a bot can see, in addition to its own radius
+    VISION_RANGE = 200
+    # Only shoot at amoebae closer than this
+    FIRE_RANGE = 400
+    # How close the aim needs to be to the target before firing
+    FIRE_ANGLE = math.radians(15)
+
+    def __init__(self, name: str, rng: Random):
+        self.name = name
+        self.player_id: int = None
+        self.input_state = NO_INPUT
+        self._rng = rng
+        # Direction to wander in when there is nothing interesting in sight
+        self._wander_x, self._wander_y = utils.angle_to_vec(rng.random() * math.tau)
+
+    def get_name(self):
+        return self.name
+
+    def sample(self, pressed=None) -> InputState:
+        return self.input_state
+
+    def get_axis(self, axis: int):
+        return self.input_state.get_axis(axis)
+
+    def think(self, amoeba: PlayerAmoeba, accelerator, amoeba_index):
+        """
+        :param amoeba_index: Spatial hash of only the amoebae (see EntityCollection.get_amoeba_index())
+        """
+        x = amoeba.pos_x
+        y = amoeba.pos_y
+        radius = amoeba.radius
+        vision = radius + self.VISION_RANGE
+        # Same rules as the eat check in state.update()
+        max_edible_radius = radius * state.COLLISION_RADIUS_RATIO
+
+        def is_food(obj):
+            return obj.radius <= max_edible_radius and (obj.is_edible or isinstance(obj, Powerup))
+
+        flee_x = 0
+        flee_y = 0
+        nearest_enemy = None
+        nearest_enemy_dist_squared = self.FIRE_RANGE ** 2
+        for enemy in amoeba_index.get_objs_in_radius(x, y, vision):
+            if enemy is amoeba:
+                continue
+            dx = enemy.pos_x - x
+            dy = enemy.pos_y - y
+            dist_squared = dx * dx + dy * dy
+            if dist_squared < nearest_enemy_dist_squared:
+                nearest_enemy = enemy
+                nearest_enemy_dist_squared = dist_squared
+            if enemy.radius * state.COLLISION_RADIUS_RATIO >= radius:
+                # It can eat us, get away. Closer threats are more urgent.
+                weight = 1 / max(dist_squared, 1)
+                flee_x -= dx * weight
+                flee_y -= dy * weight
+
+        # Food is only looked for when there is nothing to flee from
+        nearest_food = None if flee_x or flee_y else accelerator.get_nearest(x, y, 1, vision, predicate=is_food)
+        if flee_x or flee_y:
+            move_x, move_y = flee_x, flee_y
+        elif nearest_food:
+            move_x = nearest_food[0].pos_x - x
+            move_y = nearest_food[0].pos_y - y
+        else:
+            if self._rng.random() < 0.1:
+                self._wander_x, self._wander_y = utils.angle_to_vec(self._rng.random() * math.tau)
+            move_x, move_y = self._wander_x, self._wander_y
+
+        aim_x = 0
+        aim_y = 0
+        fire = False
+        if nearest_enemy:
+            aim_x = nearest_enemy.pos_x - x
+            aim_y = nearest_enemy.pos_y - y
+            target_angle = utils.vec_to_angle((aim_x, aim_y))
+            fire = abs(utils.calc_angle_difference(amoeba.aim_angle, target_angle)) < self.FIRE_ANGLE
+
+        move_x, move_y = utils.normalize((move_x, move_y))
+        aim_x, aim_y = utils.normalize((aim_x, aim_y))
+        # Fires the active powerup too, if it's a laser
+        trigger = 1 if fire else 0
+        self.input_state = InputState(move_x, move_y, aim_x, aim_y, right_trigger=trigger, left_trigger=trigger)
+
+
+class BotPool:
+    """
+    Runs the decisions of all bots. Each bot only thinks every think_interval ticks, and the bots are
+    spread evenly over these ticks, so the cost per tick stays flat no matter when bots were added.
+    In between, bots keep their last input.
+    """
+    def __init__(self, think_interval: int = 10, seed: int = None):
+        self.think_interval = think_interval
+        self.bots: list[BotController] = []
+        self.tick = 0
+        # Bots have their own random number generator. They are controllers, so their decisions are
+        # recorded as input, and must not influence the random numbers the simulation sees.
+        self.rng = Random(seed)
+
+    def create_bot(self) -> BotController:
+        bot = BotController(f"Bot {len(self.bots) + 1}", self.rng)
+        self.bots.append(bot)
+        return bot
+
+    def remove_bot(self, bot: BotController):
+        self.bots.remove(bot)
+
+    def update(self, entities):
+        self.tick += 1
+        due_bots = self.bots[self.tick % self.think_interval::self.think_interval]
+        if not due_bots:
+            return
+
+        amoebae_by_player = {amoeba.player_id: amoeba for amoeba in entities.player_amoebae}
+        accelerator = entities.accelerator
+        amoeba_index = entities.get_amoeba_index()
+        for bot in due_bots:
+            amoeba = amoebae_by_player.get(bot.player_id)
+            if amoeba:
+                bot.think(amoeba, accelerator, amoeba_index)
+            else:
+                # Dead, waiting for respawn
+                bot.input_state = NO_INPUT
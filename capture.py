@@ -0,0 +1,122 @@
+import os
+import queue
+import subprocess
+import threading
+
+import pygame
+
+# Frames waiting for the writer. Each is a copy of the window (about 3.5 MB at 1280x720), so this bounds the memory.
+MAX_QUEUED_FRAMES = 30
+# Paths with these extensions are encoded as a video, everything else is a directory for an image sequence
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".webm", ".avi", ".mov")
+
+
+class ImageSequenceWriter:
+    """
+    Saves every frame as a numbered PNG file in a directory.
+    """
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.frame_count = 0
+
+    def write(self, frame: pygame.Surface):
+        pygame.image.save(frame, os.path.join(self.directory, f"frame_{self.frame_count:06}.png"))
+        self.frame_count += 1
+
+    def close(self):
+        pass
+
+
+class VideoPipeWriter:
+    """
+    Pipes the frames as raw RGB video into an encoder process, by default ffmpeg, which has to be installed.
+    """
+    def __init__(self, path: str, size: tuple[int, int], framerate: float, command: list[str] = None):
+        """
+        :param command: Command line of the encoder, which reads raw RGB frames of the given size from stdin.
+                        Defaults to ffmpeg writing to path.
+        """
+        if command is None:
+            width, height = size
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                       "-s", f"{width}x{height}", "-r", str(framerate), "-i", "-", "-pix_fmt", "yuv420p", path]
+        self.frame_count = 0
+        try:
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError(f"Video encoder {command[0]} not found, install it or capture to a directory instead")
+
+    def write(self, frame: pygame.Surface):
+        self._process.stdin.write(pygame.image.tobytes(frame, "RGB"))
+        self.frame_count += 1
+
+    def close(self):
+        self._process.stdin.close()
+        exit_code = self._process.wait()
+        if exit_code:
+            raise RuntimeError(f"The video encoder failed with exit code {exit_code}")
+
+
+class FrameCapture:
+    """
+    Records the frames drawn into the window, to watch bot matches or replays later, also ones that ran without
+    a display (see --headless). Each frame is copied, and saved by a writer thread. The game never waits for the
+    disk or the encoder: while the writer is behind and the queue is full, frames are dropped and counted instead.
+    """
+    def __init__(self, writer, max_queued: int = MAX_QUEUED_FRAMES):
+        """
+        :param writer: ImageSequenceWriter, VideoPipeWriter or anything else with write(surface) and close()
+        """
+        self.writer = writer
+        self.captured = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(max_queued)
+        self._error: Exception = None
+        self._thread = threading.Thread(target=self._write_frames, name="Capture", daemon=True)
+        self._thread.start()
+
+    def capture(self, surface: pygame.Surface):
+        # Re-raises the exception from the writer thread, if writing failed
+        if self._error:
+            raise self._error
+        # Only this thread adds frames, so the queue can't fill up between the check and put_nowait()
+        if self._queue.full():
+            self.dropped += 1
+            return
+        self._queue.put_nowait(surface.copy())
+        self.captured += 1
+
+    def close(self):
+        """
+        Wait until the frames in the queue are written.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close()
+        if self._error:
+            raise self._error
+
+    def _write_frames(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            # After an error, the rest of the frames are only taken from the queue, so close() doesn't block
+            if self._error:
+                continue
+            try:
+                self.writer.write(frame)
+            except Exception as e:
+                self._error = e
+
+
+def open_capture(path: str, size: tuple[int, int], framerate: float) -> FrameCapture:
+    """
+    :param path: A video file (see VIDEO_EXTENSIONS), or a directory for an image sequence
+    """
+    if path.lower().endswith(VIDEO_EXTENSIONS):
+        writer = VideoPipeWriter(path, size, framerate)
+    else:
+        writer = ImageSequenceWriter(path)
+    return FrameCapture(writer)
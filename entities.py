@@ -1,21 +1,58 @@
-import pygame
-from random import random
 import math
+from collections import deque
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional
 
+import render
 import state
 import utils
 
 
+# Fraction of speed that is left after one second
+DAMPING_RATE = 0.04
+# Damping never stops an object completely, below this speed (pixels per second) it's put to rest
+REST_SPEED = 1
+
+
+# All objects move with the same dt in a tick
+@lru_cache(maxsize=8)
+def calc_damping(dt: float):
+    """
+    :return: Factor to multiply the speed with, and factor to multiply the speed with to get the distance travelled.
+    """
+    # From https://gamedev.stackexchange.com/a/169559
+    pow_r_dt = pow(DAMPING_RATE, dt)
+    damping = (pow_r_dt - 1) / math.log(DAMPING_RATE)
+    return pow_r_dt, damping
+
+
 class Object:
+    # Objects are hashed by a sequential id instead of their memory address. This makes the iteration order
+    # of sets of objects (e.g. results of accelerator queries) the same in every run, which replays rely on.
+    next_uid = 0
+
     def __init__(self, x: float, y: float, radius: float):
+        self.uid = Object.next_uid
+        Object.next_uid += 1
         self.pos_x = x
         self.pos_y = y
         self.radius = radius
         self.is_edible = False
 
+    def __hash__(self):
+        return self.uid
+
     def draw(self):
+        commands = []
+        self.add_draw_commands(commands, utils.get_time())
+        render.execute(state.window, commands)
+
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        """
+        Describe how to draw this object (see render.py). Must only copy data, as the commands
+        might be executed on another thread while this object is already being updated.
+        """
         raise NotImplementedError()
 
 
@@ -30,19 +67,28 @@ class MovingObject(Object):
         self.speed_y += dir_y * strength
 
     def update(self, dt: float):
-        # From https://gamedev.stackexchange.com/a/169559
-        r = 0.04
-        pow_r_dt = pow(r, dt)
-        damping = (pow_r_dt - 1) / math.log(r)
-        self.pos_x += self.speed_x * damping
-        self.pos_y += self.speed_y * damping
-        self.speed_x *= pow_r_dt
-        self.speed_y *= pow_r_dt
+        if not (self.speed_x or self.speed_y):
+            # At rest, nothing would change (most food is)
+            return
 
-        # Prevent stuff from going beyond the edges of the screen
-        import state
-        self.pos_x = utils.clamp(self.pos_x, 0, state.window.get_width())
-        self.pos_y = utils.clamp(self.pos_y, 0, state.window.get_height())
+        pow_r_dt, damping = calc_damping(dt)
+        speed_x = self.speed_x
+        speed_y = self.speed_y
+        x = self.pos_x + speed_x * damping
+        y = self.pos_y + speed_y * damping
+        speed_x *= pow_r_dt
+        speed_y *= pow_r_dt
+        if speed_x * speed_x + speed_y * speed_y < REST_SPEED * REST_SPEED:
+            speed_x = 0
+            speed_y = 0
+        self.speed_x = speed_x
+        self.speed_y = speed_y
+
+        # Prevent stuff from going beyond the edges of the board. Same as utils.clamp(), which is a call
+        # per object more.
+        world = state.world
+        self.pos_x = min(max(x, 0), world.width)
+        self.pos_y = min(max(y, 0), world.height)
 
 
 class Food(MovingObject):
@@ -51,17 +97,18 @@ class Food(MovingObject):
         self.color = color
         self.is_edible = True
 
-    def draw(self):
-        import state
-        pygame.draw.circle(state.window, self.color, (self.pos_x, self.pos_y), self.radius)
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        commands.append((render.CIRCLE, self.color, (self.pos_x, self.pos_y), self.radius, 0))
 
 
 class Amoeba(MovingObject):
     def __init__(self, x: float, y: float, radius: float, color=None):
         super().__init__(x, y, radius)
+        self.set_radius(radius)
         if color:
             self.color = color
         else:
+            random = state.world.rng.random
             color = [random() * 255, random() * 255, random() * 255]
             # Make sure it's a bright color
             max_value = max(color)
@@ -70,29 +117,123 @@ class Amoeba(MovingObject):
                 color[random_channel] = 200 + random() * 55
             self.color = color
         self.is_edible = True
-
-    def eat(self, other):
+        # Weapon use since the last metabolism update (see state.apply_metabolism())
+        self.energy_used = 0
+        self.nucleus = Nucleus(self)
+
+    # The area is the mass of an amoeba. It's what is gained and lost, the radius is derived from it.
+    # Don't assign the radius directly (it's a plain attribute, because it's read all the time), use these.
+    def set_area(self, area: float):
+        self.area = area
+        self.radius = math.sqrt(area / math.pi)
+
+    def set_radius(self, radius: float):
+        self.set_area((radius ** 2) * math.pi)
+
+    def eat(self, other) -> float:
+        """
+        :return: The area gained
+        """
         if self.radius < other.radius:
             # Cant' eat something bigger than yourself
-            return
-        area = (self.radius ** 2) * math.pi
+            return 0
         other_area = (other.radius ** 2) * math.pi
-        self.radius = math.sqrt((area + other_area) / math.pi)
-
-    def draw(self):
-        import state
-        outline_width = 2
-        outline_color = [50] * 3
-        pygame.draw.circle(state.window, self.color, (self.pos_x, self.pos_y), self.radius)
-        pygame.draw.circle(state.window, outline_color, (self.pos_x, self.pos_y), self.radius, outline_width)
-
-        if self.radius > 30:
-            text_surface = state.my_font.render(str(round(self.radius)), True, (0, 0, 0))
-            state.window.blit(text_surface, (self.pos_x - text_surface.get_width() / 2,
-                                             self.pos_y - text_surface.get_height() / 2))
+        self.set_area(self.area + other_area)
+        return other_area
+
+    def lose_area(self, lost_area: float):
+        self.set_area(max(self.area - lost_area, 0))
+
+    def split_off(self, lost_area: float, dir_x: float, dir_y: float, piece_count: int):
+        """
+        Lose area, which flies off as pieces of food in a fan around the given direction.
+        :return: The new pieces of food
+        """
+        self.lose_area(lost_area)
+        piece_radius = math.sqrt(lost_area / piece_count / math.pi)
+        if piece_radius < 1:
+            # Too small to bother
+            return []
+
+        SPREAD = math.radians(25)
+        SPLIT_SPEED = 300
+        base_angle = utils.vec_to_angle((dir_x, dir_y))
+        distance = self.radius + piece_radius
+        pieces = []
+        for i in range(piece_count):
+            piece_x, piece_y = utils.angle_to_vec(base_angle + (i - (piece_count - 1) / 2) * SPREAD)
+            piece = state.world.entities.food_pool.acquire(self.pos_x + piece_x * distance,
+                                                           self.pos_y + piece_y * distance, piece_radius, self.color)
+            piece.speed_x = self.speed_x
+            piece.speed_y = self.speed_y
+            piece.accelerate(piece_x, piece_y, SPLIT_SPEED)
+            pieces.append(piece)
+        return pieces
+
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        detail = state.level_of_detail.level
+        center = (self.pos_x, self.pos_y)
+        commands.append((render.CIRCLE, self.color, center, self.radius, 0))
+        if self.radius >= detail.outline_radius:
+            outline_width = 2
+            outline_color = [50] * 3
+            commands.append((render.CIRCLE, outline_color, center, self.radius, outline_width))
+            self.nucleus.add_draw_commands(commands, game_time)
+
+        if self.radius > detail.label_radius:
+            commands.append((render.TEXT, str(round(self.radius)), center, state.my_font, (0, 0, 0), None, True))
+
+
+class Nucleus:
+    """
+    The weak spot of an amoeba. It's small and wanders around inside the amoeba, so it's hard to hit.
+    A nucleus is not in the accelerator. It always lies inside its amoeba, so it's only checked for amoebae
+    that were already hit (see state.apply_laser() and state.resolve_grenade_impacts()).
+    Its position follows from the game time, so it doesn't need to be saved in snapshots.
+    """
+    # Radius in relation to the amoeba
+    RADIUS_RATIO = 0.2
+    # How far the center wanders from the center of the amoeba, in relation to the amoeba's radius
+    WANDER_RATIO = 0.45
+
+    def __init__(self, parent: Amoeba):
+        self.parent = parent
+
+    def get_circle(self, game_time: float) -> tuple[float, float, float]:
+        """
+        :return: x, y and radius
+        """
+        parent = self.parent
+        # Different frequencies on the two axes, and a different phase for each amoeba
+        phase = parent.uid
+        wander = parent.radius * self.WANDER_RATIO
+        x = parent.pos_x + math.cos(game_time * 0.7 + phase) * wander
+        y = parent.pos_y + math.sin(game_time * 1.1 + phase * 1.7) * wander
+        return x, y, parent.radius * self.RADIUS_RATIO
+
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        x, y, radius = self.get_circle(game_time)
+        if radius < 2:
+            return
+        color = [channel * 0.6 for channel in self.parent.color]
+        commands.append((render.CIRCLE, color, (x, y), radius, 0))
 
 
 class PlayerAmoeba(Amoeba):
+    """
+    Powerups that were eaten are queued up in reserve_powerups, and become the active powerup one after the other.
+    Until then they float around inside the amoeba like particles. Their positions and speeds are in the amoeba's
+    local space, relative to its center and its speed, so they move along with it without being updated one by one
+    like objects in the world. Only drawing and activation turn them into world positions.
+    """
+    # Reserve powerups that drift further from the center than this (in relation to the radius) are pulled back
+    RESERVE_AREA_RATIO = 0.7
+    # Maximum speed change per tick of the random drift of reserve powerups
+    RESERVE_DRIFT = 10
+    # The grenade launcher powerup fires this many grenades at once, in a fan around the aim
+    VOLLEY_GRENADES = 3
+    VOLLEY_SPREAD = math.radians(20)
+
     def __init__(self, player_id: int, x: float, y: float):
         PLAYER_INIT_RADIUS = 10
         super().__init__(x, y, PLAYER_INIT_RADIUS)
@@ -103,11 +244,22 @@ class PlayerAmoeba(Amoeba):
         self.aim_angle: float = 0
         # turn speed in degrees per second
         self.aim_speed: float = math.radians(90)
-        self.reserve_powerups = []
+        self.reserve_powerups: deque = deque()
         from powerups import Powerup
         self.active_powerup: Optional[Powerup] = None
 
+    def set_area(self, area: float):
+        super().set_area(area)
+        # Keeps the ranking up to date without sorting it every frame
+        if state.world:
+            state.world.leaderboard.on_area_changed(self)
+
     def add_powerup(self, powerup):
+        # Into local space, starting at rest relative to the amoeba
+        powerup.pos_x -= self.pos_x
+        powerup.pos_y -= self.pos_y
+        powerup.speed_x = 0
+        powerup.speed_y = 0
         self.reserve_powerups.append(powerup)
 
     def update_aim(self, dt: float, aim_x: float, aim_y: float):
@@ -123,50 +275,67 @@ class PlayerAmoeba(Amoeba):
 
     def update(self, dt: float):
         super().update(dt)
+        self.update_powerups(dt)
 
+    def update_powerups(self, dt: float):
+        """
+        Move the powerups along, after the amoeba moved. Also runs while the amoeba is at rest.
+        """
         if not self.active_powerup and self.reserve_powerups:
-            self.active_powerup = self.reserve_powerups.pop(0)
+            self.active_powerup = self.reserve_powerups.popleft()
+            self.active_powerup.speed_x = self.speed_x
+            self.active_powerup.speed_y = self.speed_y
 
         if self.active_powerup:
             aim_x, aim_y = utils.angle_to_vec(self.aim_angle)
             self.active_powerup.pos_x = self.pos_x + aim_x * self.radius
             self.active_powerup.pos_y = self.pos_y + aim_y * self.radius
 
+        if self.reserve_powerups:
+            self.update_reserve_powerups(dt)
+
+    def update_reserve_powerups(self, dt: float):
+        """
+        Let the reserve powerups drift around randomly inside the amoeba. Like MovingObject.update(), but in local
+        space, so the damping is calculated once for all of them, and there are no window edges to clamp to.
+        """
+        pow_r_dt, damping = calc_damping(dt)
+        max_distance_squared = (self.radius * self.RESERVE_AREA_RATIO) ** 2
+        drift = self.RESERVE_DRIFT
+        random = state.world.rng.random
         for powerup in self.reserve_powerups:
-            # Copy player cell acceleration to powerups
-            powerup.speed_x = self.speed_x
-            powerup.speed_y = self.speed_y
-
-            # Make the powerups move inside the player amoeba randomly
-            distance_squared = utils.calc_distance_squared_objs(self, powerup)
-
-            if distance_squared > (self.radius * 0.7)**2:
-                # Accelerate back towards center
-                dir_x = self.pos_x - powerup.pos_x
-                dir_y = self.pos_y - powerup.pos_y
+            x = powerup.pos_x
+            y = powerup.pos_y
+            distance_squared = x * x + y * y
+            if distance_squared > max_distance_squared:
+                # Accelerate back towards the center
+                strength = random() * drift / math.sqrt(distance_squared)
+                speed_x = powerup.speed_x - x * strength
+                speed_y = powerup.speed_y - y * strength
             else:
-                # Accelerate in random direction
-                dir_x = random() * 2 - 1
-                dir_y = random() * 2 - 1
-
-            dir_x, dir_y = utils.normalize((dir_x, dir_y))
-            powerup.accelerate(dir_x, dir_y, random() * 10)
-
-            powerup.update(dt)
-
-    def draw(self):
-        super().draw()
+                # Accelerate in a random direction
+                angle = random() * math.tau
+                strength = random() * drift
+                speed_x = powerup.speed_x + math.cos(angle) * strength
+                speed_y = powerup.speed_y + math.sin(angle) * strength
+            powerup.pos_x = x + speed_x * damping
+            powerup.pos_y = y + speed_y * damping
+            powerup.speed_x = speed_x * pow_r_dt
+            powerup.speed_y = speed_y * pow_r_dt
+
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        super().add_draw_commands(commands, game_time)
 
         # Draw powerups
         if self.active_powerup:
-            self.active_powerup.draw()
+            self.active_powerup.add_draw_commands(commands, game_time)
 
-        for powerup in self.reserve_powerups:
-            powerup.draw()
+        if state.level_of_detail.level.reserve_powerups:
+            for powerup in self.reserve_powerups:
+                powerup.add_draw_commands_at(commands, self.pos_x + powerup.pos_x, self.pos_y + powerup.pos_y)
 
         if state.draw_debug:
             # Show where the aim is currently
-            from state import window
             color = (1, 0, 0)
 
             aim_x = math.cos(self.aim_angle)
@@ -176,9 +345,28 @@ class PlayerAmoeba(Amoeba):
             end_pos = (self.pos_x + aim_x * 100,
                        self.pos_y + aim_y * 100)
             width = 2
-            pygame.draw.line(window, color, start_pos, end_pos, width)
-
-            utils.draw_text(window, str(math.degrees(self.aim_angle)), (self.pos_x, self.pos_y), state.debug_font)
+            commands.append((render.LINE, color, start_pos, end_pos, width))
+
+            commands.append((render.TEXT, str(math.degrees(self.aim_angle)), start_pos, state.debug_font,
+                             (0, 0, 0), None, False))
+
+    def fire_powerup(self, game_time: float):
+        """
+        Use up the active powerup, so the next one in reserve becomes active.
+        :return: The laser that was fired or None, and the grenades that were fired
+        """
+        from powerups import PowerupType, Laser
+        if not self.active_powerup:
+            return None, []
+
+        powerup_type = self.active_powerup.powerup_type
+        self.active_powerup = None
+        if powerup_type == PowerupType.LASER:
+            return Laser(self, game_time), []
+        # Grenade launcher, it doesn't need to be reloaded
+        grenades = [self._launch_grenade(game_time, self.aim_angle + (i - (self.VOLLEY_GRENADES - 1) / 2)
+                                         * self.VOLLEY_SPREAD) for i in range(self.VOLLEY_GRENADES)]
+        return None, grenades
 
     def fire_grenade(self, game_time: float):
         if game_time - self.last_grenade_fired < self.GRENADE_RELOAD_TIME:
@@ -186,14 +374,16 @@ class PlayerAmoeba(Amoeba):
             return None
 
         self.last_grenade_fired = game_time
+        return self._launch_grenade(game_time, self.aim_angle)
 
+    def _launch_grenade(self, game_time: float, angle: float):
         # Create the grenade outside of our circle in the direction that we're aiming
         spawn_distance = self.radius + 10
-        aim_x, aim_y = utils.angle_to_vec(self.aim_angle)
+        aim_x, aim_y = utils.angle_to_vec(angle)
         x = self.pos_x + aim_x * spawn_distance
         y = self.pos_y + aim_y * spawn_distance
 
-        grenade = GravityGrenade(x, y, game_time)
+        grenade = state.world.entities.grenade_pool.acquire(x, y, game_time, self)
 
         # Copy our own impulse
         grenade.speed_x = self.speed_x
@@ -209,51 +399,67 @@ class PlayerAmoeba(Amoeba):
 # TODO Grenade could also look like a small black hole once it activates, then gets bigger the more it swallows
 #  until it shrinks rapidly
 class GravityGrenade(MovingObject):
-    def __init__(self, x: float, y: float, creation_time: float):
+    # TODO maybe it would be a better idea to use percentages of the total lifetime for these steps
+    #  Like ARMING_DURATION = 0.1, FUSE_DURATION = 0.8, and EXPLOSION_DURATION is implicitly what's left until 1.0
+    # Time until the grenade activates its gravity after creation
+    ARMING_DURATION = 2
+    # Time until the grenade explodes after arming
+    FUSE_DURATION = 10
+    EXPLOSION_DURATION = 0.5
+
+    def __init__(self, x: float, y: float, creation_time: float, owner: Optional[PlayerAmoeba] = None):
         GRENADE_RADIUS = 10
         super().__init__(x, y, GRENADE_RADIUS)
         self.creation_time = creation_time
-        # TODO maybe it would be a better idea to use percentages of the total lifetime for these steps
-        #  Like ARMING_DURATION = 0.1, FUSE_DURATION = 0.8, and EXPLOSION_DURATION is implicitly what's left until 1.0
-        # Time until the grenade activates its gravity after creation
-        self.ARMING_DURATION = 2
-        # Time until the grenade explodes after arming
-        self.FUSE_DURATION = 10
-        self.EXPLOSION_DURATION = 0.5
+        # The grenade doesn't hit the amoeba that fired it
+        self.owner = owner
         self.LIFETIME = self.ARMING_DURATION + self.FUSE_DURATION + self.EXPLOSION_DURATION
+        # Can be earlier, if another explosion sets this grenade off
+        self.detonation_time = creation_time + self.ARMING_DURATION + self.FUSE_DURATION
+        # The blast is applied once, see state.apply_explosions()
+        self.has_exploded = False
+        # Scheduled arming, detonation and removal (see state.schedule_grenade())
+        self.events = []
 
     def is_active(self, game_time: float):
         elapsed = game_time - self.creation_time
-        return elapsed > self.ARMING_DURATION and elapsed < self.ARMING_DURATION + self.FUSE_DURATION
+        return elapsed > self.ARMING_DURATION and game_time < self.detonation_time
 
     def is_exploding(self, game_time: float):
-        elapsed = game_time - self.creation_time
-        return elapsed > self.ARMING_DURATION + self.FUSE_DURATION and elapsed < self.LIFETIME
+        return self.detonation_time < game_time < self.detonation_time + self.EXPLOSION_DURATION
+
+    def detonate(self, game_time: float):
+        """
+        Explode early. The blast happens in the next tick, so chain reactions are spread over several ticks.
+        """
+        self.detonation_time = min(self.detonation_time, game_time)
 
     def get_lifetime_percent(self, game_time: float):
         elapsed = game_time - self.creation_time
         return elapsed / self.LIFETIME
 
+    def get_gravity_mass(self, game_time: float):
+        # Grenade gets heavier and heavier over time
+        return 10 + 200 * self.get_lifetime_percent(game_time)
+
     def should_be_removed(self, game_time: float):
-        elapsed = game_time - self.creation_time
-        return elapsed > self.LIFETIME
+        return game_time > self.detonation_time + self.EXPLOSION_DURATION
 
-    def draw(self):
-        from state import window
-        game_time = utils.get_time()
-        elapsed = game_time - self.creation_time
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        center = (self.pos_x, self.pos_y)
 
         if self.is_exploding(game_time):
             # Goes from 0 to 1
-            explosion_timeline_pos = (elapsed - (self.ARMING_DURATION + self.FUSE_DURATION)) / self.EXPLOSION_DURATION
+            explosion_timeline_pos = (game_time - self.detonation_time) / self.EXPLOSION_DURATION
             color = (255, 128, 0)
-            # Over the explosion time, the radius gets bigger, then smaller
-            radius = self.radius + math.sin(explosion_timeline_pos * math.pi) * (self.radius * 10)
-            pygame.draw.circle(window, color, (self.pos_x, self.pos_y), radius)
+            # Over the explosion time, the radius gets bigger (up to the range of the blast), then smaller
+            radius = self.radius + math.sin(explosion_timeline_pos * math.pi) * (state.EXPLOSION_RANGE - self.radius)
+            commands.append((render.CIRCLE, color, center, radius, 0))
         else:
             color = (220, 0, 0) if self.is_active(game_time) else (0, 0, 0)
-            pygame.draw.circle(window, color, (self.pos_x, self.pos_y), self.radius)
+            commands.append((render.CIRCLE, color, center, self.radius, 0))
 
-            # pygame.draw.circle(state.window, color, (self.pos_x, self.pos_y), 100, 1)
-            # pygame.draw.circle(state.window, color, (self.pos_x, self.pos_y), 200, 1)
-            pygame.draw.circle(window, color, (self.pos_x, self.pos_y), 300, 1)
+            if state.level_of_detail.level.grenade_rings:
+                # commands.append((render.CIRCLE, color, center, 100, 1))
+                # commands.append((render.CIRCLE, color, center, 200, 1))
+                commands.append((render.CIRCLE, color, center, 300, 1))
@@ -0,0 +1,56 @@
+import json
+import os
+from typing import Optional
+
+import pygame
+
+# Where the paths of fonts are remembered between runs
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "amoeba_game", "fonts.json")
+
+# Font name -> path of the font file, None if the font isn't installed (the default font is used then)
+_paths: dict[str, Optional[str]] = None
+
+
+def load_font(name: str, size: int) -> pygame.font.Font:
+    """
+    Like pygame.font.SysFont(), but faster to start up. To find a font by name, pygame scans all fonts installed
+    on the system (on Linux it runs fc-list), which can take longer than everything else at startup together.
+    The paths it finds are cached in a file, so the scan only happens when a font is used for the first time.
+    """
+    return pygame.font.Font(_get_path(name), size)
+
+
+def _get_path(name: str) -> Optional[str]:
+    global _paths
+    if _paths is None:
+        _paths = _load_cache()
+
+    if name in _paths:
+        path = _paths[name]
+        # The font could have been uninstalled since
+        if path is None or os.path.exists(path):
+            return path
+
+    path = pygame.font.match_font(name)
+    _paths[name] = path
+    _save_cache()
+    return path
+
+
+def _load_cache() -> dict[str, Optional[str]]:
+    try:
+        with open(CACHE_PATH) as file:
+            paths = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return paths if isinstance(paths, dict) else {}
+
+
+def _save_cache():
+    # Without the cache, startup is only slower, so don't fail
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        with open(CACHE_PATH, "w") as file:
+            json.dump(_paths, file)
+    except OSError:
+        pass
@@ -0,0 +1,143 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from input import SimulationSettings
+from render import LevelOfDetail
+
+
+@dataclass
+class Knob:
+    """
+    A setting the governor can turn down, in steps from full quality to the lowest load.
+    """
+    name: str
+    steps: list
+    index: int = 0
+
+    @property
+    def value(self):
+        return self.steps[self.index]
+
+
+@dataclass
+class Adjustment:
+    frame: int
+    knob: str
+    old_value: object
+    new_value: object
+    reason: str
+
+    def describe(self):
+        return f"{self.knob} {_format(self.old_value)} -> {_format(self.new_value)} ({self.reason})"
+
+
+class FrameGovernor:
+    """
+    Holds the frame rate when the game gets too heavy. Turns down knobs that carry a lot of the load, one step
+    at a time and within bounds, and turns them back up when there is time to spare. Decides from the time
+    used per frame (clock.get_rawtime()) and how it's split between simulating and drawing: if drawing takes
+    longer, the render detail goes down first, otherwise the simulation.
+    Changes to the simulation are handed to state.update() with the tick input (see pop_settings()),
+    so replays see them too. Every adjustment is logged with the reason, so it's clear why the board was thinned.
+    """
+    # Frames to wait after an adjustment, for its effect to show in the frame time
+    SETTLE_FRAMES = 30
+    # Turn knobs back up when frames take less than this fraction of the budget
+    RELAX_RATIO = 0.6
+    # Weight of the latest frame in the smoothed times, single slow frames shouldn't change anything
+    SMOOTHING = 0.1
+
+    def __init__(self, target_framerate: float, defaults: SimulationSettings, level_of_detail: LevelOfDetail,
+                 adjust_simulation: bool = True):
+        """
+        :param defaults: The settings at full quality
+        :param adjust_simulation: False to only adjust the render detail, e.g. when playing back a replay,
+                                  which has the settings it was recorded with
+        """
+        self.budget_ms = 1000 / target_framerate
+        self.level_of_detail = level_of_detail
+        self.adjust_simulation = adjust_simulation
+
+        self.render_detail = Knob("render detail level", list(range(len(LevelOfDetail.LEVELS))))
+        # In the order they are turned down, the ones that are noticed the least come first
+        self.food_interval = Knob("food interval", [defaults.food_interval_sec * factor for factor in (1, 2, 4, 8)])
+        self.max_food = Knob("max food", [int(defaults.max_food * factor) for factor in (1, 0.5, 0.25, 0.1)])
+        self.gravity_range = Knob("gravity range", [defaults.gravity_range * factor for factor in (1, 0.85, 0.7, 0.5)])
+        self.simulation_knobs = [self.food_interval, self.max_food, self.gravity_range]
+
+        # Smoothed times per frame
+        self.frame_ms = 0
+        self.simulation_ms = 0
+        self.render_ms = 0
+        self.frame_count = 0
+        self._frames_since_change = 0
+        # Knobs in the order they were turned down, they are turned back up in reverse
+        self._lowered: list[Knob] = []
+        self._pending_settings: Optional[SimulationSettings] = None
+        self.adjustments: deque[Adjustment] = deque(maxlen=1000)
+
+    def update(self, frame_ms: float, simulation_ms: float, render_ms: float):
+        """
+        Call once per frame.
+        :param frame_ms: Time that was actually used for the last frame, excluding idle waiting time
+        :param simulation_ms: Part of it that went to state.update()
+        :param render_ms: Part of it that went to drawing
+        """
+        self.frame_ms += (frame_ms - self.frame_ms) * self.SMOOTHING
+        self.simulation_ms += (simulation_ms - self.simulation_ms) * self.SMOOTHING
+        self.render_ms += (render_ms - self.render_ms) * self.SMOOTHING
+        self.frame_count += 1
+        self._frames_since_change += 1
+        if self._frames_since_change < self.SETTLE_FRAMES:
+            return
+
+        if self.frame_ms > self.budget_ms:
+            self._lower()
+        elif self.frame_ms < self.budget_ms * self.RELAX_RATIO and self._lowered:
+            knob = self._lowered.pop()
+            self._set(knob, knob.index - 1, "time to spare")
+
+    def pop_settings(self) -> Optional[SimulationSettings]:
+        """
+        :return: The new simulation settings, if they changed since the last call
+        """
+        settings = self._pending_settings
+        self._pending_settings = None
+        return settings
+
+    def get_settings(self) -> SimulationSettings:
+        return SimulationSettings(self.food_interval.value, self.max_food.value, self.gravity_range.value)
+
+    def _lower(self):
+        render_knobs = [self.render_detail]
+        simulation_knobs = self.simulation_knobs if self.adjust_simulation else []
+        if self.render_ms > self.simulation_ms:
+            knobs = render_knobs + simulation_knobs
+        else:
+            knobs = simulation_knobs + render_knobs
+
+        for knob in knobs:
+            if knob.index < len(knob.steps) - 1:
+                self._lowered.append(knob)
+                self._set(knob, knob.index + 1, "over budget")
+                return
+
+    def _set(self, knob: Knob, index: int, reason: str):
+        old_value = knob.value
+        knob.index = index
+        if knob is self.render_detail:
+            self.level_of_detail.set_index(index)
+        else:
+            self._pending_settings = self.get_settings()
+        self._frames_since_change = 0
+
+        reason = (f"{reason}: {self.frame_ms:.1f} ms per frame of {self.budget_ms:.1f} ms, "
+                  f"simulation {self.simulation_ms:.1f} ms, drawing {self.render_ms:.1f} ms")
+        adjustment = Adjustment(self.frame_count, knob.name, old_value, knob.value, reason)
+        self.adjustments.append(adjustment)
+        print(f"Frame governor: {adjustment.describe()}")
+
+
+def _format(value):
+    return f"{value:g}" if isinstance(value, float) else str(value)
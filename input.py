@@ -1,4 +1,6 @@
 import pygame
+from dataclasses import dataclass
+from typing import Optional
 
 
 class Axis:
@@ -30,6 +32,69 @@ RIGHT_TRIGGER = 8
 LEFT_TRIGGER = 9
 
 
+@dataclass
+class InputState:
+    """
+    The state of all axes of one controller, sampled once per tick.
+    """
+    move_x: float = 0
+    move_y: float = 0
+    aim_x: float = 0
+    aim_y: float = 0
+    right_trigger: float = 0
+    left_trigger: float = 0
+
+    def get_axis(self, axis: int):
+        if axis == Axis.LEFT_STICK_X:
+            return self.move_x
+        elif axis == Axis.LEFT_STICK_Y:
+            return self.move_y
+        elif axis == Axis.RIGHT_STICK_X:
+            return self.aim_x
+        elif axis == Axis.RIGHT_STICK_Y:
+            return self.aim_y
+        elif axis == Axis.RIGHT_TRIGGER:
+            return self.right_trigger
+        elif axis == Axis.LEFT_TRIGGER:
+            return self.left_trigger
+        raise Exception("Unsupported axis:", axis)
+
+
+# Used for players without a controller
+NO_INPUT = InputState()
+
+
+@dataclass
+class SimulationSettings:
+    """
+    The settings of the simulation that the frame governor turns down when the game can't keep up
+    (see governor.FrameGovernor).
+    """
+    # Time between two pieces of food being added
+    food_interval_sec: float
+    # No more food is added while there is this much
+    max_food: int
+    # How far grenades pull objects in
+    gravity_range: float
+
+
+@dataclass
+class TickInput:
+    """
+    Everything from the outside world that influences one simulation tick.
+    Recorded by replays, so it must be complete: state.update() may not read input from anywhere else.
+    """
+    # Mapping from player_id to the input of the player's controller
+    player_inputs: dict[int, InputState]
+    debug_spawn_food: bool = False
+    # Number of network clients that connected since the last tick
+    players_joined: int = 0
+    # New settings from the frame governor, if it changed any
+    settings: Optional[SimulationSettings] = None
+    # Controllers of the network clients that connected, in live matches. Not recorded, replays only need the count.
+    joined_controllers: Optional[list] = None
+
+
 keymap_WASD = {
     MoveDir.UP: pygame.K_w,
     MoveDir.DOWN: pygame.K_s,
@@ -61,37 +126,45 @@ class FakeController:
     def get_name(self):
         return self.name
 
+    def sample(self, pressed) -> InputState:
+        """
+        Read all axes at once from the keyboard state.
+        :param pressed: The result of pygame.key.get_pressed(), fetched once per tick by the caller.
+        """
+        def key_value(key_id):
+            key = self.move_map.get(key_id)
+            return 1 if key is not None and pressed[key] else 0
+
+        return InputState(
+            move_x=key_value(MoveDir.RIGHT) or -key_value(MoveDir.LEFT),
+            move_y=-key_value(MoveDir.UP) or key_value(MoveDir.DOWN),
+            aim_x=key_value(AimDir.RIGHT) or -key_value(AimDir.LEFT),
+            aim_y=-key_value(AimDir.UP) or key_value(AimDir.DOWN),
+            right_trigger=key_value(RIGHT_TRIGGER),
+            left_trigger=key_value(LEFT_TRIGGER),
+        )
+
     def get_axis(self, axis: int):
-        pressed = pygame.key.get_pressed()
-
-        def map_dirs_to_values(dir_1, value_1, dir_2, value_2, default_value):
-            if pressed[self.move_map[dir_1]]:
-                return value_1
-            if pressed[self.move_map[dir_2]]:
-                return value_2
-            return default_value
-
-        try:
-            if axis == Axis.LEFT_STICK_X:
-                return map_dirs_to_values(MoveDir.RIGHT, 1, MoveDir.LEFT, -1, 0)
-            elif axis == Axis.LEFT_STICK_Y:
-                return map_dirs_to_values(MoveDir.UP, -1, MoveDir.DOWN, 1, 0)
-            elif axis == Axis.RIGHT_STICK_X:
-                return map_dirs_to_values(AimDir.RIGHT, 1, AimDir.LEFT, -1, 0)
-            elif axis == Axis.RIGHT_STICK_Y:
-                return map_dirs_to_values(AimDir.UP, -1, AimDir.DOWN, 1, 0)
-            elif axis == Axis.RIGHT_TRIGGER:
-                if pressed[self.move_map[RIGHT_TRIGGER]]:
-                    return 1
-                else:
-                    return 0
-            elif axis == Axis.LEFT_TRIGGER:
-                if pressed[self.move_map[LEFT_TRIGGER]]:
-                    return 1
-                else:
-                    return 0
-            else:
-                raise Exception("Unsupported axis:", axis)
-        except KeyError:
-            # print("Warning: missing entry in move map")
-            return 0
+        # Slow path, prefer sample() when reading more than one axis
+        return self.sample(pygame.key.get_pressed()).get_axis(axis)
+
+
+def sample_controller(controller, pressed) -> InputState:
+    """
+    Sample every axis of a controller once. Works with pygame joysticks as well as our own
+    controller types (FakeController, RemoteController etc.), which implement sample().
+    :param pressed: The result of pygame.key.get_pressed()
+    """
+    sample = getattr(controller, "sample", None)
+    if sample:
+        return sample(pressed)
+
+    get_axis = controller.get_axis
+    return InputState(
+        move_x=get_axis(Axis.LEFT_STICK_X),
+        move_y=get_axis(Axis.LEFT_STICK_Y),
+        aim_x=get_axis(Axis.RIGHT_STICK_X),
+        aim_y=get_axis(Axis.RIGHT_STICK_Y),
+        right_trigger=get_axis(Axis.RIGHT_TRIGGER),
+        left_trigger=get_axis(Axis.LEFT_TRIGGER),
+    )
@@ -0,0 +1,211 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import pygame
+
+import render
+
+
+@dataclass
+class PlayerStats:
+    player_id: int
+    name: str
+    # Area gained by eating food and other amoebae
+    mass_eaten: float = 0
+    kills: int = 0
+    deaths: int = 0
+    grenades_fired: int = 0
+    # Game time the current life started, None while waiting for respawn
+    spawn_time: Optional[float] = None
+    # Time alive in all earlier lives
+    past_time_alive: float = 0
+
+    def get_time_alive(self, game_time: float) -> float:
+        if self.spawn_time is None:
+            return self.past_time_alive
+        return self.past_time_alive + game_time - self.spawn_time
+
+
+class Leaderboard:
+    """
+    The living players ranked by mass (area), and stats for every player.
+    The ranking is never sorted as a whole. When the area of a player amoeba changes (see PlayerAmoeba.set_area()),
+    it moves up or down past its neighbours until it's in place again. Areas change a little at a time, so that's
+    usually no move at all, or a single step. Deaths, respawns and shots are reported by state.py.
+    Stats are not part of snapshots, a restored match starts counting from zero again.
+    """
+    # Number of places shown in the overlay, changes further down don't count as changes (see version)
+    TOP_COUNT = 5
+
+    def __init__(self):
+        # Player id -> stats, also for players waiting for respawn
+        self.stats: dict[int, PlayerStats] = {}
+        # Biggest first, amoebae with the same area in the order of their player ids
+        self.ranking: list = []
+        self._ranks: dict = {}
+        # Counts up whenever the top places or what's shown about them changes,
+        # so they only need to be rendered again then
+        self.version = 0
+
+    def get_top(self) -> list[tuple[object, PlayerStats]]:
+        """
+        :return: The player amoebae in the top places with their stats, biggest first
+        """
+        return [(amoeba, self.stats[amoeba.player_id]) for amoeba in self.ranking[:self.TOP_COUNT]]
+
+    def get_rank(self, amoeba) -> Optional[int]:
+        """
+        :return: 1 for the biggest amoeba, None if the amoeba is not in the ranking (dead)
+        """
+        rank = self._ranks.get(amoeba)
+        return None if rank is None else rank + 1
+
+    def on_spawn(self, amoeba, game_time: float, name: str = None):
+        """
+        :param name: Shown in the leaderboard, defaults to "Player <id>"
+        """
+        stats = self.stats.get(amoeba.player_id)
+        if stats is None:
+            stats = PlayerStats(amoeba.player_id, name or f"Player {amoeba.player_id}")
+            self.stats[amoeba.player_id] = stats
+        stats.spawn_time = game_time
+
+        rank = len(self.ranking)
+        self.ranking.append(amoeba)
+        self._ranks[amoeba] = rank
+        self._changed(rank)
+        self.on_area_changed(amoeba)
+
+    def on_death(self, amoeba, game_time: float, killer=None):
+        """
+        :param killer: The player amoeba that ate or shot it
+        """
+        rank = self._ranks.pop(amoeba, None)
+        if rank is None:
+            return
+        ranking = self.ranking
+        del ranking[rank]
+        for i in range(rank, len(ranking)):
+            self._ranks[ranking[i]] = i
+        self._changed(rank)
+
+        stats = self.stats[amoeba.player_id]
+        stats.deaths += 1
+        stats.past_time_alive = stats.get_time_alive(game_time)
+        stats.spawn_time = None
+
+        if killer is not None and killer is not amoeba:
+            self.stats[killer.player_id].kills += 1
+            killer_rank = self._ranks.get(killer)
+            if killer_rank is not None:
+                self._changed(killer_rank)
+
+    def on_area_changed(self, amoeba):
+        rank = self._ranks.get(amoeba)
+        if rank is None:
+            # Not spawned yet, or dead
+            return
+        ranking = self.ranking
+        ranks = self._ranks
+        area = amoeba.area
+        player_id = amoeba.player_id
+
+        # Insertion sort for a single element: shift the neighbours it overtakes by one place
+        new_rank = rank
+        while new_rank > 0:
+            other = ranking[new_rank - 1]
+            if other.area > area or (other.area == area and other.player_id < player_id):
+                break
+            ranking[new_rank] = other
+            ranks[other] = new_rank
+            new_rank -= 1
+        if new_rank == rank:
+            last_rank = len(ranking) - 1
+            while new_rank < last_rank:
+                other = ranking[new_rank + 1]
+                if other.area < area or (other.area == area and other.player_id > player_id):
+                    break
+                ranking[new_rank] = other
+                ranks[other] = new_rank
+                new_rank += 1
+
+        if new_rank != rank:
+            ranking[new_rank] = amoeba
+            ranks[amoeba] = new_rank
+            self._changed(min(rank, new_rank))
+
+    def on_eat(self, amoeba, area: float):
+        self.stats[amoeba.player_id].mass_eaten += area
+
+    def on_grenade_fired(self, amoeba):
+        self.stats[amoeba.player_id].grenades_fired += 1
+
+    def format_stats(self, game_time: float) -> str:
+        """
+        :return: A table of the stats of all players, in the order of the ranking, dead players last
+        """
+        ranked_ids = [amoeba.player_id for amoeba in self.ranking]
+        dead_ids = sorted(self.stats.keys() - set(ranked_ids))
+        lines = [f"{'Rank':>4}  {'Player':<12}{'Mass eaten':>12}{'Kills':>7}{'Deaths':>8}{'Grenades':>10}"
+                 f"{'Time alive':>12}"]
+        for rank, player_id in enumerate(ranked_ids + dead_ids, 1):
+            stats = self.stats[player_id]
+            rank_text = str(rank) if rank <= len(ranked_ids) else "-"
+            lines.append(f"{rank_text:>4}  {stats.name:<12}{round(stats.mass_eaten):>12}{stats.kills:>7}"
+                         f"{stats.deaths:>8}{stats.grenades_fired:>10}{stats.get_time_alive(game_time):>11.1f}s")
+        return "\n".join(lines)
+
+    def _changed(self, rank: int):
+        if rank < self.TOP_COUNT:
+            self.version += 1
+
+
+class LeaderboardOverlay:
+    """
+    Shows the top places of the leaderboard. Rendering text is slow, so it's rendered into a surface only when
+    the leaderboard changed (see Leaderboard.version). Every other frame, the same surface is drawn again.
+    """
+    LINE_SPACING = 4
+    PADDING = 8
+
+    def __init__(self, font: pygame.font.Font):
+        """
+        :param font: Only for the overlay. It's rendered with on the main thread, while the render thread might
+                     use other fonts (see render.RenderPipeline).
+        """
+        self.font = font
+        self._leaderboard: Leaderboard = None
+        self._version = None
+        self._surface: pygame.Surface = None
+        # Number of times the surface was rendered, for tests
+        self.render_count = 0
+
+    def add_draw_commands(self, commands: list[tuple], leaderboard: Leaderboard, right: float, top: float):
+        if leaderboard is not self._leaderboard or leaderboard.version != self._version:
+            self._leaderboard = leaderboard
+            self._version = leaderboard.version
+            self._surface = self._render(leaderboard.get_top())
+        if self._surface:
+            commands.append((render.BLIT, self._surface, (right - self._surface.get_width(), top)))
+
+    def _render(self, top: list[tuple[object, PlayerStats]]) -> Optional[pygame.Surface]:
+        if not top:
+            return None
+        self.render_count += 1
+        text_surfaces = [self.font.render(f"{rank}. {stats.name}  {stats.kills} kills", True, (0, 0, 0))
+                         for rank, (amoeba, stats) in enumerate(top, 1)]
+        line_height = max(surface.get_height() for surface in text_surfaces)
+        # A dot in the color of the player in front of each line
+        dot_radius = line_height // 4
+        text_left = self.PADDING + dot_radius * 2 + self.PADDING
+        width = text_left + max(surface.get_width() for surface in text_surfaces) + self.PADDING
+        height = self.PADDING * 2 + len(text_surfaces) * line_height + (len(text_surfaces) - 1) * self.LINE_SPACING
+
+        # Never changed after it's handed to the renderer, a new one is rendered instead
+        surface = pygame.Surface((width, height), pygame.SRCALPHA)
+        surface.fill((255, 255, 255, 180))
+        for i, ((amoeba, stats), text_surface) in enumerate(zip(top, text_surfaces)):
+            y = self.PADDING + i * (line_height + self.LINE_SPACING)
+            pygame.draw.circle(surface, amoeba.color, (self.PADDING + dot_radius, y + line_height // 2), dot_radius)
+            surface.blit(text_surface, (text_left, y))
+        return surface
@@ -1,17 +1,150 @@
 from time import perf_counter
 start = perf_counter()
 
+import argparse
+import gc
+import random
+
 import pygame
 
 import state
+import governor
+import render
+import replay
+import snapshot
+import utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Amoeba Game")
+    parser.add_argument("--listen", type=int, metavar="PORT",
+                        help="Accept network players sending input packets to this UDP port")
+    parser.add_argument("--listen-host", default="127.0.0.1", metavar="HOST",
+                        help="Address to listen on for network players, 0.0.0.0 to accept them from other machines "
+                             "(default: only this machine)")
+    parser.add_argument("--seed", type=int, help="Seed for the random number generator")
+    parser.add_argument("--record", metavar="FILE", help="Record the match to a replay file")
+    parser.add_argument("--replay", metavar="FILE", help="Play back a recorded match")
+    parser.add_argument("--skip-to", type=float, default=0, metavar="SECONDS",
+                        help="When playing back, simulate this much of the match without drawing first")
+    parser.add_argument("--headless", action="store_true",
+                        help="Don't open a window. When playing back without --capture, only re-simulate the match "
+                             "as fast as possible")
+    parser.add_argument("--restore", metavar="FILE", help="Continue a match from a snapshot file")
+    parser.add_argument("--checkpoint", metavar="FILE", help="Periodically save the match to a snapshot file")
+    parser.add_argument("--checkpoint-interval", type=float, default=60, metavar="SECONDS",
+                        help="Time between checkpoints")
+    parser.add_argument("--bots", type=int, default=0, help="Number of AI controlled players to add")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Draw each frame on a worker thread while the next one is simulated")
+    parser.add_argument("--frames", type=int, metavar="COUNT",
+                        help="Quit after this many frames, e.g. to measure the startup time")
+    parser.add_argument("--metrics", type=int, metavar="PORT",
+                        help="Serve metrics for Prometheus at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--no-governor", action="store_true",
+                        help="Always simulate and draw with full detail, even if the frame rate drops")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="Save the drawn frames as PNG images in this directory, or as a video if it ends "
+                             "with .mp4, .mkv, .webm, .avi or .mov (needs ffmpeg)")
+    args = parser.parse_args()
+    if args.restore and args.record:
+        # A replay only has the seed and the inputs, playing it back would start from a new board
+        parser.error("--record can't be combined with --restore")
+    return args
+
+
+def start_governor(args, adjust_simulation: bool = True):
+    if not args.no_governor:
+        state.frame_governor = governor.FrameGovernor(state.TARGET_FRAMERATE, state.get_default_settings(),
+                                                      state.level_of_detail, adjust_simulation)
+
+
+def start_capture(args):
+    if not args.capture:
+        return None
+    # Imported only when needed, like the input and metrics servers
+    import capture
+    return capture.open_capture(args.capture, state.window.get_size(), state.TARGET_FRAMERATE)
+
+
+def stop_capture(frame_capture):
+    if frame_capture:
+        frame_capture.close()
+        print(f"Captured {frame_capture.captured} frames, dropped {frame_capture.dropped} "
+              f"because writing them fell behind")
+
+
+def play_replay(args):
+    if args.headless and not args.capture:
+        game_time, elapsed = replay.play_headless(args.replay)
+        print(f"Simulated {round(game_time, 1)} s of gameplay in {round(elapsed, 2)} s")
+        return
+
+    recorded_match = replay.Replay(args.replay)
+    replay.start_match(recorded_match, headless=args.headless)
+    # The simulation settings are in the recorded input, only the render detail can change
+    start_governor(args, adjust_simulation=False)
+    frame_capture = start_capture(args)
+
+    try:
+        for dt, tick_input in recorded_match.ticks():
+            fast_forward = utils.get_time() < args.skip_to
+            if not fast_forward:
+                state.clock.tick(state.TARGET_FRAMERATE)
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYUP and event.key == pygame.K_ESCAPE):
+                    return
+
+            update_start = perf_counter()
+            state.update(dt, tick_input)
+            if not fast_forward:
+                render_start = perf_counter()
+                state.draw(state.clock.get_rawtime())
+                pygame.display.flip()
+                if frame_capture:
+                    frame_capture.capture(state.window)
+                if state.frame_governor:
+                    state.frame_governor.update(state.clock.get_rawtime(), (render_start - update_start) * 1000,
+                                                (perf_counter() - render_start) * 1000)
+    finally:
+        stop_capture(frame_capture)
 
 
 def main():
-    state.init_system()
+    args = parse_args()
+
+    if args.replay:
+        play_replay(args)
+        pygame.quit()
+        return
+
+    seed = args.seed if args.seed is not None else random.randrange(2**63)
+    state.init_system(seed=seed, headless=args.headless)
     state.init_board_and_players()
-    print(f"Startup time {round(perf_counter() - start, 2)} s")
+    state.add_bots(args.bots)
+    if args.restore:
+        snapshot.load(args.restore)
+    if args.checkpoint:
+        state.checkpointer = snapshot.Checkpointer(args.checkpoint, args.checkpoint_interval)
+    if args.record:
+        state.recorder = replay.ReplayRecorder(args.record, seed, state.window.get_size(),
+                                               len(state.world.entities.player_amoebae) - args.bots, args.bots)
+    if args.listen is not None:
+        state.start_input_server(args.listen, args.listen_host)
+    if args.metrics is not None:
+        state.start_metrics_server(args.metrics)
+    pipeline = render.RenderPipeline(state.window) if args.pipelined else None
+    start_governor(args)
+    frame_capture = start_capture(args)
+    # Most of what was created so far (modules, fonts, the board) stays around for a long time. Move it out of
+    # the way of the garbage collector, so collections during the game only look at new objects, which are
+    # few, as food and grenades are recycled (see ObjectPool).
+    gc.collect()
+    gc.freeze()
 
     done = False
+    frame_count = 0
 
     while not done:
         # Delta time (time it took to update and draw the last frame, plus time waiting for vsync)
@@ -28,10 +161,42 @@ def main():
                 elif event.key == pygame.K_DELETE:
                     state.draw_debug = not state.draw_debug
 
+        update_start = perf_counter()
         state.update(dt)
-        state.draw(dt_used_ms)
-        pygame.display.flip()
+        render_start = perf_counter()
+        if pipeline:
+            # Show the previous frame, which was drawn while this one was simulated
+            pipeline.present()
+            if frame_capture:
+                frame_capture.capture(state.window)
+            pipeline.submit(state.build_frame(dt_used_ms))
+        else:
+            state.draw(dt_used_ms)
+            pygame.display.flip()
+            if frame_capture:
+                frame_capture.capture(state.window)
+        if state.frame_governor:
+            state.frame_governor.update(dt_used_ms, (render_start - update_start) * 1000,
+                                        (perf_counter() - render_start) * 1000)
+
+        frame_count += 1
+        if frame_count == 1:
+            print(f"Startup time {round(perf_counter() - start, 3)} s (until the first frame was drawn)")
+        if frame_count == args.frames:
+            done = True
 
+    if pipeline:
+        pipeline.close()
+    stop_capture(frame_capture)
+    if state.recorder:
+        state.recorder.close()
+    if state.checkpointer:
+        state.checkpointer.wait()
+    if state.input_server:
+        state.input_server.stop()
+    if state.metrics:
+        state.metrics.close()
+    print(state.world.leaderboard.format_stats(utils.get_time()))
     pygame.quit()
 
 
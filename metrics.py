@@ -0,0 +1,220 @@
+import bisect
+import gc
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# Upper bounds of the histogram buckets, in seconds
+FRAME_BUCKETS = (0.005, 0.010, 0.0167, 0.025, 0.033, 0.050, 0.100, 0.250)
+GC_PAUSE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.010, 0.050, 0.100)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def render(self, lines: list[str]):
+        lines.append(f"# TYPE {self.name} counter")
+        lines.append(f"{self.name} {self.value}")
+
+
+class Gauge:
+    """
+    A value that is only read when the metrics are published, so keeping it up to date costs nothing per frame.
+    """
+    def __init__(self, name: str, help_text: str, read, label: str = None):
+        """
+        :param read: Function returning the value, or with a label, a dict from label values to values
+        :param label: Name of the label, if the gauge has one value per label value
+        """
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.label = label
+
+    def render(self, lines: list[str]):
+        lines.append(f"# TYPE {self.name} gauge")
+        if self.label:
+            for label_value, value in self.read().items():
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        else:
+            lines.append(f"{self.name} {self.read()}")
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Per bucket, not cumulative, the last one is for values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, lines: list[str]):
+        lines.append(f"# TYPE {self.name} histogram")
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # The text served to scrapers, see publish()
+        self.published = ""
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        :return: All metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            metric.render(lines)
+        return "\n".join(lines) + "\n"
+
+    def publish(self):
+        """
+        Render the metrics for the scrapers. Must be called on the thread that changes the metrics and the game
+        state, as that's what the gauges read. Scrapers only get the rendered text, which is never changed.
+        """
+        self.published = self.render()
+
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry at /metrics, for Prometheus or any other scraper.
+    Runs on its own thread, so it must not read the metrics or the game state: the game thread changes them
+    at the same time (e.g. the cells of the accelerator come and go). It only serves the text that the game
+    thread published last (see Registry.publish()).
+    """
+    def __init__(self, registry: Registry, host: str, port: int):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.published.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't print every scrape
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        # The actual port, if port 0 was passed to pick a free one
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="Metrics", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class GameMetrics:
+    """
+    Operational metrics of a running match. state.update() and state.draw() report timings and events,
+    everything else is read from the game state when the metrics are published, at most every PUBLISH_INTERVAL.
+    Rates, like eaten objects per second, are left to the scraper (e.g. rate() in Prometheus).
+    """
+    # Seconds between publishing the metrics. Scrapers usually come every 15 s or more.
+    PUBLISH_INTERVAL = 1
+
+    def __init__(self):
+        import state
+        registry = self.registry = Registry()
+        self.frame_seconds = registry.add(Histogram(
+            "amoeba_frame_seconds", "Time between two ticks", FRAME_BUCKETS))
+        self.update_seconds = registry.add(Histogram(
+            "amoeba_update_seconds", "Time it took to simulate a tick", FRAME_BUCKETS))
+        self.draw_seconds = registry.add(Histogram(
+            "amoeba_draw_seconds", "Time it took to draw a frame, not measured with pipelined rendering",
+            FRAME_BUCKETS))
+        self.gc_pause_seconds = registry.add(Histogram(
+            "amoeba_gc_pause_seconds", "Pauses for garbage collection", GC_PAUSE_BUCKETS))
+        self.ticks = registry.add(Counter("amoeba_ticks_total", "Simulated ticks"))
+        self.eaten = registry.add(Counter("amoeba_eaten_total", "Objects eaten by amoebae"))
+
+        registry.add(Gauge("amoeba_entities", "Objects in the world", lambda: {
+            "food": state.world.entities.get_food_count(),
+            "amoeba": len(state.world.entities.amoebae) - len(state.world.entities.player_amoebae),
+            "player_amoeba": len(state.world.entities.player_amoebae),
+            "grenade": len(state.world.entities.gravity_grenades),
+        }, label="kind"))
+        registry.add(Gauge("amoeba_active_grenades", "Armed grenades that pull objects in",
+                           lambda: len(state.world.entities.active_grenades)))
+        registry.add(Gauge("amoeba_respawn_queue_length", "Dead players waiting for respawn",
+                           lambda: len(state.world.respawn_queue)))
+        registry.add(Gauge("amoeba_grid", "Occupancy of the accelerator's cells",
+                           lambda: self._get_grid_stats(state.world.entities.accelerator), label="stat"))
+
+        self._gc_start = 0
+        # Garbage collection can happen on any thread, the pauses are added to the histogram on the game thread
+        self._gc_pauses = deque()
+        gc.callbacks.append(self._on_gc)
+        self._last_publish = perf_counter()
+        self.server: MetricsServer = None
+
+    def start_server(self, host: str, port: int):
+        self.publish()
+        self.server = MetricsServer(self.registry, host, port)
+
+    def publish(self):
+        self._observe_gc_pauses()
+        self.registry.publish()
+        self._last_publish = perf_counter()
+
+    def close(self):
+        gc.callbacks.remove(self._on_gc)
+        if self.server:
+            self.server.close()
+
+    def on_update(self, dt: float, update_seconds: float, eaten_count: int):
+        self.frame_seconds.observe(dt)
+        self.update_seconds.observe(update_seconds)
+        self.ticks.inc()
+        self.eaten.inc(eaten_count)
+        if self._gc_pauses:
+            self._observe_gc_pauses()
+        if self.server and perf_counter() - self._last_publish >= self.PUBLISH_INTERVAL:
+            self.publish()
+
+    def _observe_gc_pauses(self):
+        gc_pauses = self._gc_pauses
+        while gc_pauses:
+            self.gc_pause_seconds.observe(gc_pauses.popleft())
+
+    def _on_gc(self, phase: str, info: dict):
+        if phase == "start":
+            self._gc_start = perf_counter()
+        else:
+            self._gc_pauses.append(perf_counter() - self._gc_start)
+
+    @staticmethod
+    def _get_grid_stats(accelerator):
+        stats = accelerator.get_stats(check_entries=False)
+        return {name: stats[name] for name in ("objects", "cell_entries", "occupied_cells", "max_cell_entries")}
@@ -0,0 +1,191 @@
+import asyncio
+import struct
+import threading
+from typing import Optional
+
+from input import InputState
+
+# Input packet sent by network clients, once per client tick:
+# client id, sequence number, move x/y, aim x/y (-127..127), right/left trigger (0..255)
+PACKET_FORMAT = struct.Struct("!HIbbbbBB")
+# Every client that sends input gets a player, up to this many
+MAX_REMOTE_PLAYERS = 16
+
+
+def encode_packet(client_id: int, sequence: int, input_state: InputState) -> bytes:
+    def stick(value):
+        return round(max(-1, min(1, value)) * 127)
+
+    def trigger(value):
+        return round(max(0, min(1, value)) * 255)
+
+    return PACKET_FORMAT.pack(client_id, sequence,
+                              stick(input_state.move_x), stick(input_state.move_y),
+                              stick(input_state.aim_x), stick(input_state.aim_y),
+                              trigger(input_state.right_trigger), trigger(input_state.left_trigger))
+
+
+def decode_packet(data: bytes) -> tuple[int, int, InputState]:
+    client_id, sequence, move_x, move_y, aim_x, aim_y, right_trigger, left_trigger = PACKET_FORMAT.unpack(data)
+    input_state = InputState(move_x / 127, move_y / 127, aim_x / 127, aim_y / 127,
+                             right_trigger / 255, left_trigger / 255)
+    return client_id, sequence, input_state
+
+
+class RemoteController:
+    """
+    A controller whose input arrives over the network.
+    Packets are collected in a jitter buffer and consumed at a steady rate of one per tick, so that
+    uneven network delivery doesn't translate into uneven movement.
+    A client that sends faster than the game ticks would fall further and further behind. Once more than
+    max_buffer_size packets are waiting, the oldest are dropped, back down to jitter_buffer_size.
+    """
+    def __init__(self, client_id: int, jitter_buffer_size: int = 3, max_buffer_size: int = 8):
+        self.client_id = client_id
+        self.name = f"Remote client {client_id}"
+        # How many packets we collect before we start playing back
+        self.jitter_buffer_size = jitter_buffer_size
+        self.max_buffer_size = max_buffer_size
+        self._buffer: dict[int, InputState] = {}
+        self._next_sequence = None
+        self._last_state = InputState()
+        self._lock = threading.Lock()
+        self.packets_received = 0
+        self.packets_dropped = 0
+
+    def get_name(self):
+        return self.name
+
+    def receive(self, sequence: int, input_state: InputState):
+        """
+        Called from the network thread for every packet of this client.
+        """
+        with self._lock:
+            self.packets_received += 1
+            if self._next_sequence is not None and sequence < self._next_sequence:
+                # Arrived too late, we already played back past this point
+                self.packets_dropped += 1
+                return
+            self._buffer[sequence] = input_state
+            if len(self._buffer) > self.max_buffer_size * 2:
+                # Nothing is played back (yet), don't let the buffer grow without bounds
+                del self._buffer[min(self._buffer)]
+                self.packets_dropped += 1
+
+    def sample(self, pressed=None) -> InputState:
+        with self._lock:
+            if self._next_sequence is None:
+                if len(self._buffer) < self.jitter_buffer_size:
+                    # Still filling the buffer
+                    return self._last_state
+                self._next_sequence = min(self._buffer)
+            if len(self._buffer) > self.max_buffer_size:
+                # Catch up, by skipping to the newest packets
+                sequences = sorted(self._buffer)
+                skipped = sequences[:-self.jitter_buffer_size]
+                for sequence in skipped:
+                    del self._buffer[sequence]
+                self.packets_dropped += len(skipped)
+                self._next_sequence = sequences[-self.jitter_buffer_size]
+
+            input_state = self._buffer.pop(self._next_sequence, None)
+            if input_state is not None:
+                self._last_state = input_state
+                self._next_sequence += 1
+            elif self._buffer:
+                # A packet was lost, skip ahead to the next one we have instead of stalling
+                self._next_sequence = min(self._buffer)
+                self._last_state = self._buffer.pop(self._next_sequence)
+                self._next_sequence += 1
+            # If the buffer ran dry, repeat the last known input
+            return self._last_state
+
+    def get_axis(self, axis: int):
+        return self._last_state.get_axis(axis)
+
+
+class _InputProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        if len(data) != PACKET_FORMAT.size:
+            return
+        client_id, sequence, input_state = decode_packet(data)
+        controller = self.server.get_controller(client_id)
+        if controller:
+            controller.receive(sequence, input_state)
+
+
+class InputServer:
+    """
+    Receives input packets from network clients over UDP.
+    The asyncio event loop runs in a background thread, the game loop only ever touches
+    the RemoteControllers it creates.
+    There is no authentication, every client id that sends a packet gets a player. So by default, only clients
+    on this machine are accepted, and once max_clients have joined, packets from other client ids are ignored.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, max_clients: int = MAX_REMOTE_PLAYERS):
+        """
+        :param host: The address to listen on, "0.0.0.0" for clients from anywhere
+        """
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        # Packets from clients that weren't accepted
+        self.packets_rejected = 0
+        self.controllers: dict[int, RemoteController] = {}
+        self._new_controllers: list[RemoteController] = []
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop = None
+        self._transport = None
+        self._thread: threading.Thread = None
+
+    def get_controller(self, client_id: int) -> Optional[RemoteController]:
+        """
+        :return: The controller of the client, a new one if it's the first packet of the client,
+                 or None if there are no more players allowed
+        """
+        with self._lock:
+            controller = self.controllers.get(client_id)
+            if controller is None:
+                if len(self.controllers) >= self.max_clients:
+                    self.packets_rejected += 1
+                    return None
+                controller = RemoteController(client_id)
+                self.controllers[client_id] = controller
+                self._new_controllers.append(controller)
+            return controller
+
+    def pop_new_controllers(self) -> list[RemoteController]:
+        """
+        Returns the controllers of all clients that connected since the last call.
+        """
+        with self._lock:
+            new_controllers = self._new_controllers
+            self._new_controllers = []
+            return new_controllers
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._transport, _ = self._loop.run_until_complete(
+                self._loop.create_datagram_endpoint(lambda: _InputProtocol(self), local_addr=(self.host, self.port)))
+            # Port 0 means the OS picked a free port for us
+            self.port = self._transport.get_extra_info("sockname")[1]
+            started.set()
+            self._loop.run_forever()
+            self._transport.close()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="InputServer", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
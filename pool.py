@@ -0,0 +1,39 @@
+class ObjectPool:
+    """
+    Keeps removed objects to reuse them for new ones, instead of allocating a new object every time
+    (and leaving the old one to the garbage collector). Meant for objects that are created and destroyed
+    all the time, like food.
+    Objects are reinitialized by calling __init__() again, so their classes have to set all of their state there.
+    Only release objects that are not referenced anywhere anymore.
+    """
+    def __init__(self, cls, max_size: int = 10000):
+        self.cls = cls
+        self.max_size = max_size
+        self._free = []
+        # Statistics
+        self.created = 0
+        self.reused = 0
+        self.released = 0
+
+    def acquire(self, *args):
+        if self._free:
+            obj = self._free.pop()
+            obj.__init__(*args)
+            self.reused += 1
+        else:
+            obj = self.cls(*args)
+            self.created += 1
+        return obj
+
+    def release(self, obj):
+        if len(self._free) < self.max_size:
+            self._free.append(obj)
+            self.released += 1
+
+    def get_stats(self):
+        return {
+            "created": self.created,
+            "reused": self.reused,
+            "released": self.released,
+            "free": len(self._free),
+        }
@@ -1,13 +1,29 @@
 
+from math import cos, sin, pi
+
 import pygame
 
 from entities import MovingObject
+import render
 
 # TODO maybe weapons could work like this:
 #  They are powerups in the world
 #  You can collect them, and they are queued up inside the cell in a FIFO queue
 #  Only one weapon is active, and can only be fired once (or a number of times)
 
+# These two numbers control how "fat" your star is
+_STAR_INNER_R = 5
+_STAR_OUTER_R = 15
+_STAR_R_SEQ = [_STAR_INNER_R, _STAR_OUTER_R] * 5  # for convenience
+
+# Make the coordinate for a star centered at 0,0 with points outer_r away
+# from the center and inner v things inner_r away from the center
+STAR_BASE_POLY = tuple(
+    (r * cos(2 * pi * index / 10 - pi / 2), r * sin(2 * pi * index / 10 - pi / 2))
+    for r, index in zip(_STAR_R_SEQ, range(10))
+)
+
+
 class PowerupType:
     GRAVITY_GRENADE_LAUNCHER = 1
     LASER = 2
@@ -28,50 +44,49 @@ class Powerup(MovingObject):
         self.powerup_type: PowerupType = powerup_type
         self.color: pygame.Color = self.POWERUP_COLORS[self.powerup_type]
 
-    def draw(self):
-        # Draw a star
-        from math import cos, sin, pi
-        from pygame.math import Vector2
-        # These two numbers control how "fat" your star is
-        inner_r = 5
-        outer_r = 15
-        r_seq = [inner_r, outer_r] * 5  # for convenience
-
-        # Make the coordinate for a star centered at 0,0 with points outer_r away
-        # from the center and inner v things inner_r away from the center
-        STAR_BASE_POLY = tuple(
-            Vector2(r * cos(2 * pi * index / 10 - pi / 2), r * sin(2 * pi * index / 10 - pi / 2))
-            for r, index in zip(r_seq, range(10))
-        )
-
-        # Now (or whenever you need to draw a star), translate the constant come up
-        # a version of the polygon centered wherever you need it
-        center_coords = Vector2(self.pos_x, self.pos_y)  # or wherever the star needs to be
-        star_at_center_coords = [vertex + center_coords for vertex in STAR_BASE_POLY]
-
-        from state import window
-        pygame.draw.polygon(window, self.color, star_at_center_coords)
-
-
-# @dataclass
-# class Laser:
-#     length: float
-#     creation_time: float
-#     start_pos_x: float = 0
-#     start_pos_y: float = 0
-#     dir_x: float = 0
-#     dir_y: float = 0
-#     turn_speed: float = math.radians(1)  # degrees per second
-#
-#     def draw(self):
-#         from state import window
-#         game_time = utils.get_time()
-#         color = (0, 1, 0)
-#         start_pos = (self.start_pos_x, self.start_pos_y)
-#         end_pos = (self.start_pos_x + self.dir_x * self.length,
-#                    self.start_pos_y + self.dir_y * self.length)
-#         width = 10
-#         pygame.draw.line(window, color, start_pos, end_pos, width)
-#
-#     def update(self, dt: float):
-#         ...
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        self.add_draw_commands_at(commands, self.pos_x, self.pos_y)
+
+    def add_draw_commands_at(self, commands: list[tuple], x: float, y: float):
+        """
+        Draw at another position, for powerups whose position is relative to the amoeba that carries them.
+        """
+        # Draw a star, by translating the constant polygon to where the star needs to be
+        star_at_center_coords = [(vertex_x + x, vertex_y + y) for vertex_x, vertex_y in STAR_BASE_POLY]
+        commands.append((render.POLYGON, self.color, star_at_center_coords))
+
+
+class Laser:
+    """
+    A beam that starts at the edge of its owner and points where the owner aims, so it sweeps across
+    the board while the owner turns. It cuts through everything in its way: food is destroyed,
+    amoebae shrink (see state.apply_laser()).
+    """
+    LENGTH = 600
+    DURATION = 3
+    # Area per second that an amoeba in the beam loses
+    DAMAGE_PER_SEC = 3000
+    # Only for drawing, hits are tested against the center line
+    WIDTH = 6
+
+    def __init__(self, owner, creation_time: float):
+        self.owner = owner
+        self.creation_time = creation_time
+
+    def get_segment(self):
+        """
+        :return: Start and end of the beam as (x0, y0, x1, y1)
+        """
+        owner = self.owner
+        dir_x = cos(owner.aim_angle)
+        dir_y = sin(owner.aim_angle)
+        x0 = owner.pos_x + dir_x * owner.radius
+        y0 = owner.pos_y + dir_y * owner.radius
+        return x0, y0, x0 + dir_x * self.LENGTH, y0 + dir_y * self.LENGTH
+
+    def should_be_removed(self, game_time: float):
+        return game_time - self.creation_time > self.DURATION
+
+    def add_draw_commands(self, commands: list[tuple], game_time: float):
+        x0, y0, x1, y1 = self.get_segment()
+        commands.append((render.LINE, (0, 200, 0), (x0, y0), (x1, y1), self.WIDTH))
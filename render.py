@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+import math
+
+import pygame
+
+import utils
+
+# Draw commands are plain tuples that only contain copies of the data needed to draw (positions, radii,
+# colors, text), never references to game objects. A list of them is an immutable snapshot of one frame,
+# which can be drawn while the simulation already works on the next frame.
+# (CIRCLE, color, (x, y), radius, width)
+CIRCLE = 0
+# (POLYGON, color, points)
+POLYGON = 1
+# (LINE, color, start, end, width)
+LINE = 2
+# (RECT, color, (left, top, width, height), width)
+RECT = 3
+# (TEXT, text, (x, y), font, color, bg_color, centered)
+TEXT = 4
+# (FILL, color)
+FILL = 5
+# (CALL, function), for debug drawing that only depends on data that never changes
+CALL = 6
+# (BLIT, surface, (x, y)), for something rendered before, e.g. text that rarely changes. The surface must not be
+# changed afterwards, render a new one instead.
+BLIT = 8
+# (SPRITES, [(surface, (x, y)), ...]), like a BLIT command for each, but all in one call. For the thousands of
+# pieces of food, as circles from get_circle_sprite(), which is much cheaper than a CIRCLE command for each.
+SPRITES = 9
+
+# Colors of food split off from amoebae are random, so the sprites are thrown away once there are too many
+MAX_CIRCLE_SPRITES = 1000
+# (color, radius) -> filled circle, see get_circle_sprite()
+_circle_sprites: dict[tuple, pygame.Surface] = {}
+
+
+def execute(window: pygame.Surface, commands: list[tuple]):
+    draw_circle = pygame.draw.circle
+    for command in commands:
+        kind = command[0]
+        if kind == CIRCLE:
+            draw_circle(window, command[1], command[2], command[3], command[4])
+        elif kind == POLYGON:
+            pygame.draw.polygon(window, command[1], command[2])
+        elif kind == LINE:
+            pygame.draw.line(window, command[1], command[2], command[3], command[4])
+        elif kind == RECT:
+            pygame.draw.rect(window, command[1], pygame.Rect(*command[2]), width=command[3])
+        elif kind == TEXT:
+            utils.draw_text(window, *command[1:])
+        elif kind == FILL:
+            window.fill(color=command[1])
+        elif kind == CALL:
+            command[1](window)
+        elif kind == BLIT:
+            window.blit(command[1], command[2])
+        elif kind == SPRITES:
+            window.blits(command[1], doreturn=False)
+        else:
+            raise Exception("Unsupported draw command:", kind)
+
+
+def get_circle_sprite(color, radius: int) -> pygame.Surface:
+    """
+    A filled circle on a transparent background, the same as a CIRCLE command draws. Rendered only once for each
+    color and radius. Draw it at (x - radius, y - radius) for a circle around (x, y).
+    A radius of 0 is a single pixel, for objects too small to draw as circles.
+    Must only be called on the main thread.
+    """
+    key = (tuple(color), radius)
+    sprite = _circle_sprites.get(key)
+    if sprite is None:
+        if len(_circle_sprites) >= MAX_CIRCLE_SPRITES:
+            _circle_sprites.clear()
+        if radius == 0:
+            sprite = pygame.Surface((1, 1))
+            sprite.fill(color)
+            _circle_sprites[key] = sprite
+            return sprite
+        sprite = pygame.Surface((radius * 2, radius * 2))
+        # A color key is much faster to blit than an alpha channel. Magenta is transparent, unless it's the color
+        # of the circle.
+        transparent = (0, 0, 0) if [int(channel) for channel in color] == [255, 0, 255] else (255, 0, 255)
+        sprite.fill(transparent)
+        pygame.draw.circle(sprite, color, (radius, radius), radius)
+        sprite.set_colorkey(transparent)
+        _circle_sprites[key] = sprite
+    return sprite
+
+
+@dataclass
+class DetailLevel:
+    """
+    What to leave out when drawing. Sizes are radii in pixels on screen.
+    """
+    # Food smaller than this is drawn as a single pixel
+    pixel_radius: float
+    # Amoebae smaller than this are drawn without outline and nucleus
+    outline_radius: float
+    # Amoebae from this size on show their size as a label
+    label_radius: float
+    # Draw the powerups that players carry around in reserve
+    reserve_powerups: bool
+    # Draw the gravity range around grenades
+    grenade_rings: bool
+
+
+class LevelOfDetail:
+    """
+    The detail level that objects are drawn with (see add_draw_commands()). The frame governor lowers it when
+    frames take too long (see governor.FrameGovernor).
+    """
+    LEVELS = [
+        DetailLevel(pixel_radius=1, outline_radius=0, label_radius=30, reserve_powerups=True, grenade_rings=True),
+        DetailLevel(pixel_radius=3, outline_radius=15, label_radius=50, reserve_powerups=True, grenade_rings=False),
+        DetailLevel(pixel_radius=6, outline_radius=math.inf, label_radius=math.inf, reserve_powerups=False,
+                    grenade_rings=False),
+    ]
+
+    def __init__(self):
+        self.index = 0
+        self.level = self.LEVELS[0]
+
+    def set_index(self, index: int):
+        self.index = index
+        self.level = self.LEVELS[index]
+
+
+class RenderPipeline:
+    """
+    Draws frames on a worker thread, so frame N is rendered while frame N+1 is simulated.
+    Much of pygame's surface work (fills, blits, font rendering) releases the GIL.
+    Flipping the display stays on the main thread, as SDL requires.
+    """
+    def __init__(self, window: pygame.Surface):
+        self.window = window
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Render")
+        self._pending: Future = None
+
+    def submit(self, commands: list[tuple]):
+        """
+        Start drawing a frame. Call present() before submitting the next one.
+        """
+        assert self._pending is None, "The previous frame was not presented yet"
+        self._pending = self._executor.submit(execute, self.window, commands)
+
+    def present(self):
+        """
+        Wait until the submitted frame is drawn, then show it.
+        """
+        if self._pending is None:
+            return
+        # Re-raises any exception from the render thread
+        self._pending.result()
+        self._pending = None
+        pygame.display.flip()
+
+    def close(self):
+        self.present()
+        self._executor.shutdown()
@@ -0,0 +1,124 @@
+import struct
+import zlib
+from time import perf_counter
+
+from input import InputState, TickInput, SimulationSettings
+
+# File layout: header, followed by a zlib stream of ticks.
+# Header: magic, version, seed, window width, window height, initial player count, bot count
+HEADER_FORMAT = struct.Struct("<4sHQHHHH")
+MAGIC = b"AMRP"
+VERSION = 2
+# Tick: dt, flags, players joined, number of player inputs
+TICK_FORMAT = struct.Struct("<dBBH")
+# Follows the tick if FLAG_SETTINGS is set: food interval, max food, gravity range
+SETTINGS_FORMAT = struct.Struct("<dId")
+# Player input: player_id, move x/y, aim x/y, right/left trigger.
+# Stored as doubles, because the simulation has to see exactly the values it saw when recording
+PLAYER_INPUT_FORMAT = struct.Struct("<H6d")
+
+FLAG_DEBUG_SPAWN_FOOD = 1
+FLAG_SETTINGS = 2
+
+
+class ReplayRecorder:
+    """
+    Writes the seed and the input of every tick to a compact binary file.
+    Together with the deterministic simulation, this is enough to re-simulate the whole match.
+    """
+    def __init__(self, path: str, seed: int, window_size: tuple[int, int], player_count: int, bot_count: int = 0):
+        """
+        :param player_count: Number of players passed to state.init_board_and_players()
+        :param bot_count: Number of bots added with state.add_bots() right after that
+        """
+        self.file = open(path, "wb")
+        self.file.write(HEADER_FORMAT.pack(MAGIC, VERSION, seed, window_size[0], window_size[1],
+                                           player_count, bot_count))
+        self._compressor = zlib.compressobj()
+        self.tick_count = 0
+
+    def record_tick(self, dt: float, tick_input: TickInput):
+        flags = FLAG_DEBUG_SPAWN_FOOD if tick_input.debug_spawn_food else 0
+        settings = tick_input.settings
+        if settings:
+            flags |= FLAG_SETTINGS
+        parts = [TICK_FORMAT.pack(dt, flags, tick_input.players_joined, len(tick_input.player_inputs))]
+        if settings:
+            parts.append(SETTINGS_FORMAT.pack(settings.food_interval_sec, settings.max_food, settings.gravity_range))
+        for player_id, i in tick_input.player_inputs.items():
+            parts.append(PLAYER_INPUT_FORMAT.pack(player_id, i.move_x, i.move_y, i.aim_x, i.aim_y,
+                                                  i.right_trigger, i.left_trigger))
+        self.file.write(self._compressor.compress(b"".join(parts)))
+        self.tick_count += 1
+
+    def close(self):
+        self.file.write(self._compressor.flush())
+        self.file.close()
+
+
+class Replay:
+    """
+    A recorded match, loaded from a file written by ReplayRecorder.
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            data = file.read()
+
+        magic, version, self.seed, width, height, self.player_count, self.bot_count = HEADER_FORMAT.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a replay file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported replay version {version}")
+        self.window_size = (width, height)
+        self._tick_data = zlib.decompress(data[HEADER_FORMAT.size:])
+
+    def ticks(self):
+        """
+        Yields (dt, TickInput) for every recorded tick.
+        """
+        data = self._tick_data
+        offset = 0
+        while offset < len(data):
+            dt, flags, players_joined, input_count = TICK_FORMAT.unpack_from(data, offset)
+            offset += TICK_FORMAT.size
+
+            settings = None
+            if flags & FLAG_SETTINGS:
+                settings = SimulationSettings(*SETTINGS_FORMAT.unpack_from(data, offset))
+                offset += SETTINGS_FORMAT.size
+
+            player_inputs = {}
+            for values in PLAYER_INPUT_FORMAT.iter_unpack(data[offset:offset + input_count * PLAYER_INPUT_FORMAT.size]):
+                player_inputs[values[0]] = InputState(*values[1:])
+            offset += input_count * PLAYER_INPUT_FORMAT.size
+
+            yield dt, TickInput(player_inputs, bool(flags & FLAG_DEBUG_SPAWN_FOOD), players_joined, settings)
+
+
+def start_match(replay: Replay, headless=False):
+    """
+    Set up the game state exactly as it was at the start of the recorded match.
+    """
+    import state
+    state.init_system(replay.window_size, headless=headless, seed=replay.seed)
+    state.init_board_and_players(replay.player_count)
+    # The bots' decisions are in the recorded input, so these are just regular players now
+    for i in range(replay.bot_count):
+        state.add_player()
+
+
+def play_headless(path: str):
+    """
+    Re-simulate a whole recorded match as fast as possible, without drawing anything.
+    :return: (simulated game time, real time it took) in seconds
+    """
+    import state
+    import utils
+
+    replay = Replay(path)
+    start_match(replay, headless=True)
+
+    start = perf_counter()
+    for dt, tick_input in replay.ticks():
+        state.update(dt, tick_input)
+    return utils.get_time(), perf_counter() - start
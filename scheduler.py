@@ -0,0 +1,54 @@
+import heapq
+import itertools
+
+
+class Event:
+    """
+    A scheduled call. Cancelling only marks it, it is dropped once it comes up in the heap.
+    """
+    __slots__ = ("time", "callback", "args", "cancelled")
+
+    def __init__(self, time: float, callback, args: tuple):
+        self.time = time
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Calls functions once the game time reaches their deadline. Used for everything that happens after a delay,
+    like respawns, the phases of grenades and spawning food.
+    The deadlines are kept in a heap, so a tick only costs as much as the events that are due, no matter how many
+    are waiting. Events that are due at the same time run in the order they were scheduled, which replays rely on.
+    """
+    def __init__(self):
+        self._heap: list[tuple[float, int, Event]] = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        # Includes cancelled events that weren't dropped yet
+        return len(self._heap)
+
+    def schedule(self, time: float, callback, *args) -> Event:
+        event = Event(time, callback, args)
+        heapq.heappush(self._heap, (time, next(self._sequence), event))
+        return event
+
+    def run_due(self, game_time: float) -> int:
+        """
+        Run all events that are due, in order. Events that are scheduled while running are run too, if they are due.
+        :return: Number of events that were run
+        """
+        heap = self._heap
+        count = 0
+        while heap and heap[0][0] <= game_time:
+            event = heapq.heappop(heap)[2]
+            if event.cancelled:
+                continue
+            event.callback(*event.args)
+            count += 1
+        return count
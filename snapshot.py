@@ -0,0 +1,380 @@
+import gc
+import mmap
+import os
+import struct
+import threading
+from itertools import chain
+
+from entities import Object, Food, Amoeba, PlayerAmoeba, GravityGrenade
+from input import SimulationSettings
+from powerups import Powerup, Laser
+
+# File layout: header, RNG state, one fixed-size record per object, then the spatial index of the objects
+# in state.world.entities. Fixed-size records mean the file can be memory-mapped and read in place, without parsing.
+# Header: magic, version, window width/height, game time, food/powerup spawn timers, next player id,
+#         next object uid, record count, object count, cell count,
+#         simulation settings (food interval, max food, gravity range)
+HEADER_FORMAT = struct.Struct("<4sHHHdddIQIIIdId")
+MAGIC = b"AMSS"
+VERSION = 6
+# State of the Mersenne Twister: version, 625 words, gauss_next (flag + value)
+RNG_FORMAT = struct.Struct("<I625I?d")
+# Record: kind, flags, player_id/powerup_type, uid, parent uid, pos x/y, radius (area for amoebae), speed x/y, color,
+#         and three kind-specific values (see _pack_object)
+RECORD_FORMAT = struct.Struct("<BBHQQ5d3f3d")
+# Spatial index: the cell index range of each object in state.world.entities (see SpatialHash.get_index_ranges()),
+# then a header for each cell (x index, y index, object count), then the positions in state.world.entities.objects
+# of the objects in the cells, one cell after the other
+INDEX_RANGE_SIZE = struct.calcsize("<4i")
+CELL_FORMAT = struct.Struct("<iiI")
+
+KIND_FOOD = 0
+KIND_AMOEBA = 1
+KIND_PLAYER_AMOEBA = 2
+KIND_GRAVITY_GRENADE = 3
+KIND_POWERUP = 4
+# Not an object, only the creation time (extra) and owner (parent uid) are used
+KIND_LASER = 5
+
+# Object is in state.world.entities
+FLAG_IN_WORLD = 1
+# Player amoeba is dead and waits in the respawn queue
+FLAG_RESPAWNING = 2
+# Powerup is carried by the amoeba with the parent uid. Position and speed of reserve powerups are relative
+# to the amoeba (see PlayerAmoeba).
+FLAG_RESERVE_POWERUP = 4
+FLAG_ACTIVE_POWERUP = 8
+
+NO_PARENT = 2**64 - 1
+
+
+def _pack_object(obj: Object, flags: int, parent_uid: int = NO_PARENT, respawn_time: float = 0):
+    color = getattr(obj, "color", (0, 0, 0))
+    extra = (0, 0, 0)
+    small_id = 0
+    if isinstance(obj, Food):
+        kind = KIND_FOOD
+    elif isinstance(obj, PlayerAmoeba):
+        kind = KIND_PLAYER_AMOEBA
+        small_id = obj.player_id
+        extra = (obj.aim_angle, obj.last_grenade_fired, respawn_time)
+    elif isinstance(obj, Amoeba):
+        kind = KIND_AMOEBA
+    elif isinstance(obj, GravityGrenade):
+        kind = KIND_GRAVITY_GRENADE
+        extra = (obj.creation_time, obj.detonation_time, obj.has_exploded)
+        if obj.owner:
+            parent_uid = obj.owner.uid
+    elif isinstance(obj, Powerup):
+        kind = KIND_POWERUP
+        small_id = obj.powerup_type
+    else:
+        raise ValueError(f"Can't snapshot object of type {type(obj).__name__}")
+
+    # The radius of an amoeba is derived from its area, storing the radius would lose precision
+    size = obj.area if isinstance(obj, Amoeba) else obj.radius
+    return RECORD_FORMAT.pack(kind, flags, small_id, obj.uid, parent_uid, obj.pos_x, obj.pos_y, size,
+                              obj.speed_x, obj.speed_y, *color[:3], *extra)
+
+
+def _pack_player_amoeba(player: PlayerAmoeba, flags: int, respawn_time: float = 0):
+    records = [_pack_object(player, flags, respawn_time=respawn_time)]
+    # Carried powerups are not part of state.world.entities, they are stored after their amoeba
+    if player.active_powerup:
+        records.append(_pack_object(player.active_powerup, FLAG_ACTIVE_POWERUP, player.uid))
+    for powerup in player.reserve_powerups:
+        records.append(_pack_object(powerup, FLAG_RESERVE_POWERUP, player.uid))
+    return records
+
+
+def take_snapshot() -> bytes:
+    """
+    Serialize the full simulation state. Must be called between ticks.
+    """
+    import state
+    import utils
+
+    world = state.world
+    records = []
+    for obj in world.entities.objects:
+        if isinstance(obj, PlayerAmoeba):
+            records.extend(_pack_player_amoeba(obj, FLAG_IN_WORLD))
+        else:
+            records.append(_pack_object(obj, FLAG_IN_WORLD))
+
+    for dead_player, time_of_death in world.respawn_queue.items():
+        records.extend(_pack_player_amoeba(dead_player, FLAG_RESPAWNING, time_of_death))
+
+    # After all amoebae, so the owners exist when restoring
+    for laser in world.entities.lasers:
+        records.append(RECORD_FORMAT.pack(KIND_LASER, FLAG_IN_WORLD, 0, 0, laser.owner.uid, 0, 0, 0, 0, 0,
+                                          0, 0, 0, laser.creation_time, 0, 0))
+
+    # Saving the spatial index means it doesn't have to be computed again for every object when restoring
+    objects = world.entities.objects
+    accelerator = world.entities.accelerator
+    index_ranges = accelerator.get_index_ranges(objects)
+    index = [struct.pack(f"<{len(index_ranges) * 4}i", *chain.from_iterable(index_ranges))]
+    positions = dict(zip(objects, range(len(objects))))
+    members = []
+    for (x_index, y_index), cell in accelerator.cells.items():
+        index.append(CELL_FORMAT.pack(x_index, y_index, len(cell)))
+        members.extend(map(positions.__getitem__, cell))
+    index.append(struct.pack(f"<{len(members)}I", *members))
+
+    rng_version, rng_words, gauss_next = world.rng.getstate()
+    settings = world.settings
+    header = HEADER_FORMAT.pack(MAGIC, VERSION, world.width, world.height, utils.get_time(),
+                                world.food_last_added, world.powerup_last_added, world.next_free_player_id,
+                                Object.next_uid, len(records), len(objects), len(accelerator.cells),
+                                settings.food_interval_sec, settings.max_food, settings.gravity_range)
+    rng = RNG_FORMAT.pack(rng_version, *rng_words, gauss_next is not None, gauss_next or 0)
+    return b"".join([header, rng, *records, *index])
+
+
+def _create_object(kind, small_id, x, y, size, color, extra):
+    if kind == KIND_FOOD:
+        return Food(x, y, size, color)
+    elif kind == KIND_AMOEBA:
+        amoeba = Amoeba(x, y, 0, color)
+        amoeba.set_area(size)
+        return amoeba
+    elif kind == KIND_PLAYER_AMOEBA:
+        player = PlayerAmoeba(small_id, x, y)
+        player.set_area(size)
+        player.color = color
+        player.aim_angle, player.last_grenade_fired = extra[:2]
+        return player
+    elif kind == KIND_GRAVITY_GRENADE:
+        grenade = GravityGrenade(x, y, extra[0])
+        grenade.detonation_time = extra[1]
+        grenade.has_exploded = bool(extra[2])
+        return grenade
+    elif kind == KIND_POWERUP:
+        powerup = Powerup(x, y, small_id)
+        powerup.radius = size
+        return powerup
+    raise ValueError(f"Unknown object kind {kind}")
+
+
+def restore_snapshot(data):
+    """
+    Replace the simulation state with a snapshot.
+    :param data: Anything supporting the buffer protocol, e.g. bytes from take_snapshot() or a memory-mapped file
+    """
+    # Creating this many objects would set off several garbage collections, which have nothing to free
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        _restore_snapshot(data)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _restore_snapshot(data):
+    # A memory-mapped file can only be closed once nothing references its buffer anymore,
+    # also if the snapshot turns out to be broken
+    view = memoryview(data)
+    try:
+        _restore_snapshot_from_view(view)
+    finally:
+        view.release()
+
+
+def _restore_snapshot_from_view(view: memoryview):
+    import state
+
+    (magic, version, width, height, game_time, food_last_added, powerup_last_added, next_free_player_id,
+     next_uid, record_count, object_count, cell_count, *settings) = HEADER_FORMAT.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError("Not a snapshot")
+    if version != VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}")
+
+    world = state.World((width, height))
+    entities = world.entities
+    # Added to the entities all at once at the end, in the original order
+    in_world = []
+    respawn_queue = {}
+    players_by_uid = {}
+    grenade_owners = []
+
+    records_start = HEADER_FORMAT.size + RNG_FORMAT.size
+    records = view[records_start:records_start + record_count * RECORD_FORMAT.size]
+    try:
+        _restore_records(records, entities, in_world, respawn_queue, players_by_uid, grenade_owners)
+    finally:
+        records.release()
+    if len(in_world) != object_count:
+        raise ValueError(f"Snapshot has {len(in_world)} objects, but an index for {object_count}")
+
+    index_start = records_start + record_count * RECORD_FORMAT.size
+    flat_index_ranges = struct.unpack_from(f"<{object_count * 4}i", view, index_start)
+    index_ranges = zip(*[iter(flat_index_ranges)] * 4)
+    cells = {}
+    cell_start = index_start + object_count * INDEX_RANGE_SIZE
+    members_start = cell_start + cell_count * CELL_FORMAT.size
+    for i in range(cell_count):
+        x_index, y_index, count = CELL_FORMAT.unpack_from(view, cell_start + i * CELL_FORMAT.size)
+        cells[x_index, y_index] = struct.unpack_from(f"<{count}I", view, members_start)
+        members_start += count * 4
+    entities.extend(in_world, (index_ranges, cells))
+
+    # The owner is stored after the grenade if it's waiting for respawn. If it's not stored at all,
+    # it was respawned, and the grenade can't hit the old amoeba anyway.
+    for grenade, owner_uid in grenade_owners:
+        grenade.owner = players_by_uid.get(owner_uid)
+
+    rng = RNG_FORMAT.unpack_from(view, HEADER_FORMAT.size)
+    world.rng.setstate((rng[0], rng[1:626], rng[627] if rng[626] else None))
+
+    # Stats are not saved, the leaderboard starts over with the players that are alive
+    for player in entities.player_amoebae:
+        world.leaderboard.on_spawn(player, game_time)
+    world.respawn_queue.update(respawn_queue)
+    world.food_last_added = food_last_added
+    world.settings = SimulationSettings(*settings)
+    world.powerup_last_added = powerup_last_added
+    world.next_free_player_id = next_free_player_id
+    world.game_time = game_time
+    world.next_uid = next_uid
+
+    # Players keep the controller they have in this process (e.g. bots), by player id. Players that only exist
+    # in the snapshot get the controllers no player uses, in player order.
+    previous_controllers = state.world.player_to_controller_map
+    free_controllers = [controller for controller in state.controllers
+                        if controller not in previous_controllers.values()]
+    for player_id in sorted(player.player_id for player in players_by_uid.values()):
+        if player_id in previous_controllers:
+            world.player_to_controller_map[player_id] = previous_controllers[player_id]
+        elif free_controllers:
+            world.player_to_controller_map[player_id] = free_controllers.pop(0)
+    world.bot_pool = state.world.bot_pool
+
+    state.set_world(world)
+    state.start_timers()
+
+
+def _restore_records(records: memoryview, entities, in_world: list, respawn_queue: dict, players_by_uid: dict,
+                     grenade_owners: list):
+    """
+    Create the objects of the records, and collect where they belong, see _restore_snapshot_from_view().
+    """
+    new_food = Food.__new__
+    for (kind, flags, small_id, uid, parent_uid, x, y, size, speed_x, speed_y,
+         r, g, b, extra_0, extra_1, extra_2) in RECORD_FORMAT.iter_unpack(records):
+        if kind == KIND_FOOD:
+            # Almost all objects are food. The constructors take longer than everything else here together,
+            # so the attributes they would set are filled in directly (test_snapshot_restore() checks them).
+            obj = new_food(Food)
+            obj.uid = uid
+            obj.pos_x = x
+            obj.pos_y = y
+            obj.radius = size
+            obj.is_edible = True
+            obj.speed_x = speed_x
+            obj.speed_y = speed_y
+            obj.color = (r, g, b)
+            in_world.append(obj)
+            continue
+        extra = (extra_0, extra_1, extra_2)
+        if kind == KIND_LASER:
+            entities.lasers.append(Laser(players_by_uid[parent_uid], extra[0]))
+            continue
+        obj = _create_object(kind, small_id, x, y, size, (r, g, b), extra)
+        obj.uid = uid
+        obj.speed_x = speed_x
+        obj.speed_y = speed_y
+
+        if flags & FLAG_IN_WORLD:
+            in_world.append(obj)
+        if flags & FLAG_RESPAWNING:
+            respawn_queue[obj] = extra[2]
+        if kind == KIND_PLAYER_AMOEBA:
+            players_by_uid[uid] = obj
+        elif kind == KIND_GRAVITY_GRENADE and parent_uid != NO_PARENT:
+            grenade_owners.append((obj, parent_uid))
+        elif flags & FLAG_ACTIVE_POWERUP:
+            players_by_uid[parent_uid].active_powerup = obj
+        elif flags & FLAG_RESERVE_POWERUP:
+            players_by_uid[parent_uid].reserve_powerups.append(obj)
+
+def save(path: str, data: bytes = None):
+    """
+    Write a snapshot to a file. The file is replaced atomically, so a crash never leaves a broken save behind.
+    """
+    if data is None:
+        data = take_snapshot()
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+def load(path: str):
+    """
+    Restore a snapshot file. The file is memory-mapped, records are unpacked directly from the mapping.
+    """
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            restore_snapshot(mapping)
+
+
+class Checkpointer:
+    """
+    Periodically saves the simulation state in the background, for long-running server matches.
+    The snapshot is serialized between ticks and only the disk write happens on a background thread.
+    When the game loop is the only thread in the process (no rendering, network, metrics or capture
+    threads), a forked child serializes and writes the copy-on-write state instead, so the game loop
+    only pays for the fork. Forking while other threads run could leave the child with locks held
+    by threads that don't exist there.
+    """
+    def __init__(self, path: str, interval_sec: float):
+        self.path = path
+        self.interval_sec = interval_sec
+        self.last_checkpoint = 0
+        self._child_pid = None
+        self._thread: threading.Thread = None
+
+    def update(self, game_time: float):
+        if game_time - self.last_checkpoint < self.interval_sec or self.is_busy():
+            return
+        self.last_checkpoint = game_time
+        self.start_checkpoint()
+
+    def is_busy(self):
+        if self._child_pid:
+            pid, status = os.waitpid(self._child_pid, os.WNOHANG)
+            if pid == 0:
+                return True
+            self._child_pid = None
+        return bool(self._thread and self._thread.is_alive())
+
+    def start_checkpoint(self):
+        if hasattr(os, "fork") and threading.active_count() == 1:
+            pid = os.fork()
+            if pid == 0:
+                # Child process
+                exit_code = 0
+                try:
+                    save(self.path)
+                except BaseException:
+                    exit_code = 1
+                finally:
+                    os._exit(exit_code)
+            self._child_pid = pid
+        else:
+            data = take_snapshot()
+            self._thread = threading.Thread(target=save, args=(self.path, data), name="Checkpointer", daemon=True)
+            self._thread.start()
+
+    def wait(self):
+        """
+        Block until the checkpoint in progress (if any) has been written.
+        """
+        if self._child_pid:
+            os.waitpid(self._child_pid, 0)
+            self._child_pid = None
+        if self._thread:
+            self._thread.join()
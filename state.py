@@ -1,22 +1,73 @@
+import gc
+import os
 import pygame
-from random import random, choice as random_choice
+import random as random_module
 import math
-
-from input import FakeController, keymap_WASD, keymap_arrow_keys
-from entities import Object, Food, MovingObject, Amoeba, PlayerAmoeba, GravityGrenade
-from powerups import PowerupType, Powerup
+import operator
+from time import perf_counter
+
+from input import (FakeController, keymap_WASD, keymap_arrow_keys, sample_controller, NO_INPUT, TickInput,
+                   SimulationSettings)
+from bots import BotPool, BotController
+from entities import Object, Food, MovingObject, Amoeba, PlayerAmoeba, GravityGrenade, calc_damping, REST_SPEED
+from powerups import PowerupType, Powerup, Laser
 from quadtree import QuadTree
-from accelerator import Grid
+from accelerator import SpatialHash
+from scheduler import Scheduler
+from pool import ObjectPool
+import fonts
+import render
+from leaderboard import Leaderboard, LeaderboardOverlay
 import utils
 
 
 TARGET_FRAMERATE = 60
 
+FOOD_INTERVAL_SEC = 0.1
+POWERUP_INTERVAL_SEC = 10
+# No more food is added by the timer while there is this much
+MAX_FOOD = 20000
+RESPAWN_TIME_SEC = 5
+
+GRENADE_GRAVITY_RANGE = 300  # TODO find a good distance where the gravity effect becomes negligible
+GRENADE_MAX_FORCE = 50
+# Amoebae closer in size than this can't eat each other, they collide instead (see the eat check in update())
+COLLISION_RADIUS_RATIO = 0.8
+# How much of the overlap between two colliding amoebae is resolved per tick. Less than 1 makes them squishy.
+COLLISION_STIFFNESS = 0.5
+# Acceleration from player input, per second. It's reduced as the radius increases, down to a minimum.
+ACCELERATION_BASE = 205
+ACCELERATION_PER_RADIUS = 0.5
+ACCELERATION_MIN = 80
+# Amoebae that are cut down below this radius by lasers or explosions die
+AMOEBA_MIN_RADIUS = 5
+# How far the blast of an exploding grenade reaches
+EXPLOSION_RANGE = 110
+# Speed that the blast gives to small objects at the center of the explosion
+EXPLOSION_IMPULSE = 800
+# Fraction of its area that an amoeba at the center of the explosion loses
+EXPLOSION_DAMAGE = 0.5
+# Number of pieces of food the lost area splits into
+EXPLOSION_PIECES = 5
+# Lasers do this much more damage while they cut through the nucleus of an amoeba
+NUCLEUS_DAMAGE_MULTIPLIER = 5
+
+# Metabolism: amoebae constantly lose area, more when moving fast or using weapons
+# Fraction of the area lost per second at rest
+METABOLISM_BASE_RATE = 0.005
+# Additional fraction of the area lost per second, per pixel per second of speed
+METABOLISM_SPEED_RATE = 0.00002
+# Area it costs to fire a grenade
+GRENADE_ENERGY = 50
+# Area per second it costs to keep a laser going
+LASER_ENERGY_PER_SEC = 100
+# Amoebae don't starve below this radius
+METABOLISM_MIN_RADIUS = 10
+
 # Available controllers
 controllers: list[pygame.joystick.Joystick] = []
-# Mapping from player_id to controller used
-player_to_controller_map: dict[int: pygame.joystick.Joystick] = {}
-next_free_player_id = 1
+# Receives input from network clients, if started (a network_input.InputServer)
+input_server = None
 
 window: pygame.Surface = None
 clock: pygame.time.Clock = None
@@ -26,69 +77,255 @@ my_font: pygame.font.Font = None
 debug_font: pygame.font.Font = None
 
 draw_debug = False
+# How much detail is drawn (see render.LevelOfDetail)
+level_of_detail: render.LevelOfDetail = None
+# If set, turns down the settings and the detail level to keep up the frame rate (a governor.FrameGovernor)
+frame_governor = None
+
+# If set, every tick is written to this replay recorder
+recorder = None
+# If set, periodically saves the game state (see snapshot.Checkpointer)
+checkpointer = None
+# If set, operational metrics are collected (see metrics.GameMetrics)
+metrics = None
+leaderboard_overlay: LeaderboardOverlay = None
 
 class EntityCollection:
     def __init__(self, window_size: tuple[float, float]):
         self.objects: list[Object] = []
         self.moving_objects: list[MovingObject] = []
+        # All amoebae, including the player amoebae
+        self.amoebae: list[Amoeba] = []
         self.player_amoebae: list[PlayerAmoeba] = []
         self.gravity_grenades: list[GravityGrenade] = []
+        # Armed grenades that pull objects in, maintained by the grenade events (see schedule_grenade())
+        self.active_grenades: list[GravityGrenade] = []
+        # Lasers are not objects in the accelerator, they are tied to their owner
+        self.lasers: list[Laser] = []
+
+        # Cells of the same size as a 16 x 16 grid over the window. Objects that stick out of the window, and big
+        # amoebae, are in cells of their own beyond it.
+        self.accelerator = SpatialHash(window_size[0] // 16, window_size[1] // 16)
 
-        self.accelerator = Grid(window_size[0], window_size[1], 16)
+        # Objects that are created and destroyed all the time are recycled, see recycle()
+        self.food_pool = ObjectPool(Food)
+        self.grenade_pool = ObjectPool(GravityGrenade)
+        self.powerup_pool = ObjectPool(Powerup)
+        self._pools = {Food: self.food_pool, GravityGrenade: self.grenade_pool, Powerup: self.powerup_pool}
 
     def append(self, obj):
         self.accelerator.add(obj)
         self.objects.append(obj)
         if isinstance(obj, MovingObject):
             self.moving_objects.append(obj)
+            if isinstance(obj, Amoeba):
+                self.amoebae.append(obj)
             if isinstance(obj, PlayerAmoeba):
                 self.player_amoebae.append(obj)
             elif isinstance(obj, GravityGrenade):
                 self.gravity_grenades.append(obj)
 
+    def extend(self, objs: list, saved_index: tuple = None):
+        """
+        Add many objects at once, like append() for each, in the same order.
+        :param saved_index: The index ranges and cells of the objects in the accelerator, if they are known
+                            already (see SpatialHash.add_all_saved())
+        """
+        if saved_index:
+            self.accelerator.add_all_saved(objs, *saved_index)
+        else:
+            self.accelerator.add_all(objs)
+        self.objects.extend(objs)
+        moving_objects = [obj for obj in objs if isinstance(obj, MovingObject)]
+        self.moving_objects.extend(moving_objects)
+        self.amoebae.extend(obj for obj in moving_objects if isinstance(obj, Amoeba))
+        self.player_amoebae.extend(obj for obj in moving_objects if isinstance(obj, PlayerAmoeba))
+        self.gravity_grenades.extend(obj for obj in moving_objects if isinstance(obj, GravityGrenade))
+
     def remove(self, obj):
-        self.accelerator.remove(obj, obj.pos_x, obj.pos_y, obj.radius)
+        self.accelerator.remove(obj)
         self.objects.remove(obj)
         if isinstance(obj, MovingObject):
             self.moving_objects.remove(obj)
+            if isinstance(obj, Amoeba):
+                self.amoebae.remove(obj)
             if isinstance(obj, PlayerAmoeba):
                 self.player_amoebae.remove(obj)
             elif isinstance(obj, GravityGrenade):
                 self.gravity_grenades.remove(obj)
 
+    def remove_all(self, objs: set):
+        """
+        Remove many objects at once. Each remove() searches the lists, for many objects
+        it's cheaper to rebuild them.
+        """
+        if len(objs) < 16:
+            for obj in objs:
+                self.remove(obj)
+            return
+
+        for obj in objs:
+            self.accelerator.remove(obj)
+        # Objects hash by their uid in Python code (see Object.__hash__()), looking up their ids is much faster
+        removed_ids = set(map(id, objs))
+        self.objects = [obj for obj in self.objects if id(obj) not in removed_ids]
+        self.moving_objects = [obj for obj in self.moving_objects if id(obj) not in removed_ids]
+        self.amoebae = [obj for obj in self.amoebae if id(obj) not in removed_ids]
+        self.player_amoebae = [obj for obj in self.player_amoebae if id(obj) not in removed_ids]
+        self.gravity_grenades = [obj for obj in self.gravity_grenades if id(obj) not in removed_ids]
+
+    def get_amoeba_index(self) -> SpatialHash:
+        """
+        A spatial hash of only the amoebae, with the same cells as the accelerator. Looking for amoebae in it
+        doesn't go through all the food around them. It's built from scratch, so it's only up to date until
+        the next amoeba moves.
+        """
+        amoeba_index = SpatialHash(self.accelerator.cellwidth, self.accelerator.cellheight)
+        amoeba_index.add_all(self.amoebae)
+        return amoeba_index
+
+    def get_food_count(self):
+        # Powerups lying around are counted too, there are only a few of them
+        return len(self.objects) - len(self.amoebae) - len(self.gravity_grenades)
+
+    def recycle(self, objs):
+        """
+        Hand objects back to their pool, to be reused for new objects. Only for objects that were removed,
+        and are not referenced anywhere else anymore (e.g. eaten powerups are still carried around).
+        """
+        for obj in objs:
+            pool = self._pools.get(type(obj))
+            if pool:
+                pool.release(obj)
+
+    def get_pool_stats(self):
+        return {"food": self.food_pool.get_stats(),
+                "grenades": self.grenade_pool.get_stats(),
+                "powerups": self.powerup_pool.get_stats()}
+
     def update(self, dt):
+        """
+        Move all objects by their speed. Same as MovingObject.update() for each object, but without a method call
+        per object. Thousands of objects can be in motion at once, e.g. food after explosions.
+        """
+        pow_r_dt, damping = calc_damping(dt)
+        rest_speed_squared = REST_SPEED * REST_SPEED
+        width = world.width
+        height = world.height
+        moved = []
         for obj in self.moving_objects:
-            old_data = obj.pos_x, obj.pos_y, obj.radius
-            obj.update(dt)
-            new_data = obj.pos_x, obj.pos_y, obj.radius
-
-            # The object might have moved from one accelerator cell into another
-            if old_data != new_data:
-                self.accelerator.remove(obj, *old_data)
-                self.accelerator.add(obj)
-
-# Game entities
-entities: EntityCollection = None
-
-respawn_queue: list[tuple[PlayerAmoeba, float]] = []
-food_last_added = 0
-powerup_last_added = 0
+            speed_x = obj.speed_x
+            speed_y = obj.speed_y
+            if not (speed_x or speed_y):
+                # At rest, like most food
+                continue
+            x = obj.pos_x + speed_x * damping
+            y = obj.pos_y + speed_y * damping
+            speed_x *= pow_r_dt
+            speed_y *= pow_r_dt
+            if speed_x * speed_x + speed_y * speed_y < rest_speed_squared:
+                speed_x = 0
+                speed_y = 0
+            obj.speed_x = speed_x
+            obj.speed_y = speed_y
+            # Same as utils.clamp(), without two calls
+            obj.pos_x = 0 if x < 0 else width if x > width else x
+            obj.pos_y = 0 if y < 0 else height if y > height else y
+            moved.append(obj)
+
+        # The objects might have moved from one accelerator cell into another
+        self.accelerator.move_all(moved)
+        for player in self.player_amoebae:
+            player.update_powerups(dt)
+
+class World:
+    """
+    The state of one match: the board with everything on it, the players and the clock. Matches don't share
+    anything, so a process can hold several, e.g. batch.py creates one per match.
+    The functions in this module work on the current world, see set_world().
+    """
+    def __init__(self, size: tuple[int, int], seed: int = None):
+        """
+        :param seed: Seed for the random number generators, for reproducible matches
+        """
+        self.width, self.height = size
+        # Everything in the match that draws random numbers uses this, never the random module
+        self.rng = random_module.Random(seed)
+        # Game time and next object uid while another world is current (see set_world())
+        self.game_time = 0
+        self.next_uid = 0
+
+        # Game entities
+        self.entities = EntityCollection(size)
+        # Mapping from player_id to controller used
+        self.player_to_controller_map: dict[int: pygame.joystick.Joystick] = {}
+        self.next_free_player_id = 1
+        # Makes the decisions of all AI controlled players
+        self.bot_pool = BotPool(seed=seed)
+        # Settings of the simulation, changed by the frame governor through the tick input
+        self.settings = get_default_settings()
+        # Ranking and stats of the players
+        self.leaderboard = Leaderboard()
+        # Dead players and their time of death
+        self.respawn_queue: dict[PlayerAmoeba, float] = {}
+        self.food_last_added = 0
+        self.powerup_last_added = 0
+        # Runs everything that happens after a delay, see start_timers()
+        self.scheduler: Scheduler = None
+        # Grenades that detonated this tick, their explosions are applied together
+        self.exploding_grenades: list[GravityGrenade] = []
+        # Objects eaten by player amoebae so far: food, powerups and other amoebae
+        self.eaten_count = 0
+
+
+# The match that is simulated and drawn
+world: World = None
+get_uid = operator.attrgetter("uid")
+get_radius = operator.attrgetter("radius")
+
+
+def set_world(new_world: World):
+    """
+    Make a world the current one. The game time (utils.get_time()) and the uid counter of the objects are
+    module globals, they are kept in the world while it isn't current.
+    """
+    global world
+    if world:
+        world.game_time = utils.get_time()
+        world.next_uid = Object.next_uid
+    world = new_world
+    utils.game_time = new_world.game_time
+    Object.next_uid = new_world.next_uid
 
 
-def init_system():
+def init_system(window_size: tuple[int, int] = None, headless=False, seed: int = None):
     """
     Runs before the main game loop starts.
     Global stuff is initialized here, and the starting game state is set up (spawning players, adding food etc.)
+    :param window_size: Defaults to the size of the screen (windowless fullscreen)
+    :param headless: Don't open a real window, for simulations and replay playback
+    :param seed: Seed for the random number generator, for reproducible matches
     """
-    pygame.init()
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+    controllers.clear()
+
+    # Only what is used, pygame.init() would also open the audio device
+    pygame.display.init()
+    pygame.font.init()
     pygame.joystick.init()
     pygame.display.set_caption("Amoeba Game")
 
     # Init globals
-    global clock, my_font, debug_font, window, entities
+    global clock, my_font, debug_font, window, level_of_detail, frame_governor, leaderboard_overlay
     clock = pygame.time.Clock()
-    my_font = pygame.font.SysFont("Comic Sans MS", 30)
-    debug_font = pygame.font.SysFont("Monospace", 20)
+    level_of_detail = render.LevelOfDetail()
+    frame_governor = None
+    my_font = fonts.load_font("Comic Sans MS", 30)
+    debug_font = fonts.load_font("Monospace", 20)
+    leaderboard_overlay = LeaderboardOverlay(fonts.load_font("Monospace", 20))
     # window = pygame.display.set_mode((800, 600), vsync=True)
 
     for i in range(pygame.joystick.get_count()):
@@ -99,96 +336,203 @@ def init_system():
     controllers.append(FakeController(keymap_WASD, "WASD"))
     controllers.append(FakeController(keymap_arrow_keys, "Arrow Keys"))
 
-    # Windowless fullscreen
-    info = pygame.display.Info()
-    win_size = (info.current_w, info.current_h)
+    if window_size:
+        win_size = window_size
+    else:
+        # Windowless fullscreen
+        info = pygame.display.Info()
+        win_size = (info.current_w, info.current_h)
     flags = 0
     window = pygame.display.set_mode(win_size, flags, vsync=1)
 
-    entities = EntityCollection(win_size)
+    set_world(World(win_size, seed))
+    start_timers()
 
 
-def init_board_and_players():
-    for i in range(len(controllers)):
+def get_default_settings() -> SimulationSettings:
+    return SimulationSettings(FOOD_INTERVAL_SEC, MAX_FOOD, GRENADE_GRAVITY_RANGE)
+
+
+def start_timers():
+    """
+    Schedule the timed events of the current world. Runs at startup, and after restoring a snapshot.
+    """
+    world.scheduler = Scheduler()
+    world.exploding_grenades.clear()
+    world.entities.active_grenades.clear()
+
+    world.scheduler.schedule(world.food_last_added + world.settings.food_interval_sec, _spawn_food_timer)
+    world.scheduler.schedule(world.powerup_last_added + POWERUP_INTERVAL_SEC, _spawn_powerup_timer)
+    for dead_player, time_of_death in world.respawn_queue.items():
+        world.scheduler.schedule(time_of_death + RESPAWN_TIME_SEC, _respawn, dead_player)
+    for grenade in world.entities.gravity_grenades:
+        schedule_grenade(grenade)
+
+
+def _spawn_food_timer():
+    world.food_last_added = utils.get_time()
+    if world.entities.get_food_count() < world.settings.max_food:
+        spawn_food(1)
+    world.scheduler.schedule(world.food_last_added + world.settings.food_interval_sec, _spawn_food_timer)
+
+
+def _spawn_powerup_timer():
+    world.powerup_last_added = utils.get_time()
+    spawn_powerup(1)
+    world.scheduler.schedule(world.powerup_last_added + POWERUP_INTERVAL_SEC, _spawn_powerup_timer)
+
+
+def queue_respawn(dead_player: PlayerAmoeba, time_of_death: float, killer: PlayerAmoeba = None):
+    """
+    :param killer: The player amoeba that ate or shot the dead one, if any
+    """
+    world.respawn_queue[dead_player] = time_of_death
+    world.leaderboard.on_death(dead_player, time_of_death, killer)
+    world.scheduler.schedule(time_of_death + RESPAWN_TIME_SEC, _respawn, dead_player)
+
+
+def _respawn(dead_player: PlayerAmoeba):
+    del world.respawn_queue[dead_player]
+    # The powerups it carried are lost
+    if dead_player.active_powerup:
+        world.entities.recycle([dead_player.active_powerup])
+    world.entities.recycle(dead_player.reserve_powerups)
+    # Create a new, small amoeba for the player
+    spawn_player(dead_player.player_id, dead_player.color)
+
+
+def add_fired_grenade(grenade: GravityGrenade):
+    world.leaderboard.on_grenade_fired(grenade.owner)
+    grenade.owner.energy_used += GRENADE_ENERGY
+    world.entities.append(grenade)
+    schedule_grenade(grenade)
+
+
+def schedule_grenade(grenade: GravityGrenade):
+    """
+    Schedule the phases of a grenade that was added to the entities: arming, detonation and removal.
+    """
+    events = []
+    if not grenade.has_exploded:
+        arming_time = grenade.creation_time + grenade.ARMING_DURATION
+        if arming_time < grenade.detonation_time:
+            events.append(world.scheduler.schedule(arming_time, _arm_grenade, grenade))
+        events.append(world.scheduler.schedule(grenade.detonation_time, _detonate_grenade, grenade))
+    events.append(world.scheduler.schedule(grenade.detonation_time + grenade.EXPLOSION_DURATION,
+                                           _remove_grenade, grenade))
+    grenade.events = events
+
+
+def detonate_grenade(grenade: GravityGrenade, game_time: float):
+    """
+    Set off a grenade early, e.g. by another explosion. Explodes in the next tick.
+    """
+    if grenade.detonation_time <= game_time:
+        # Already going off
+        return
+    for event in grenade.events:
+        event.cancel()
+    if grenade in world.entities.active_grenades:
+        world.entities.active_grenades.remove(grenade)
+    grenade.detonate(game_time)
+    schedule_grenade(grenade)
+
+
+def _arm_grenade(grenade: GravityGrenade):
+    world.entities.active_grenades.append(grenade)
+
+
+def _remove_grenade(grenade: GravityGrenade):
+    world.entities.remove(grenade)
+    world.entities.recycle([grenade])
+
+
+def _detonate_grenade(grenade: GravityGrenade):
+    if grenade in world.entities.active_grenades:
+        world.entities.active_grenades.remove(grenade)
+    world.exploding_grenades.append(grenade)
+
+
+def init_board_and_players(player_count: int = None):
+    """
+    :param player_count: Defaults to one player per controller
+    """
+    if player_count is None:
+        player_count = len(controllers)
+
+    for i in range(player_count):
         add_player()
 
     spawn_food(100)
     spawn_powerup(1)
 
-    entities.player_amoebae[0].radius = 100
+    world.entities.player_amoebae[0].set_radius(100)
+    world.entities.accelerator.move(world.entities.player_amoebae[0])
 
 
 def spawn_food(amount: int):
-    info = pygame.display.Info()
-    win_width = info.current_w
-    win_height = info.current_h
-
     for i in range(amount):
-        entities.append(Food(random() * win_width, random() * win_height,
-                             5, (0, 170, 60)))
+        world.entities.append(world.entities.food_pool.acquire(world.rng.random() * world.width,
+                                                               world.rng.random() * world.height, 5, (0, 170, 60)))
 
 
 def spawn_powerup(amount: int):
-    info = pygame.display.Info()
-    win_width = info.current_w
-    win_height = info.current_h
-
     MIN_DIST_TO_PLAYERS = 200
 
     for i in range(amount):
-        powerup_type = random_choice(PowerupType.values)
+        powerup_type = world.rng.choice(PowerupType.values)
 
         too_close_to_players = True
 
         while too_close_to_players:
-            x = random() * win_width
-            y = random() * win_height
-            too_close_to_players = False
-
-            rect = utils.get_square_around_point(x, y, MIN_DIST_TO_PLAYERS)
-            objs_in_rect = entities.accelerator.get_objs_in_rect(*rect)
+            x = world.rng.random() * world.width
+            y = world.rng.random() * world.height
+            too_close_to_players = bool(world.entities.accelerator.get_nearest(x, y, 1, MIN_DIST_TO_PLAYERS,
+                                                                               PlayerAmoeba))
 
-            for obj in objs_in_rect:
-                dist_squared = utils.calc_distance_squared((x, y), (obj.pos_x, obj.pos_y))
-                if dist_squared < MIN_DIST_TO_PLAYERS**2:
-                    too_close_to_players = True
-
-        entities.append(Powerup(x, y, powerup_type))
+        world.entities.append(world.entities.powerup_pool.acquire(x, y, powerup_type))
 
 
 
 def spawn_player(player_id: int, color=None):
-    info = pygame.display.Info()
-    win_width = info.current_w
-    win_height = info.current_h
-
     spawn_margin = 50
-    spawn_width = win_width - spawn_margin * 2
-    spawn_height = win_height - spawn_margin * 2
+    spawn_width = world.width - spawn_margin * 2
+    spawn_height = world.height - spawn_margin * 2
 
-    spawn_x = spawn_margin + random() * spawn_width
-    spawn_y = spawn_margin + random() * spawn_height
+    spawn_x = spawn_margin + world.rng.random() * spawn_width
+    spawn_y = spawn_margin + world.rng.random() * spawn_height
 
     player_amoeba = PlayerAmoeba(player_id, spawn_x, spawn_y)
     if color:
         player_amoeba.color = color
 
-    entities.append(player_amoeba)
+    world.entities.append(player_amoeba)
+    controller = world.player_to_controller_map.get(player_id)
+    world.leaderboard.on_spawn(player_amoeba, utils.get_time(),
+                               controller.get_name() if isinstance(controller, BotController) else None)
 
 
-def add_player():
+def add_player(controller=None) -> int:
+    """
+    :param controller: The controller for the new player. Defaults to the first one not used by any player.
+    :return: The player_id of the new player
+    """
     # Get a new player id
-    global next_free_player_id
-    player_id = next_free_player_id
-    next_free_player_id += 1
+    player_id = world.next_free_player_id
+    world.next_free_player_id += 1
 
     # print("Adding player with ID:", player_id)
 
+    if controller:
+        world.player_to_controller_map[player_id] = controller
+        spawn_player(player_id)
+        return player_id
+
     # Find a free controller
     found_free_controller = False
     for controller in controllers:
-        if controller not in player_to_controller_map.values():
-            player_to_controller_map[player_id] = controller
+        if controller not in world.player_to_controller_map.values():
+            world.player_to_controller_map[player_id] = controller
             found_free_controller = True
             # print(f"Player {player_id} is using controller: {controller.get_name()}")
             break
@@ -197,85 +541,122 @@ def add_player():
     #     print("Could not find a free controller for player", player_id)
 
     spawn_player(player_id)
+    return player_id
+
+
+def add_bots(amount: int):
+    """
+    Add players controlled by the AI
+    """
+    for i in range(amount):
+        bot = world.bot_pool.create_bot()
+        bot.player_id = add_player(bot)
+
+
+def start_input_server(port: int, host: str = "127.0.0.1"):
+    """
+    Start accepting players over the network. A new player is added for every client that sends input,
+    up to network_input.MAX_REMOTE_PLAYERS.
+    :param host: "0.0.0.0" to accept clients from other machines
+    """
+    # Imported only when needed, asyncio takes a while to load
+    from network_input import InputServer
+    global input_server
+    input_server = InputServer(host, port)
+    input_server.start()
 
 
-def update(dt: float):
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """
+    Collect metrics and serve them at http://host:port/metrics
+    """
+    # Imported only when needed, like the input server
+    from metrics import GameMetrics
+    global metrics
+    metrics = GameMetrics()
+    metrics.start_server(host, port)
+
+
+def poll_input() -> TickInput:
+    """
+    Collect the input for the next tick. Every controller is sampled exactly once.
+    """
+    # Sample keyboard state only once per tick, all keyboard controllers share it
+    pressed = pygame.key.get_pressed()
+
+    # Register controllers of newly connected network clients, their players are added in update()
+    joined_controllers = []
+    if input_server:
+        for controller in input_server.pop_new_controllers():
+            controllers.append(controller)
+            joined_controllers.append(controller)
+
+    # Bots decide what to do based on the current board, their decision is their controller input
+    world.bot_pool.update(world.entities)
+
+    player_inputs = {player_id: sample_controller(controller, pressed)
+                     for player_id, controller in world.player_to_controller_map.items()}
+
+    new_settings = frame_governor.pop_settings() if frame_governor else None
+
+    return TickInput(player_inputs, debug_spawn_food=pressed[pygame.K_SPACE],
+                     players_joined=len(joined_controllers), settings=new_settings,
+                     joined_controllers=joined_controllers)
+
+
+def update(dt: float, tick_input: TickInput = None):
     """
     Runs every frame, before draw(). Updates the game state (moving objects etc.)
     :param dt: Delta time, the time that passed since the last call to update().
                Used in various calculcations to make the game framerate-independent.
+    :param tick_input: Input for this tick. If None, the controllers are polled.
+                       Replays pass the recorded input here.
     """
+    update_start = perf_counter()
+    entities = world.entities
+    if tick_input is None:
+        tick_input = poll_input()
+    if recorder:
+        recorder.record_tick(dt, tick_input)
+    if tick_input.settings:
+        world.settings = tick_input.settings
+
+    utils.advance_time(dt)
+
     # fps = clock.get_fps()
     # if fps == 0:
     #     fps = TARGET_FRAMERATE
     # gamespeed = fps / TARGET_FRAMERATE
     # gamespeed_correction = TARGET_FRAMERATE / fps
 
-    # Add some food
-    FOOD_INTERVAL_SEC = 0.1
-    game_time = utils.get_time()
-    global food_last_added
-    if game_time - food_last_added > FOOD_INTERVAL_SEC:
-        food_last_added = game_time
-        spawn_food(1)
-
-    POWERUP_INTERVAL_SEC = 10
+    # Add food and powerups, respawn dead players, arm and detonate grenades
     game_time = utils.get_time()
-    global powerup_last_added
-    if game_time - powerup_last_added > POWERUP_INTERVAL_SEC:
-        powerup_last_added = game_time
-        spawn_powerup(1)
+    world.scheduler.run_due(game_time)
 
     # Debug: add food
-    pressed = pygame.key.get_pressed()
-    if pressed[pygame.K_SPACE]:
+    if tick_input.debug_spawn_food:
         spawn_food(30)
 
-    # Respawn dead players
-    RESPAWN_TIME_SEC = 5
-    respawned = []
-    for elem in respawn_queue:
-        dead_player, time_of_death = elem
-        if game_time - time_of_death > RESPAWN_TIME_SEC:
-            # Create a new, small amoeba for the player
-            spawn_player(dead_player.player_id, dead_player.color)
-            respawned.append(elem)
-
-    for elem in respawned:
-        respawn_queue.remove(elem)
+    # Add players for newly connected network clients. They must get the client's controller, not a free local one.
+    # Replays have no controllers, their players' input is recorded.
+    for i in range(tick_input.players_joined):
+        add_player(tick_input.joined_controllers[i] if tick_input.joined_controllers else None)
 
+    firing_players = {laser.owner for laser in entities.lasers}
     for player_amoeba in entities.player_amoebae:
         # Handle player input
-        try:
-            # For controller input handling, see https://stackoverflow.com/a/70056815
-            # Also helpful: https://github.com/martinohanlon/XboxController/blob/master/XboxController.py
-            from input import Axis
-
-            controller = player_to_controller_map[player_amoeba.player_id]
-
-            move_x = controller.get_axis(Axis.LEFT_STICK_X)
-            move_y = controller.get_axis(Axis.LEFT_STICK_Y)
-            move_x, move_y = utils.normalize((move_x, move_y))
-
-            aim_x = controller.get_axis(Axis.RIGHT_STICK_X)
-            aim_y = controller.get_axis(Axis.RIGHT_STICK_Y)
-            aim_x, aim_y = utils.normalize((aim_x, aim_y))
-
-            right_trigger = controller.get_axis(Axis.RIGHT_TRIGGER)
-            left_trigger = controller.get_axis(Axis.LEFT_TRIGGER)
-        except KeyError:
-            # No controller found for this player
-            move_x = 0
-            move_y = 0
-            aim_x = 0
-            aim_y = 0
-            right_trigger = 0
-            left_trigger = 0
+        # For controller input handling, see https://stackoverflow.com/a/70056815
+        # Also helpful: https://github.com/martinohanlon/XboxController/blob/master/XboxController.py
+        inputs = tick_input.player_inputs.get(player_amoeba.player_id, NO_INPUT)
+
+        move_x, move_y = utils.normalize((inputs.move_x, inputs.move_y))
+        aim_x, aim_y = utils.normalize((inputs.aim_x, inputs.aim_y))
+        right_trigger = inputs.right_trigger
+        left_trigger = inputs.left_trigger
 
         TRIGGER_THRESHOLD = 0.95
 
-        # Acceleration from player input is reduced as radius increases
-        strength = max(80, (-0.5 * player_amoeba.radius + 205)) * dt
+        strength = max(ACCELERATION_MIN, ACCELERATION_BASE - ACCELERATION_PER_RADIUS * player_amoeba.radius) * dt
         player_amoeba.accelerate(move_x, move_y, strength)
 
         player_amoeba.update_aim(dt, aim_x, aim_y)
@@ -284,20 +665,44 @@ def update(dt: float):
         if right_trigger > TRIGGER_THRESHOLD:
             grenade = player_amoeba.fire_grenade(game_time)
             if grenade:
-                entities.append(grenade)
+                add_fired_grenade(grenade)
+
+        if left_trigger > TRIGGER_THRESHOLD and player_amoeba not in firing_players:
+            powerup = player_amoeba.active_powerup
+            laser, grenades = player_amoeba.fire_powerup(game_time)
+            if laser:
+                entities.lasers.append(laser)
+            for grenade in grenades:
+                add_fired_grenade(grenade)
+            if laser or grenades:
+                entities.recycle([powerup])
 
     # Check if any players are eating anything (overlapping with it)
-    player_amoebae_to_delete = set()
+    # Eaten player amoeba -> the one that ate it
+    player_amoebae_to_delete = {}
     entities_to_delete = set()
 
     for player_amoeba in entities.player_amoebae:
-        # Check if we ate something
+        # Check if we ate something. Eating doesn't move us, only makes us bigger.
         p = player_amoeba
+        x = p.pos_x
+        y = p.pos_y
         r = p.radius
+        # Eating can only start with something whose center is inside us already. Most of the time there is
+        # nothing, then skip sorting all our neighbours.
+        if not entities.accelerator.has_obj_in_radius(x, y, r, exclude=p):
+            continue
         r2 = r * 2
-        objs_in_rect = entities.accelerator.get_objs_in_rect(p.pos_x - r, p.pos_y - r, r2, r2)
-
-        for other in objs_in_rect:
+        objs_in_rect = entities.accelerator.get_objs_in_rect(x - r, y - r, r2, r2)
+        # Eating makes us bigger, but never by more than everything around us together. What's farther away
+        # than that can't be eaten, leave it out before sorting.
+        max_radius_squared = math.hypot(r, *map(get_radius, objs_in_rect)) ** 2
+        candidates = [obj for obj in objs_in_rect
+                      if (obj.pos_x - x) ** 2 + (obj.pos_y - y) ** 2 <= max_radius_squared]
+
+        # Eating makes us bigger, which changes what we can eat next. Process the candidates in a fixed order,
+        # so the outcome doesn't depend on how the accelerator stores them.
+        for other in sorted(candidates, key=get_uid):
             if not (other.is_edible or isinstance(other, Powerup)):
                 continue
 
@@ -313,11 +718,14 @@ def update(dt: float):
 
             # How big the other amoeba is relative to us (near 1 = same size, 0.5 = other is half size, etc.)
             other_radius_relative = other_radius / player_radius
-            if other_radius_relative > 0.8:
+            if other_radius_relative > COLLISION_RADIUS_RATIO:
                 # Can't eat the smaller amoeba if it is almost as big as us
                 continue
 
-            dist_squared = utils.calc_distance_squared_objs(player_amoeba, other)
+            # Same as utils.calc_distance_squared_objs(), without a call for each of the many candidates
+            dx = other.pos_x - x
+            dy = other.pos_y - y
+            dist_squared = dx * dx + dy * dy
 
             # We know that the other is the smaller amoeba. Don't eat it when the circles touch,
             # but only once the others center overlaps with our edge.
@@ -325,91 +733,412 @@ def update(dt: float):
                 # We ate it
                 entities_to_delete.add(other)
                 if isinstance(other, PlayerAmoeba):
-                    player_amoebae_to_delete.add(other)
+                    player_amoebae_to_delete[other] = player_amoeba
 
                 if other.is_edible:
                     # Make us bigger
-                    player_amoeba.eat(other)
+                    world.leaderboard.on_eat(player_amoeba, player_amoeba.eat(other))
                 elif isinstance(other, Powerup):
                     player_amoeba.add_powerup(other)
 
+        if player_amoeba.radius != r:
+            # We grew, and might cover more accelerator cells now
+            entities.accelerator.move(player_amoeba)
+
     # Remove all entities that were eaten
-    for amoeba in entities_to_delete:
-        entities.remove(amoeba)
+    entities.remove_all(entities_to_delete)
+    world.eaten_count += len(entities_to_delete)
+    # Powerups that were eaten are carried around now
+    entities.recycle(obj for obj in entities_to_delete if not isinstance(obj, Powerup))
 
     # Queue dead players for respawn later
-    for player_amoeba in player_amoebae_to_delete:
-        respawn_queue.append((player_amoeba, game_time))
+    for player_amoeba, eater in player_amoebae_to_delete.items():
+        queue_respawn(player_amoeba, game_time, eater)
+
+    # Handle lasers. They go away with their owner.
+    alive_players = set(entities.player_amoebae)
+    entities.lasers = [laser for laser in entities.lasers
+                       if laser.owner in alive_players and not laser.should_be_removed(game_time)]
+    # Object -> owner of the laser that cut it
+    cut_objects = {}
+    for laser in entities.lasers:
+        if laser.owner not in cut_objects:
+            laser.owner.energy_used += LASER_ENERGY_PER_SEC * dt
+            apply_laser(laser, dt, game_time, cut_objects)
+
+    entities.remove_all(cut_objects)
+    entities.recycle(cut_objects)
+    for obj, shooter in cut_objects.items():
+        if isinstance(obj, PlayerAmoeba):
+            queue_respawn(obj, game_time, shooter)
+
+    resolve_amoeba_collisions()
+    apply_metabolism(dt)
 
     # Handle gravity grenades
-    grenades_to_delete = set()
-    for grenade in entities.gravity_grenades:
-        if grenade.should_be_removed(game_time):
-            grenades_to_delete.add(grenade)
-            continue
+    if world.exploding_grenades:
+        apply_explosions(world.exploding_grenades, game_time)
+        world.exploding_grenades.clear()
+
+    grenade_starts = [(grenade, grenade.pos_x, grenade.pos_y) for grenade in entities.gravity_grenades]
+    apply_grenade_gravity(entities.active_grenades, game_time)
+    entities.update(dt)
+    resolve_grenade_impacts(grenade_starts, game_time)
 
-        if not grenade.is_active(game_time):
+    if checkpointer:
+        checkpointer.update(game_time)
+    if metrics:
+        metrics.on_update(dt, perf_counter() - update_start, len(entities_to_delete))
+
+
+def apply_metabolism(dt: float):
+    """
+    Drain the area of all amoebae, for staying alive, moving and the weapons they used this tick.
+    """
+    accelerator = world.entities.accelerator
+    min_area = (METABOLISM_MIN_RADIUS ** 2) * math.pi
+    base_rate = METABOLISM_BASE_RATE * dt
+    speed_rate = METABOLISM_SPEED_RATE * dt
+
+    for amoeba in world.entities.amoebae:
+        area = amoeba.area
+        if area <= min_area:
+            amoeba.energy_used = 0
             continue
+        speed = math.sqrt(amoeba.speed_x ** 2 + amoeba.speed_y ** 2)
+        drain = area * (base_rate + speed * speed_rate) + amoeba.energy_used
+        amoeba.energy_used = 0
+        amoeba.set_area(max(area - drain, min_area))
+        # Usually still in the same cells, then this is cheap
+        accelerator.move(amoeba)
+
 
-        r = 300  # TODO find a good distance where the gravity effect becomes negligible
+def resolve_amoeba_collisions():
+    """
+    Push apart amoebae that overlap, but are too similar in size to eat each other.
+    Candidates come from a spatial hash, so each amoeba is only tested against its neighbours. The hash only has
+    the amoebae, they are usually surrounded by lots of food.
+    """
+    accelerator = world.entities.accelerator
+    amoeba_index = world.entities.get_amoeba_index()
+    width = world.width
+    height = world.height
+    moved = set()
+
+    for amoeba in world.entities.amoebae:
+        r = amoeba.radius
         r2 = r * 2
-        objs_in_rect = entities.accelerator.get_objs_in_rect(grenade.pos_x - r, grenade.pos_y - r, r2, r2)
+        others = [obj for obj in amoeba_index.get_objs_in_rect(amoeba.pos_x - r, amoeba.pos_y - r, r2, r2)
+                  if obj.uid > amoeba.uid]
+        # Every pair is only handled by the amoeba with the lower uid. Resolving a collision moves both amoebae,
+        # so the order matters for replays.
+        for other in sorted(others, key=get_uid):
+            dx = other.pos_x - amoeba.pos_x
+            dy = other.pos_y - amoeba.pos_y
+            dist_squared = dx * dx + dy * dy
+            if dist_squared >= (amoeba.radius + other.radius) ** 2:
+                continue
+            small_radius, big_radius = sorted((amoeba.radius, other.radius))
+            if small_radius / big_radius <= COLLISION_RADIUS_RATIO:
+                # One can eat the other
+                continue
 
-        for obj in objs_in_rect:
-            # Ignore ourself
+            dist = math.sqrt(dist_squared)
+            if dist == 0:
+                # Exactly on top of each other, pick any direction
+                dir_x, dir_y = 1, 0
+            else:
+                dir_x = dx / dist
+                dir_y = dy / dist
+            overlap = amoeba.radius + other.radius - dist
+
+            # The heavier one moves less
+            mass = amoeba.radius ** 2
+            other_mass = other.radius ** 2
+            push = overlap * COLLISION_STIFFNESS / (mass + other_mass)
+            amoeba.pos_x = utils.clamp(amoeba.pos_x - dir_x * push * other_mass, 0, width)
+            amoeba.pos_y = utils.clamp(amoeba.pos_y - dir_y * push * other_mass, 0, height)
+            other.pos_x = utils.clamp(other.pos_x + dir_x * push * mass, 0, width)
+            other.pos_y = utils.clamp(other.pos_y + dir_y * push * mass, 0, height)
+
+            # Stop them from moving further into each other (no bounce)
+            approach_speed = (amoeba.speed_x - other.speed_x) * dir_x + (amoeba.speed_y - other.speed_y) * dir_y
+            if approach_speed > 0:
+                impulse = approach_speed / (mass + other_mass)
+                amoeba.accelerate(dir_x, dir_y, -impulse * other_mass)
+                other.accelerate(dir_x, dir_y, impulse * mass)
+
+            moved.add(amoeba)
+            moved.add(other)
+
+    # The pushes are small, so the accelerator is updated only once at the end
+    for amoeba in moved:
+        accelerator.move(amoeba)
+
+
+def apply_laser(laser: Laser, dt: float, game_time: float, cut_objects: dict):
+    """
+    Cut everything in the beam. Objects that don't survive are added to cut_objects with the owner of the laser,
+    the caller removes them.
+    Amoebae whose nucleus is in the beam take more damage.
+    """
+    x0, y0, x1, y1 = laser.get_segment()
+    damage = Laser.DAMAGE_PER_SEC * dt
+
+    for obj in world.entities.accelerator.get_objs_on_segment(x0, y0, x1, y1):
+        # Powerups and grenades are not affected
+        if not isinstance(obj, (Food, Amoeba)):
+            continue
+        if obj is laser.owner or obj in cut_objects:
+            continue
+        if utils.calc_distance_squared_point_segment(obj.pos_x, obj.pos_y, x0, y0, x1, y1) >= obj.radius ** 2:
+            continue
+
+        if isinstance(obj, Amoeba):
+            # Second layer: the nucleus is only checked for amoebae the beam already hit
+            nucleus_x, nucleus_y, nucleus_radius = obj.nucleus.get_circle(game_time)
+            if (utils.calc_distance_squared_point_segment(nucleus_x, nucleus_y, x0, y0, x1, y1)
+                    < nucleus_radius ** 2):
+                obj.lose_area(damage * NUCLEUS_DAMAGE_MULTIPLIER)
+            else:
+                obj.lose_area(damage)
+            if obj.radius >= AMOEBA_MIN_RADIUS:
+                world.entities.accelerator.move(obj)
+                continue
+        cut_objects[obj] = laser.owner
+
+
+def apply_explosions(grenades: list[GravityGrenade], game_time: float):
+    """
+    Blast everything around grenades that explode in this tick. The blasts of all grenades are summed up first,
+    then applied in one pass, so every object is pushed and damaged only once per tick.
+    Other grenades in range are set off, but only explode in the next tick.
+    """
+    accelerator = world.entities.accelerator
+    r = EXPLOSION_RANGE
+    r2 = r * 2
+    # Object -> [push x, push y, strength, strongest single blast, owner of that grenade],
+    # strength is 1 at the center of an explosion, 0 at the edge. The owner of the strongest blast gets the kill.
+    blasts: dict[Object, list] = {}
+
+    for grenade in grenades:
+        grenade.has_exploded = True
+        grenade_x = grenade.pos_x
+        grenade_y = grenade.pos_y
+        for obj in accelerator.get_objs_in_rect(grenade_x - r, grenade_y - r, r2, r2):
             if obj is grenade:
                 continue
+            dx = obj.pos_x - grenade_x
+            dy = obj.pos_y - grenade_y
+            dist_squared = dx * dx + dy * dy
+            reach = r + obj.radius
+            if dist_squared >= reach * reach:
+                continue
 
-            # Grenade gets heavier and heavier over time
-            grenade_mass = 10 + 200 * grenade.get_lifetime_percent(game_time)
-            # Just use the object area as its mass for now
-            obj_mass = (obj.radius ** 2) * math.pi
+            if isinstance(obj, GravityGrenade):
+                detonate_grenade(obj, game_time)
+                continue
 
-            force = utils.calc_gravitational_force(obj, obj_mass, grenade, grenade_mass)
-            force = utils.clamp(force, 0, 50)
+            dist = math.sqrt(dist_squared)
+            if dist == 0:
+                dir_x, dir_y = 1, 0
+            else:
+                dir_x = dx / dist
+                dir_y = dy / dist
+            strength = 1 - dist / reach
+            blast = blasts.get(obj)
+            if blast is None:
+                blasts[obj] = [dir_x * strength, dir_y * strength, strength, strength, grenade.owner]
+            else:
+                blast[0] += dir_x * strength
+                blast[1] += dir_y * strength
+                blast[2] += strength
+                if strength > blast[3]:
+                    blast[3] = strength
+                    blast[4] = grenade.owner
+
+    # Object -> owner of the grenade that killed it
+    killed = {}
+    pieces = []
+    for obj, (push_x, push_y, strength, strongest, owner) in blasts.items():
+        # Small objects fly further
+        obj.accelerate(push_x, push_y, EXPLOSION_IMPULSE * 10 / max(obj.radius, 10))
+
+        if isinstance(obj, Amoeba):
+            area = obj.area
+            lost_area = area * min(strength * EXPLOSION_DAMAGE, 1)
+            if math.sqrt((area - lost_area) / math.pi) < AMOEBA_MIN_RADIUS:
+                # Blown to pieces
+                lost_area = area
+                killed[obj] = owner
+            pieces.extend(obj.split_off(lost_area, push_x, push_y, EXPLOSION_PIECES))
+            if obj not in killed:
+                accelerator.move(obj)
+
+    world.entities.remove_all(killed)
+    for obj, owner in killed.items():
+        if isinstance(obj, PlayerAmoeba):
+            queue_respawn(obj, game_time, owner)
+    for piece in pieces:
+        world.entities.append(piece)
+
+
+def resolve_grenade_impacts(grenade_starts: list[tuple[GravityGrenade, float, float]], game_time: float):
+    """
+    Stop grenades at the first amoeba they hit while moving this tick. Grenades are fast, at low frame rates
+    they would fly right through small amoebae if only their end position was checked.
+    A grenade that hits an amoeba on course for its nucleus goes off right away.
+    :param grenade_starts: Each grenade with its position before it moved
+    """
+    accelerator = world.entities.accelerator
 
-            dir_x = grenade.pos_x - obj.pos_x
-            dir_y = grenade.pos_y - obj.pos_y
-            dir_x, dir_y = utils.normalize((dir_x, dir_y))
-            obj.accelerate(dir_x, dir_y, force)
+    for grenade, x0, y0 in grenade_starts:
+        dx = grenade.pos_x - x0
+        dy = grenade.pos_y - y0
+        if not (dx or dy):
+            continue
 
-    for grenade in grenades_to_delete:
-        entities.remove(grenade)
+        radius = grenade.radius
+        first_impact = None
+        first_amoeba = None
+        for obj in accelerator.get_objs_on_swept_circle(x0, y0, grenade.pos_x, grenade.pos_y, radius):
+            if obj is grenade.owner or not isinstance(obj, Amoeba):
+                continue
+            t = utils.calc_time_of_impact(x0, y0, dx, dy, radius, obj.pos_x, obj.pos_y, obj.radius)
+            if t is not None and (first_impact is None or t < first_impact):
+                first_impact = t
+                first_amoeba = obj
+
+        if first_impact is not None:
+            grenade.pos_x = x0 + dx * first_impact
+            grenade.pos_y = y0 + dy * first_impact
+            grenade.speed_x = 0
+            grenade.speed_y = 0
+            accelerator.move(grenade)
+
+            # Second layer: would the grenade have hit the nucleus, if it had gone on through the amoeba?
+            nucleus_x, nucleus_y, nucleus_radius = first_amoeba.nucleus.get_circle(game_time)
+            scale = first_amoeba.radius * 2 / math.hypot(dx, dy)
+            if utils.calc_time_of_impact(grenade.pos_x, grenade.pos_y, dx * scale, dy * scale, radius,
+                                         nucleus_x, nucleus_y, nucleus_radius) is not None:
+                detonate_grenade(grenade, game_time)
+
+
+def apply_grenade_gravity(grenades: list[GravityGrenade], game_time: float):
+    r = world.settings.gravity_range
+    r2 = r * 2
+
+    for grenade in grenades:
+        # Grenade gets heavier and heavier over time
+        grenade_mass = grenade.get_gravity_mass(game_time)
+        grenade_x = grenade.pos_x
+        grenade_y = grenade.pos_y
+        objs_in_rect = world.entities.accelerator.get_objs_in_rect(grenade_x - r, grenade_y - r, r2, r2)
 
-    entities.update(dt)
+        for obj in objs_in_rect:
+            # Ignore ourself
+            if obj is grenade:
+                continue
 
+            # The accelerator also returns objects from the edges of the cells the rect touches.
+            # Only pull objects that really overlap the rect, so the result doesn't depend on the cell layout.
+            obj_r = obj.radius
+            if abs(obj.pos_x - grenade_x) > r + obj_r or abs(obj.pos_y - grenade_y) > r + obj_r:
+                continue
 
-def draw(dt_used_ms: float):
+            dir_x, dir_y, force = utils.calc_gravity_pull(obj.pos_x, obj.pos_y, obj_r, grenade_x, grenade_y,
+                                                          grenade_mass, GRENADE_MAX_FORCE)
+            obj.accelerate(dir_x, dir_y, force)
+
+
+def build_frame(dt_used_ms: float) -> list[tuple]:
     """
-    Runs every frame. Draws everything that should be visible into the window.
+    Runs every frame, after update(). Collects the draw commands for everything that should be visible.
+    The result is a snapshot that doesn't reference any game objects (see render.py).
     :param dt_used_ms: Delta time that was actually used for computations last frame.
     """
+    game_time = utils.get_time()
+    entities = world.entities
+    commands = []
 
     # Background color
-    window.fill(color=(255, 255, 255))
-
-    p = entities.player_amoebae[0] if entities.player_amoebae else None
+    commands.append((render.FILL, (255, 255, 255)))
+
+    # Food is drawn below everything else, tiny food as single pixels
+    sprites = []
+    commands.append((render.SPRITES, sprites))
+    pixel_radius = level_of_detail.level.pixel_radius
+    get_circle_sprite = render.get_circle_sprite
+    # Food comes in runs of the same look, e.g. the pieces of an amoeba share its color list
+    sprite = None
+    sprite_color = None
+    sprite_radius = None
+    sprite_offset = 0
     for obj in entities.objects:
-        obj.draw()
+        if type(obj) is not Food:
+            obj.add_draw_commands(commands, game_time)
+            continue
+        # Looks the same as Food.add_draw_commands(), but there are thousands of them
+        radius = obj.radius
+        if obj.color is not sprite_color or radius != sprite_radius:
+            sprite_color = obj.color
+            sprite_radius = radius
+            sprite_offset = int(radius) if radius >= pixel_radius else 0
+            sprite = get_circle_sprite(sprite_color, sprite_offset)
+        sprites.append((sprite, (obj.pos_x - sprite_offset, obj.pos_y - sprite_offset)))
+
+    for laser in entities.lasers:
+        laser.add_draw_commands(commands, game_time)
 
-        if draw_debug and p:
+    if draw_debug:
+        p = entities.player_amoebae[0] if entities.player_amoebae else None
+        if p:
             r = p.radius
             r2 = r * 2
             rect_coords = p.pos_x - r, p.pos_y - r, r2, r2
-            objs_in_rect = entities.accelerator.get_objs_in_rect(*rect_coords)
-            if obj in objs_in_rect:
-                outline_width = 2
-                outline_color = (255, 0, 0)
-                pygame.draw.circle(window, outline_color, (obj.pos_x, obj.pos_y), obj.radius, outline_width)
-                pygame.draw.rect(window, outline_color, pygame.Rect(*rect_coords), width=1)
+            outline_width = 2
+            outline_color = (255, 0, 0)
+            for obj in entities.accelerator.get_objs_in_rect(*rect_coords):
+                commands.append((render.CIRCLE, outline_color, (obj.pos_x, obj.pos_y), obj.radius, outline_width))
+            commands.append((render.RECT, outline_color, rect_coords, 1))
 
-    if draw_debug:
-        entities.accelerator.debug_draw(window)
+        commands.append((render.CALL, entities.accelerator.debug_draw))
+
+        commands.append((render.TEXT, "(Press DEL to toggle debug info)",
+                         (10, 34), debug_font, (0, 0, 0), (0, 255, 255), False))
+
+        pool_info = ", ".join(f"{name} {stats['reused']} reused / {stats['free']} free"
+                              for name, stats in entities.get_pool_stats().items())
+        commands.append((render.TEXT, f"Pools: {pool_info}", (10, 58), debug_font, (0, 0, 0), (0, 255, 255), False))
 
-        utils.draw_text(window, "(Press DEL to toggle debug info)",
-                        (10, 34), debug_font, bg_color=(0, 255, 255))
+        if frame_governor and frame_governor.adjustments:
+            commands.append((render.TEXT, f"Governor: {frame_governor.adjustments[-1].describe()}",
+                             (10, 82), debug_font, (0, 0, 0), (0, 255, 255), False))
+
+    leaderboard_overlay.add_draw_commands(commands, world.leaderboard, window.get_width() - 10, 10)
 
     # Debug information
-    utils.draw_text(window, f"{round(clock.get_fps()):03} fps / {dt_used_ms:02} ms / "
-                            f"{len(entities.objects)} entities",
-                    (10, 10), debug_font, bg_color=(0, 255, 255))
+    commands.append((render.TEXT, f"{round(clock.get_fps()):03} fps / {dt_used_ms:02} ms / "
+                                  f"{len(entities.objects)} entities / detail level {level_of_detail.index}",
+                     (10, 10), debug_font, (0, 0, 0), (0, 255, 255), False))
+
+    return commands
+
+
+def draw(dt_used_ms: float):
+    """
+    Runs every frame. Draws everything that should be visible into the window.
+    :param dt_used_ms: Delta time that was actually used for computations last frame.
+    """
+    draw_start = perf_counter()
+    # A frame is thousands of tuples, which are freed right after drawing. Collections while they are alive would
+    # have nothing to free, and would move them on to older generations, which brings the next full collection closer.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        render.execute(window, build_frame(dt_used_ms))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    if metrics:
+        metrics.draw_seconds.observe(perf_counter() - draw_start)
@@ -1,13 +1,14 @@
-from time import perf_counter
+from time import perf_counter, sleep
 from dataclasses import dataclass
 from typing import Optional
 import traceback
+import math
 import sys
 
 import pygame
 
 import state
-from accelerator import Grid
+from accelerator import SpatialHash
 from entities import Object
 
 @dataclass
@@ -83,7 +84,7 @@ def test_grid():
     width = 145.6
     height = 139.2
     cellcount = 16
-    grid = Grid(width, height, cellcount)
+    grid = SpatialHash(width / cellcount, height / cellcount)
 
     obj1 = Object(0, 0, 30)
     grid.add(obj1)
@@ -102,6 +103,1397 @@ def test_grid():
     return TestResult(True)
 
 
+def test_grid_segment_query():
+    import random
+    import utils
+    rng = random.Random(3)
+    width = 1000
+    height = 700
+    grid = SpatialHash(width / 16, height / 16)
+    objs = [Object(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(1, 40)) for i in range(2000)]
+    for obj in objs:
+        grid.add(obj)
+
+    segments = [(rng.uniform(-200, width + 200), rng.uniform(-200, height + 200),
+                 rng.uniform(-200, width + 200), rng.uniform(-200, height + 200)) for i in range(500)]
+    # Edge cases: axis aligned, along cell borders, degenerate, and ending exactly on the world edge
+    segments += [(0, 50, width, 50), (62, 0, 62, height), (0, 0, width, height), (300, 300, 300, 300),
+                 (width, height, 0, 0), (-10, -10, -5, -5), (width / 2, height / 2, width, height / 2)]
+
+    start = perf_counter()
+    for x0, y0, x1, y1 in segments:
+        found = grid.get_objs_on_segment(x0, y0, x1, y1)
+        # Swept circles as big as a cell, so they reach further than the neighbour cells
+        swept_radius = rng.choice((0, 10, 70))
+        found_swept = grid.get_objs_on_swept_circle(x0, y0, x1, y1, swept_radius)
+        for obj in objs:
+            dist_squared = utils.calc_distance_squared_point_segment(obj.pos_x, obj.pos_y, x0, y0, x1, y1)
+            if dist_squared < obj.radius ** 2 and obj not in found:
+                print(f"Object at {obj.pos_x}, {obj.pos_y} with radius {obj.radius} "
+                      f"not found on segment {(x0, y0, x1, y1)}")
+                return TestResult(False)
+            if dist_squared < (obj.radius + swept_radius) ** 2 and obj not in found_swept:
+                print(f"Object at {obj.pos_x}, {obj.pos_y} with radius {obj.radius} "
+                      f"not found by circle with radius {swept_radius} swept along {(x0, y0, x1, y1)}")
+                return TestResult(False)
+    elapsed = perf_counter() - start
+
+    return TestResult(True, elapsed)
+
+
+def check_accelerator_queries(accelerator, objs: list, rng, width: float, height: float, query_count: int):
+    """
+    Compare random queries of an accelerator with a brute force scan over all objects. Queries for a rect,
+    segment or swept circle may return more than what is asked for (whole cells), but never less, and never
+    objects that were removed. Radius and nearest neighbour queries must be exact.
+    :return: Description of the first wrong result, or None
+    """
+    import utils
+    alive = set(objs)
+    for i in range(query_count):
+        # Also outside the world
+        x0, x1 = rng.uniform(-100, width + 100), rng.uniform(-100, width + 100)
+        y0, y1 = rng.uniform(-100, height + 100), rng.uniform(-100, height + 100)
+        left, right = min(x0, x1), max(x0, x1)
+        top, bottom = min(y0, y1), max(y0, y1)
+        swept_radius = rng.choice((0, 10, 70))
+        in_rect = accelerator.get_objs_in_rect(left, top, right - left, bottom - top)
+        on_segment = accelerator.get_objs_on_segment(x0, y0, x1, y1)
+        on_swept_circle = accelerator.get_objs_on_swept_circle(x0, y0, x1, y1, swept_radius)
+
+        for result in (in_rect, on_segment, on_swept_circle):
+            removed = next((obj for obj in result if obj not in alive), None)
+            if removed:
+                return f"Removed object {removed.uid} is still found"
+        for obj in objs:
+            x, y, r = obj.pos_x, obj.pos_y, obj.radius
+            if x + r >= left and x - r <= right and y + r >= top and y - r <= bottom and obj not in in_rect:
+                return f"Object {obj.uid} at {x}, {y} with radius {r} not found in rect {(left, top, right, bottom)}"
+            dist_squared = utils.calc_distance_squared_point_segment(x, y, x0, y0, x1, y1)
+            if dist_squared < r ** 2 and obj not in on_segment:
+                return f"Object {obj.uid} at {x}, {y} with radius {r} not found on segment {(x0, y0, x1, y1)}"
+            if dist_squared < (r + swept_radius) ** 2 and obj not in on_swept_circle:
+                return (f"Object {obj.uid} at {x}, {y} with radius {r} not found by circle with radius "
+                        f"{swept_radius} swept along {(x0, y0, x1, y1)}")
+
+        radius = rng.choice((0, 50, 300))
+        k = rng.choice((1, 5))
+        max_distance = rng.choice((math.inf, 200))
+        min_radius = rng.choice((0, 20))
+        predicate = (lambda obj: obj.radius > min_radius) if min_radius else None
+        kind = rng.choice((None, Object))
+        distances = {obj: (obj.pos_x - x0) * (obj.pos_x - x0) + (obj.pos_y - y0) * (obj.pos_y - y0) for obj in objs
+                     if not min_radius or obj.radius > min_radius}
+        in_radius = {obj for obj, dist_squared in distances.items() if dist_squared <= radius * radius}
+        if accelerator.get_objs_in_radius(x0, y0, radius, kind, predicate) != in_radius:
+            return f"Wrong objects within {radius} of {x0}, {y0}"
+        if not min_radius:
+            exclude = min(in_radius, key=lambda obj: obj.uid, default=None)
+            if accelerator.has_obj_in_radius(x0, y0, radius, exclude) != bool(in_radius - {exclude}):
+                return f"Wrong answer if there are objects within {radius} of {x0}, {y0}"
+        nearest = sorted((dist_squared, obj.uid) for obj, dist_squared in distances.items()
+                         if dist_squared <= max_distance * max_distance)[:k]
+        found = [obj.uid for obj in accelerator.get_nearest(x0, y0, k, max_distance, kind, predicate)]
+        if found != [uid for dist_squared, uid in nearest]:
+            return f"Wrong {k} nearest to {x0}, {y0} within {max_distance}: {found}, expected {nearest}"
+    return None
+
+
+def test_spatial_hash_stress():
+    return check_accelerator_stress(SpatialHash(1000 / 16, 700 / 16), 1000, 700)
+
+
+def check_accelerator_stress(grid, width: float, height: float):
+    """
+    Move, grow, shrink, add and remove objects at random for 2000 frames, and check the queries every frame.
+    """
+    import random
+    rng = random.Random(11)
+
+    def spawn():
+        obj = Object(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(1, 40))
+        grid.add(obj)
+        objs.append(obj)
+
+    objs = []
+    for i in range(300):
+        spawn()
+
+    start = perf_counter()
+    for frame in range(2000):
+        # Movement, sometimes far outside the world
+        for obj in rng.sample(objs, min(30, len(objs))):
+            if rng.random() < 0.05:
+                obj.pos_x = rng.uniform(-500, width + 500)
+                obj.pos_y = rng.uniform(-500, height + 500)
+            else:
+                obj.pos_x += rng.uniform(-30, 30)
+                obj.pos_y += rng.uniform(-30, 30)
+            grid.move(obj)
+        # Eating: one grows by the area of the other, which is removed. Sometimes bigger than the world.
+        if len(objs) > 2 and rng.random() < 0.7:
+            eater, eaten = rng.sample(objs, 2)
+            eater.radius = min(math.sqrt(eater.radius ** 2 + eaten.radius ** 2), 1500)
+            grid.move(eater)
+            grid.remove(eaten)
+            objs.remove(eaten)
+        # Shrinking, like from lasers and explosions
+        shrinking = rng.choice(objs)
+        shrinking.radius = max(shrinking.radius * rng.uniform(0.5, 1), 0.5)
+        grid.move(shrinking)
+        # Spawns and removals
+        for i in range(rng.randrange(3)):
+            spawn()
+        if rng.random() < 0.3:
+            removed = rng.choice(objs)
+            grid.remove(removed)
+            objs.remove(removed)
+
+        error = check_accelerator_queries(grid, objs, rng, width, height, 1)
+        if error:
+            print(f"Frame {frame}: {error}")
+            return TestResult(False)
+        if frame % 100 == 0:
+            stats = grid.get_stats()
+            if stats["objects"] != len(objs) or stats["stale_entries"] or stats["missing_entries"]:
+                print(f"Frame {frame}: {len(objs)} objects, index {stats}")
+                return TestResult(False)
+    elapsed = perf_counter() - start
+
+    return TestResult(True, elapsed)
+
+
+def test_spatial_hash():
+    import random
+    rng = random.Random(50)
+    width = 1000
+    height = 700
+
+    # A world much bigger than the window. Objects outside the window must not pile up in a few cells.
+    objs = [Object(rng.uniform(-20 * width, 20 * width), rng.uniform(-20 * height, 20 * height), rng.uniform(1, 20))
+            for i in range(5000)]
+    spatial_hash = SpatialHash(width / 16, height / 16)
+    for obj in objs:
+        spatial_hash.add(obj)
+    stats = spatial_hash.get_stats()
+    if stats["max_cell_entries"] > 10:
+        print(f"Most objects in a cell: {stats['max_cell_entries']}")
+        return TestResult(False)
+    error = check_accelerator_queries(spatial_hash, objs, rng, width, height, 20)
+    if error:
+        print(error)
+        return TestResult(False)
+    # More than there are, the search has to end anyway
+    if len(spatial_hash.get_nearest(0, 0, len(objs) + 1)) != len(objs):
+        print("Not all objects found")
+        return TestResult(False)
+
+    # Memory depends on the area the objects cover, not on where they are
+    def get_memory(offset_x, offset_y):
+        cluster = SpatialHash(width / 16, height / 16)
+        for obj in objs:
+            cluster.add(Object(obj.pos_x / 20 + offset_x, obj.pos_y / 20 + offset_y, obj.radius))
+        return cluster.get_stats()["memory_bytes"]
+    near_memory = get_memory(0, 0)
+    far_memory = get_memory(1e7, -1e7)
+    if far_memory > near_memory * 1.1:
+        print(f"{far_memory} bytes far away, {near_memory} bytes near the origin")
+        return TestResult(False)
+
+    # Empty cells are freed
+    start = perf_counter()
+    for obj in objs:
+        spatial_hash.remove(obj)
+    elapsed = perf_counter() - start
+    if spatial_hash.cells or spatial_hash.get_stats()["objects"]:
+        print(f"{len(spatial_hash.cells)} cells left after removing all objects")
+        return TestResult(False)
+
+    return TestResult(True, elapsed)
+
+
+def test_entity_index_consistency():
+    import random
+
+    # A whole match with everything that moves objects or changes their size: eating, grenades, explosions,
+    # lasers, collisions and metabolism
+    state.init_system((1280, 720), headless=True, seed=12)
+    state.add_bots(30)
+    state.spawn_food(3000)
+    rng = random.Random(12)
+    width, height = state.window.get_size()
+
+    # Long enough for grenades to explode (after 12 s), in big steps, as these many bots are slow to simulate
+    start = perf_counter()
+    for tick in range(300):
+        state.update(1 / 20)
+        if tick % 20 == 0:
+            objs = state.world.entities.objects
+            accelerator = state.world.entities.accelerator
+            stats = accelerator.get_stats()
+            if stats["objects"] != len(objs) or stats["stale_entries"] or stats["missing_entries"]:
+                print(f"Tick {tick}: {len(objs)} objects, index {stats}")
+                pygame.quit()
+                return TestResult(False)
+            error = check_accelerator_queries(accelerator, objs, rng, width, height, 5)
+            if error:
+                print(f"Tick {tick}: {error}")
+                pygame.quit()
+                return TestResult(False)
+    elapsed = perf_counter() - start
+    pygame.quit()
+
+    return TestResult(True, elapsed)
+
+
+def test_nearest_queries():
+    import random
+    from entities import Amoeba
+
+    # As crowded as a world of the size of the screen gets: 100000 pieces of food and a few amoebae
+    rng = random.Random(46)
+    width = 1920
+    height = 1080
+    grid = SpatialHash(width / 16, height / 16)
+    objs = [Object(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(1, 5)) for i in range(100000)]
+    objs += [Amoeba(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(20, 80), (0, 0, 0))
+             for i in range(50)]
+    for obj in objs:
+        grid.add(obj)
+    points = [(rng.uniform(0, width), rng.uniform(0, height)) for i in range(1000)]
+
+    def get_nearest_brute_force(x, y, k, kind):
+        def get_dist_squared_and_uid(obj):
+            return (obj.pos_x - x) * (obj.pos_x - x) + (obj.pos_y - y) * (obj.pos_y - y), obj.uid
+        return sorted((obj for obj in objs if isinstance(obj, kind)), key=get_dist_squared_and_uid)[:k]
+
+    for x, y in points[:10]:
+        if (grid.get_nearest(x, y, 5) != get_nearest_brute_force(x, y, 5, Object)
+                or grid.get_nearest(x, y, 1, kind=Amoeba) != get_nearest_brute_force(x, y, 1, Amoeba)):
+            print(f"Wrong nearest objects to {x}, {y}")
+            return TestResult(False)
+
+    # Only the cells right around each point should be searched, so a frame could afford many of these
+    start = perf_counter()
+    for x, y in points:
+        grid.get_nearest(x, y, 5)
+    elapsed = perf_counter() - start
+
+    return TestResult(elapsed < 1, elapsed)
+
+
+def test_grenade_hits_at_low_framerate():
+    from entities import GravityGrenade
+    from input import TickInput, InputState
+    import utils
+
+    state.init_system((1920, 1080), headless=True, seed=6)
+    shooter_id = state.add_player()
+    target_id = state.add_player()
+    shooter, target = state.world.entities.player_amoebae
+    shooter.pos_x, shooter.pos_y = 200, 500
+    target.pos_x, target.pos_y = 600, 500
+    state.world.entities.accelerator.move(shooter)
+    state.world.entities.accelerator.move(target)
+
+    # At 4 fps, the grenade moves further than the diameter of the target in one tick
+    dt = 1 / 4
+    fire = {shooter_id: InputState(aim_x=1, right_trigger=1)}
+    state.update(dt, TickInput(fire))
+    grenade = state.world.entities.gravity_grenades[0]
+    for i in range(3):
+        state.update(dt, TickInput({}))
+        # Check where it stopped, before it explodes when it was on course for the nucleus
+        if not (grenade.speed_x or grenade.speed_y):
+            break
+
+    distance = utils.calc_distance_objs(grenade, target)
+    stopped = not (grenade.speed_x or grenade.speed_y)
+
+    # A grenade that rests against an amoeba must be able to leave again
+    leaving = GravityGrenade(0, target.pos_y, 0)
+    start_x = target.pos_x - target.radius - leaving.radius + 1
+    leaving.pos_x = start_x - 20
+    leaving.speed_x = -20
+    state.world.entities.append(leaving)
+    state.resolve_grenade_impacts([(leaving, start_x, target.pos_y)], 0)
+    pygame.quit()
+
+    if not stopped or abs(distance - (grenade.radius + target.radius)) > 1:
+        print(f"Grenade at {grenade.pos_x}, {grenade.pos_y} did not stop at the target, {distance=}")
+        return TestResult(False)
+    if leaving.speed_x != -20 or leaving.pos_x != start_x - 20:
+        print(f"Grenade moving away from the amoeba it touches was stopped at {leaving.pos_x}")
+        return TestResult(False)
+
+    return TestResult(True)
+
+
+def test_nucleus_hits():
+    from entities import Amoeba, GravityGrenade, Nucleus
+    from random import Random
+
+    state.init_system((1920, 1080), headless=True, seed=8)
+    game_time = 1
+    target = Amoeba(1000, 500, 60)
+    state.world.entities.append(target)
+    nucleus_x, nucleus_y, nucleus_radius = target.nucleus.get_circle(game_time)
+
+    def throw(start_x, start_y, end_x, end_y):
+        grenade = GravityGrenade(end_x, end_y, game_time)
+        state.world.entities.append(grenade)
+        state.schedule_grenade(grenade)
+        state.resolve_grenade_impacts([(grenade, start_x, start_y)], game_time)
+        return grenade
+
+    # Straight at the nucleus, and past it on the side of the amoeba's center
+    hit = throw(nucleus_x - 200, nucleus_y, nucleus_x, nucleus_y)
+    offset = nucleus_radius + hit.radius + 5
+    miss_y = nucleus_y - offset if nucleus_y > target.pos_y else nucleus_y + offset
+    miss = throw(nucleus_x - 200, miss_y, nucleus_x, miss_y)
+    if hit.detonation_time != game_time or miss.detonation_time == game_time:
+        print(f"Nucleus at {nucleus_x}, {nucleus_y}: {hit.detonation_time=}, {miss.detonation_time=}")
+        pygame.quit()
+        return TestResult(False)
+
+    # Every amoeba has a nucleus, but only those of amoebae that were hit are checked
+    rng = Random(8)
+    for i in range(500):
+        state.world.entities.append(Amoeba(rng.random() * 1920, rng.random() * 1080, 10 + rng.random() * 30))
+    checked = 0
+    get_circle = Nucleus.get_circle
+
+    def counting_get_circle(nucleus, time):
+        nonlocal checked
+        checked += 1
+        return get_circle(nucleus, time)
+
+    Nucleus.get_circle = counting_get_circle
+    grenades = []
+    for i in range(200):
+        start_x, start_y = rng.random() * 1920, rng.random() * 1080
+        grenade = GravityGrenade(start_x + rng.uniform(-300, 300), start_y + rng.uniform(-300, 300), game_time)
+        grenade.speed_x = 1
+        state.world.entities.append(grenade)
+        grenades.append((grenade, start_x, start_y))
+    start = perf_counter()
+    state.resolve_grenade_impacts(grenades, game_time)
+    elapsed = perf_counter() - start
+    Nucleus.get_circle = get_circle
+    pygame.quit()
+
+    impacts = sum(grenade.speed_x == 0 for grenade, x, y in grenades)
+    if impacts == 0 or checked != impacts:
+        print(f"{checked} nuclei checked for {impacts} impacts")
+        return TestResult(False, elapsed)
+
+    return TestResult(True, elapsed)
+
+
+def test_explosions():
+    from input import TickInput
+    from entities import Amoeba, GravityGrenade
+
+    state.init_system((1920, 1080), headless=True, seed=7)
+    state.spawn_food(2000)
+    game_time = state.utils.get_time()
+    amoeba = Amoeba(1000, 500, 40)
+    state.world.entities.append(amoeba)
+    area_before = amoeba.radius ** 2
+
+    # A line of grenades, each one in range of the next. Only the first one explodes on its own.
+    grenades = []
+    for i in range(40):
+        grenade = GravityGrenade(900 - i * 50, 500, game_time)
+        grenades.append(grenade)
+        state.world.entities.append(grenade)
+        state.schedule_grenade(grenade)
+    state.detonate_grenade(grenades[0], game_time)
+
+    exploded_per_tick = []
+    max_tick_time = 0
+    for i in range(60):
+        start = perf_counter()
+        state.update(1 / 60, TickInput({}))
+        max_tick_time = max(max_tick_time, perf_counter() - start)
+        exploded_per_tick.append(sum(grenade.has_exploded for grenade in grenades) - sum(exploded_per_tick))
+
+    pushed = amoeba.speed_x > 0
+    damaged = amoeba.radius ** 2 < area_before
+    pygame.quit()
+
+    if not (pushed and damaged):
+        print(f"Amoeba {pushed=} {damaged=}")
+        return TestResult(False)
+    # The chain reaction goes along the line, a blast reaches the next two grenades
+    if sum(exploded_per_tick) != len(grenades) or max(exploded_per_tick) > 2:
+        print("Grenades exploded per tick:", exploded_per_tick)
+        return TestResult(False)
+
+    return TestResult(max_tick_time < 1 / 60, max_tick_time)
+
+
+def test_object_pools():
+    from input import TickInput, InputState
+
+    state.init_system((1920, 1080), headless=True, seed=9)
+    player_ids = [state.add_player() for i in range(6)]
+    state.spawn_food(3000)
+    for player in state.world.entities.player_amoebae:
+        player.set_radius(40)
+        state.world.entities.accelerator.move(player)
+
+    for i in range(300):
+        # Lots of food to eat, and grenades that are removed again after they explode
+        inputs = {player_id: InputState(move_x=1 - (i // 30) % 2 * 2, right_trigger=1) for player_id in player_ids}
+        state.update(1 / 20, TickInput(inputs, debug_spawn_food=True))
+
+    stats = state.world.entities.get_pool_stats()
+    objs = state.world.entities.objects
+    uids_unique = len({obj.uid for obj in objs}) == len(objs)
+    pooled_in_world = [obj for obj in state.world.entities.food_pool._free + state.world.entities.grenade_pool._free
+                       if obj in state.world.entities.accelerator._obj_indices]
+    pygame.quit()
+
+    if not uids_unique or pooled_in_world:
+        print(f"{uids_unique=}, {len(pooled_in_world)} objects are in the world and in a pool")
+        return TestResult(False)
+    if stats["food"]["reused"] == 0 or stats["grenades"]["reused"] == 0:
+        print("Nothing was reused:", stats)
+        return TestResult(False)
+
+    return TestResult(True)
+
+
+def test_metabolism():
+    from input import TickInput, InputState
+
+    state.init_system((1920, 1080), headless=True, seed=10)
+    resting_id, moving_id, firing_id = [state.add_player() for i in range(3)]
+    players = state.world.entities.player_amoebae
+    for i, player in enumerate(players):
+        player.pos_x = 300 + i * 600
+        player.pos_y = 500
+        player.set_radius(50)
+        state.world.entities.accelerator.move(player)
+    resting, moving, firing = players
+
+    inputs = {moving_id: InputState(move_x=1), firing_id: InputState(aim_x=1, right_trigger=1)}
+    for i in range(120):
+        state.update(1 / 60, TickInput(inputs))
+
+    start_area = (50 ** 2) * math.pi
+    lost = [start_area - player.area for player in players]
+    consistent = all(abs(player.radius - math.sqrt(player.area / math.pi)) < 1e-9 for player in players)
+    in_place = all(state.world.entities.accelerator._obj_indices[player]
+                   == state.world.entities.accelerator._get_obj_indices(player) for player in players)
+
+    # Hundreds of amoebae
+    for i in range(500):
+        state.add_player()
+    start = perf_counter()
+    for i in range(60):
+        state.apply_metabolism(1 / 60)
+    elapsed = perf_counter() - start
+    pygame.quit()
+
+    if not (0 < lost[0] < lost[1] and lost[0] < lost[2]) or not consistent or not in_place:
+        print(f"Area lost resting/moving/firing: {lost}, {consistent=}, {in_place=}")
+        return TestResult(False)
+
+    return TestResult(elapsed < 0.1, elapsed)
+
+
+def test_leaderboard():
+    state.init_system((1280, 720), headless=True, seed=47)
+    state.draw_debug = False
+    hunter_id = state.add_player()
+    prey_id = state.add_player()
+    hunter, prey = state.world.entities.player_amoebae
+    hunter.set_radius(60)
+    prey.set_radius(20)
+    hunter.pos_x, hunter.pos_y = 300, 300
+    prey.pos_x, prey.pos_y = 310, 300
+    for player in (hunter, prey):
+        state.world.entities.accelerator.move(player)
+    state.add_bots(20)
+    leaderboard = state.world.leaderboard
+    overlay = state.leaderboard_overlay
+
+    # Long enough for respawns, grenades and explosions. The ranking is never sorted, but must always be in order.
+    versions = set()
+    for tick in range(600):
+        state.update(1 / 30)
+        expected = sorted(state.world.entities.player_amoebae, key=lambda amoeba: (-amoeba.area, amoeba.player_id))
+        if leaderboard.ranking != expected:
+            print(f"Tick {tick}: ranking {[amoeba.player_id for amoeba in leaderboard.ranking]}, "
+                  f"expected {[amoeba.player_id for amoeba in expected]}")
+            pygame.quit()
+            return TestResult(False)
+        state.build_frame(0)
+        versions.add(leaderboard.version)
+    pygame.quit()
+
+    stats = leaderboard.stats
+    all_stats = stats.values()
+    if (stats[hunter_id].kills < 1 or stats[hunter_id].mass_eaten <= 0 or stats[prey_id].deaths < 1
+            or sum(s.kills for s in all_stats) > sum(s.deaths for s in all_stats)
+            or sum(s.grenades_fired for s in all_stats) == 0
+            or not all(0 < s.get_time_alive(20) <= 20 for s in all_stats)):
+        print(leaderboard.format_stats(20))
+        return TestResult(False)
+
+    # The overlay is only rendered again when the top places changed, not every frame
+    if overlay.render_count > len(versions) or overlay.render_count >= 600:
+        print(f"Overlay rendered {overlay.render_count} times for {len(versions)} versions of the leaderboard")
+        return TestResult(False)
+
+    return TestResult(True)
+
+
+def test_lasers():
+    from input import TickInput, InputState
+    from powerups import Powerup, PowerupType
+    import math
+
+    state.init_system((1920, 1080), headless=True, seed=4)
+    state.draw_debug = False
+    player_ids = [state.add_player() for i in range(6)]
+    state.spawn_food(50000)
+    for player in state.world.entities.player_amoebae:
+        player.active_powerup = Powerup(player.pos_x, player.pos_y, PowerupType.LASER)
+    food_count = len(state.world.entities.objects)
+
+    start = perf_counter()
+    min_framerate = 60
+    dt = 1 / min_framerate
+    laser_count = 0
+    for i in range(min_framerate):
+        # Everyone sweeps their laser around
+        aim_x, aim_y = math.cos(i / 10), math.sin(i / 10)
+        inputs = {player_id: InputState(aim_x=aim_x, aim_y=aim_y, left_trigger=1) for player_id in player_ids}
+        state.update(dt, TickInput(inputs))
+        # Players cut each other too, and their lasers go away with them
+        laser_count = max(laser_count, len(state.world.entities.lasers))
+    elapsed = perf_counter() - start
+
+    cut_count = food_count - len(state.world.entities.objects)
+    pygame.quit()
+
+    if laser_count != len(player_ids) or cut_count == 0:
+        print(f"{laser_count} lasers cut {cut_count} objects")
+        return TestResult(False, elapsed)
+
+    # Only the simulation, drawing this much food is a separate problem
+    return TestResult(elapsed < 1.05, elapsed)
+
+
+def test_reserve_powerups():
+    import os
+    import tempfile
+    import snapshot
+    from input import InputState, TickInput
+    from powerups import Powerup, PowerupType
+
+    state.init_system((1920, 1080), headless=True, seed=49)
+    state.draw_debug = False
+    player_ids = [state.add_player() for i in range(6)]
+    # Hoarders, with far more powerups than they could ever use
+    collected = {}
+    for player in state.world.entities.player_amoebae:
+        player.set_radius(80)
+        collected[player] = [Powerup(player.pos_x + 10, player.pos_y, PowerupType.values[i % 2]) for i in range(500)]
+        for powerup in collected[player]:
+            player.add_powerup(powerup)
+
+    def simulate(ticks):
+        for tick in range(ticks):
+            # Into the edges of the window and back, fast
+            inputs = {player_id: InputState(1 if tick % 120 < 60 else -1, 0.5, 0, 1) for player_id in player_ids}
+            state.update(1 / 60, TickInput(inputs))
+
+    start = perf_counter()
+    simulate(60)
+    elapsed = perf_counter() - start
+
+    for player in state.world.entities.player_amoebae:
+        # They stay inside their amoeba, even when it's pushed against the window edge
+        for powerup in player.reserve_powerups:
+            distance = math.hypot(powerup.pos_x, powerup.pos_y)
+            if distance > player.radius:
+                print(f"Reserve powerup {round(distance)} from the center of an amoeba of radius {player.radius}")
+                pygame.quit()
+                return TestResult(False)
+        # First in, first out
+        expected = collected[player][1:]
+        if list(player.reserve_powerups) != expected or player.active_powerup is not collected[player][0]:
+            print("Powerups weren't activated in the order they were collected")
+            pygame.quit()
+            return TestResult(False)
+
+    # Snapshots keep them in local space
+    def get_powerup_state():
+        return [(powerup.uid, powerup.pos_x, powerup.pos_y) for player in state.world.entities.player_amoebae
+                for powerup in player.reserve_powerups]
+
+    path = os.path.join(tempfile.mkdtemp(), "test.snapshot")
+    snapshot.save(path)
+    simulate(10)
+    expected_state = get_powerup_state()
+    snapshot.load(path)
+    simulate(10)
+    pygame.quit()
+    if get_powerup_state() != expected_state:
+        print("Reserve powerups diverged after restoring the snapshot")
+        return TestResult(False)
+
+    return TestResult(elapsed < 0.5, elapsed)
+
+
+def test_powerup_queue():
+    from input import InputState, TickInput
+    from powerups import Powerup, PowerupType
+    from entities import PlayerAmoeba
+
+    state.init_system((1920, 1080), headless=True, seed=32)
+    state.draw_debug = False
+    player_id = state.add_player()
+    player = state.world.entities.player_amoebae[0]
+    player.set_radius(60)
+    launcher, laser = PowerupType.GRAVITY_GRENADE_LAUNCHER, PowerupType.LASER
+    collected = [launcher, laser, launcher, launcher, laser]
+    for powerup_type in collected:
+        player.add_powerup(Powerup(player.pos_x, player.pos_y, powerup_type))
+
+    # Keep firing powerups, every kind has to be used up for the next one to come
+    activated = []
+    for tick in range(300):
+        active = player.active_powerup
+        state.update(1 / 30, TickInput({player_id: InputState(left_trigger=1)}))
+        if player.active_powerup is not active and player.active_powerup:
+            activated.append(player.active_powerup.powerup_type)
+    pygame.quit()
+
+    volleys = collected.count(launcher)
+    grenades_fired = state.world.leaderboard.stats[player_id].grenades_fired
+    if activated[:len(collected)] != collected or grenades_fired != volleys * PlayerAmoeba.VOLLEY_GRENADES:
+        print(f"Activated {activated}, expected {collected}, {grenades_fired} grenades fired")
+        return TestResult(False)
+
+    return TestResult(True)
+
+
+def test_amoeba_collisions():
+    from input import TickInput
+    import utils
+
+    state.init_system((1920, 1080), headless=True, seed=5)
+    state.draw_debug = False
+    # A crowd of equally sized amoebae, all overlapping their neighbours.
+    # The ones inside are pushed from all sides, so it takes a while to spread out completely.
+    spacing = 15
+    for i in range(400):
+        state.add_player()
+    for i, amoeba in enumerate(state.world.entities.player_amoebae):
+        amoeba.pos_x = 660 + (i % 40) * spacing
+        amoeba.pos_y = 420 + (i // 40) * spacing
+        state.world.entities.accelerator.move(amoeba)
+
+    def calc_total_overlap():
+        amoebae = state.world.entities.amoebae
+        return sum(max(a.radius + b.radius - utils.calc_distance_objs(a, b), 0)
+                   for i, a in enumerate(amoebae) for b in amoebae[i + 1:])
+
+    overlap_before = calc_total_overlap()
+    amoeba_count = len(state.world.entities.amoebae)
+
+    start = perf_counter()
+    min_framerate = 60
+    for i in range(min_framerate):
+        state.update(1 / min_framerate, TickInput({}))
+    elapsed = perf_counter() - start
+
+    overlap_after = calc_total_overlap()
+    eaten = amoeba_count - len(state.world.entities.amoebae)
+    pygame.quit()
+
+    if eaten or overlap_after > overlap_before / 2:
+        print(f"{eaten} amoebae eaten, total overlap before {overlap_before}, after {overlap_after}")
+        return TestResult(False, elapsed)
+
+    return TestResult(elapsed < 1.05, elapsed)
+
+
+def test_scheduler():
+    from scheduler import Scheduler
+
+    scheduler = Scheduler()
+    calls = []
+    scheduler.schedule(2, calls.append, "b")
+    scheduler.schedule(1, calls.append, "a")
+    scheduler.schedule(2, calls.append, "c")
+    cancelled = scheduler.schedule(1.5, calls.append, "cancelled")
+    cancelled.cancel()
+    # Scheduled while running, and due right away
+    scheduler.schedule(2, lambda: scheduler.schedule(0, calls.append, "d"))
+
+    if scheduler.run_due(0.5) != 0 or calls:
+        print("Ran events too early:", calls)
+        return TestResult(False)
+    count = scheduler.run_due(2)
+    if calls != ["a", "b", "c", "d"] or count != 5 or len(scheduler) != 0:
+        print(f"Ran {count} events:", calls)
+        return TestResult(False)
+
+    # A tick only costs as much as the events that are due
+    for i in range(100000):
+        scheduler.schedule(10 + i, calls.append, i)
+    start = perf_counter()
+    for i in range(1000):
+        scheduler.run_due(3 + i / 1000)
+    elapsed = perf_counter() - start
+
+    return TestResult(elapsed < 0.05, elapsed)
+
+
+def test_remote_input():
+    import socket
+    from input import InputState
+    from network_input import InputServer, RemoteController, encode_packet
+
+    # A client sending twice as fast as the game ticks, for 10 s. The input played back must not fall behind.
+    controller = RemoteController(1)
+    sequence = 0
+    max_lag = 0
+    for tick in range(600):
+        for i in range(2):
+            controller.receive(sequence, InputState(move_x=sequence))
+            sequence += 1
+        played = controller.sample().move_x
+        max_lag = max(max_lag, sequence - 1 - played)
+    if max_lag > controller.max_buffer_size + 1:
+        print(f"Played back input lags {max_lag} packets behind")
+        return TestResult(False)
+
+    server = InputServer(port=0, max_clients=2)
+    server.start()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Send out of order, the jitter buffer has to sort it out
+        for sequence in (1, 0, 2):
+            sent = InputState(move_x=sequence / 2, right_trigger=1)
+            sock.sendto(encode_packet(7, sequence, sent), ("127.0.0.1", server.port))
+
+        start = perf_counter()
+        while 7 not in server.controllers or server.controllers[7].packets_received < 3:
+            if perf_counter() - start > 2:
+                print("Packets did not arrive")
+                return TestResult(False)
+            sleep(0.01)
+
+        controllers = server.pop_new_controllers()
+        if len(controllers) != 1:
+            print("Expected exactly one new controller, got", len(controllers))
+            return TestResult(False)
+
+        controller = controllers[0]
+        move_x_values = [round(controller.sample().move_x, 1) for i in range(4)]
+        if move_x_values != [0, 0.5, 1, 1]:
+            print("Wrong playback order:", move_x_values)
+            return TestResult(False)
+
+        # Only as many players as allowed, packets of other clients are ignored
+        for client_id in (8, 9, 10):
+            sock.sendto(encode_packet(client_id, 0, InputState()), ("127.0.0.1", server.port))
+        start = perf_counter()
+        while server.packets_rejected < 2:
+            if perf_counter() - start > 2:
+                print(f"Expected 2 rejected packets, got {server.packets_rejected}")
+                return TestResult(False)
+            sleep(0.01)
+        if sorted(server.controllers) != [7, 8] or server.host != "127.0.0.1":
+            print(f"Clients {sorted(server.controllers)} on {server.host}")
+            return TestResult(False)
+    finally:
+        sock.close()
+        server.stop()
+
+    # A network player has to get the client's controller, even while a keyboard is still free
+    state.init_system((800, 600), headless=True, seed=3)
+    state.start_input_server(0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(encode_packet(3, 0, InputState(move_x=1)), ("127.0.0.1", state.input_server.port))
+        start = perf_counter()
+        while 3 not in state.input_server.controllers:
+            if perf_counter() - start > 2:
+                print("Packet did not arrive")
+                return TestResult(False)
+            sleep(0.01)
+        state.update(1 / 60, state.poll_input())
+    finally:
+        sock.close()
+        state.input_server.stop()
+        state.input_server = None
+    controller = state.world.player_to_controller_map.get(state.world.next_free_player_id - 1)
+    pygame.quit()
+    if not isinstance(controller, RemoteController):
+        print(f"Network player got the controller {controller}")
+        return TestResult(False)
+
+    return TestResult(True)
+
+
+def test_replay_determinism():
+    import math
+    import os
+    import tempfile
+    import replay
+    from input import InputState, TickInput, SimulationSettings
+
+    def get_board_state():
+        return [(type(obj).__name__, obj.pos_x, obj.pos_y, obj.radius) for obj in state.world.entities.objects]
+
+    path = os.path.join(tempfile.mkdtemp(), "test.replay")
+    seed = 1234
+    window_size = (800, 600)
+    player_count = 4
+
+    # Record a match with scripted input
+    state.init_system(window_size, headless=True, seed=seed)
+    state.init_board_and_players(player_count)
+    state.recorder = replay.ReplayRecorder(path, seed, window_size, player_count)
+    try:
+        for tick in range(300):
+            player_inputs = {}
+            for player_id in range(1, player_count + 1):
+                angle = tick * 0.05 * player_id
+                player_inputs[player_id] = InputState(math.cos(angle), math.sin(angle), math.sin(angle), 1,
+                                                      right_trigger=tick % 20 < 2)
+            # Like the frame governor would, change the settings in between
+            settings = SimulationSettings(0.05, 120, 150) if tick == 100 else None
+            state.update(1 / 50 + (tick % 3) * 0.001, TickInput(player_inputs, debug_spawn_food=tick % 50 == 0,
+                                                                settings=settings))
+    finally:
+        state.recorder.close()
+        state.recorder = None
+    recorded = get_board_state()
+
+    played_back_time, elapsed = replay.play_headless(path)
+    played_back = get_board_state()
+    pygame.quit()
+
+    if played_back != recorded:
+        print("Playback diverged from the recorded match")
+        return TestResult(False)
+
+    return TestResult(True, elapsed)
+
+
+def test_snapshot_restore():
+    import os
+    import struct
+    import tempfile
+    import threading
+    import snapshot
+    from input import InputState, TickInput
+
+    def get_board_state():
+        return [(type(obj).__name__, obj.uid, obj.pos_x, obj.pos_y, obj.radius) for obj in state.world.entities.objects]
+
+    def simulate(ticks):
+        for tick in range(ticks):
+            player_inputs = {player_id: InputState(1, 0.5, 0, 1, right_trigger=tick % 30 == 0)
+                             for player_id in range(1, 4)}
+            state.update(1 / 60, TickInput(player_inputs))
+
+    path = os.path.join(tempfile.mkdtemp(), "test.snapshot")
+    # Restoring is meant to replace setting up a board from scratch, for 20000 objects it has to be instant
+    max_load_time = 0.1
+
+    state.init_system((1600, 1200), headless=True, seed=99)
+    for i in range(3):
+        state.add_player()
+    # The bot keeps its controller, it must not be handed to another player
+    state.add_bots(1)
+    expected_controllers = dict(state.world.player_to_controller_map)
+    state.spawn_food(20000)
+    state.spawn_powerup(5)
+    simulate(10)
+
+    start = perf_counter()
+    snapshot.save(path)
+    save_time = perf_counter() - start
+    simulate(20)
+    expected = get_board_state()
+
+    start = perf_counter()
+    snapshot.load(path)
+    load_time = perf_counter() - start
+    # Food is restored without its constructor, it must still end up with the same attributes
+    from entities import Food
+    restored_food = next(obj for obj in state.world.entities.objects if isinstance(obj, Food))
+    restored_controllers = dict(state.world.player_to_controller_map)
+    simulate(20)
+    restored_state = get_board_state()
+    # Only now, creating an object takes up a uid
+    food_attributes = vars(Food(0, 0, 1, (0, 0, 0))).keys()
+
+    # A broken file must fail with its own error, not because the memory-mapped file can't be closed
+    broken_path = os.path.join(os.path.dirname(path), "broken.snapshot")
+    with open(path, "rb") as file, open(broken_path, "wb") as broken_file:
+        broken_file.write(file.read(snapshot.HEADER_FORMAT.size + snapshot.RNG_FORMAT.size + 10))
+    try:
+        snapshot.load(broken_path)
+        load_error = None
+    except Exception as e:
+        load_error = e
+
+    # With another thread running, the checkpointer must not fork
+    checkpoint_path = os.path.join(os.path.dirname(path), "checkpoint.snapshot")
+    checkpointer = snapshot.Checkpointer(checkpoint_path, interval_sec=1)
+    stop_thread = threading.Event()
+    thread = threading.Thread(target=stop_thread.wait)
+    thread.start()
+    checkpointer.update(game_time=10)
+    forked = checkpointer._child_pid is not None
+    checkpointer.wait()
+    stop_thread.set()
+    thread.join()
+    snapshot.load(checkpoint_path)
+    pygame.quit()
+
+    print(f"Saving {len(expected)} entities took {round(save_time, 2)} s, loading {round(load_time, 2)} s")
+    if restored_state != expected:
+        print("Simulation diverged after restoring the snapshot")
+        return TestResult(False)
+    if restored_controllers != expected_controllers:
+        print(f"Controllers after restoring: {restored_controllers}, expected {expected_controllers}")
+        return TestResult(False)
+    if not isinstance(load_error, struct.error):
+        print(f"Loading a broken snapshot raised {load_error!r}")
+        return TestResult(False)
+    if forked:
+        print("Checkpointer forked while another thread was running")
+        return TestResult(False)
+    if get_board_state() != restored_state:
+        print("Checkpoint doesn't match the simulation state")
+        return TestResult(False)
+    if vars(restored_food).keys() != food_attributes:
+        print(f"Restored food has the attributes {list(vars(restored_food))}, expected {list(food_attributes)}")
+        return TestResult(False)
+    if load_time > max_load_time:
+        return TestResult(False, load_time)
+
+    return TestResult(True, save_time + load_time)
+
+
+def test_pipelined_rendering():
+    import render
+
+    state.init_system((1280, 720), headless=True, seed=3)
+    state.draw_debug = False
+    for i in range(6):
+        state.add_player()
+    state.spawn_food(8000)
+
+    # Draw the same frame both ways, the pipeline must produce the same image
+    commands = state.build_frame(0)
+    render.execute(state.window, commands)
+    expected = pygame.image.tobytes(state.window, "RGB")
+
+    pipeline = render.RenderPipeline(state.window)
+    pipeline.submit(commands)
+    pipeline.present()
+    if pygame.image.tobytes(state.window, "RGB") != expected:
+        print("Pipelined frame differs")
+        return TestResult(False)
+
+    start = perf_counter()
+    min_framerate = 60
+    for i in range(min_framerate):
+        dt = state.clock.tick(1000) / 1000
+        state.update(dt)
+        pipeline.present()
+        pipeline.submit(state.build_frame(state.clock.get_rawtime()))
+    pipeline.close()
+    elapsed = perf_counter() - start
+
+    pygame.quit()
+
+    return TestResult(elapsed < 1.05, elapsed)
+
+
+def test_frame_governor():
+    import render
+    from governor import FrameGovernor
+
+    state.init_system((1280, 720), headless=True, seed=9)
+    state.draw_debug = False
+    for i in range(6):
+        state.add_player()
+    state.spawn_food(5000)
+    # Food is cheap to draw at every detail level (see render.SPRITES). What the lower levels leave out are the
+    # outlines, nuclei and labels of big amoebae.
+    state.add_bots(100)
+    for amoeba in state.world.entities.player_amoebae:
+        amoeba.set_radius(40)
+        state.world.entities.accelerator.move(amoeba)
+    defaults = state.get_default_settings()
+    governor = FrameGovernor(state.TARGET_FRAMERATE, defaults, state.level_of_detail)
+    state.frame_governor = governor
+    budget = governor.budget_ms
+
+    def draw_frame():
+        commands = state.build_frame(0)
+        start = perf_counter()
+        render.execute(state.window, commands)
+        return perf_counter() - start
+
+    full_detail_time = draw_frame()
+
+    # Frames that take twice the budget, mostly for drawing: the detail level goes down first, then the simulation
+    for i in range(400):
+        governor.update(budget * 2, budget * 0.5, budget * 1.5)
+    lowered = [adjustment.knob for adjustment in governor.adjustments]
+    lowest_settings = governor.get_settings()
+    degraded_time = draw_frame()
+
+    # The simulation gets the settings with the next tick input, and stops adding food over the limit
+    settings_before = state.world.settings
+    food_count = state.world.entities.get_food_count()
+    for i in range(60):
+        state.update(1 / 60)
+    settings_after = state.world.settings
+    food_added = state.world.entities.get_food_count() > food_count
+
+    # Fast frames turn everything back up, in reverse order
+    for i in range(400):
+        governor.update(budget * 0.1, budget * 0.05, budget * 0.05)
+    raised = [adjustment.knob for adjustment in list(governor.adjustments)[len(lowered):]]
+    recovered_settings = governor.pop_settings()
+    recovered_index = state.level_of_detail.index
+    pygame.quit()
+
+    expected = ["render detail level"] * 2 + ["food interval"] * 3 + ["max food"] * 3 + ["gravity range"] * 3
+    if lowered != expected or raised != expected[::-1]:
+        print(f"Turned down: {lowered}, turned up: {raised}")
+        return TestResult(False)
+    if settings_before != defaults or settings_after != lowest_settings or food_added:
+        print(f"Settings {settings_before} -> {settings_after}, {food_added=}")
+        return TestResult(False)
+    if recovered_settings != defaults or recovered_index != 0:
+        print(f"Recovered to {recovered_settings}, detail level {recovered_index}")
+        return TestResult(False)
+
+    return TestResult(degraded_time < full_detail_time, degraded_time)
+
+
+def test_metrics():
+    import gc
+    import re
+    import threading
+    import urllib.request
+    from metrics import GameMetrics
+
+    state.init_system((1280, 720), headless=True, seed=13)
+    state.draw_debug = False
+    state.add_bots(20)
+    state.spawn_food(2000)
+    # Port 0 picks a free port
+    state.start_metrics_server(0)
+    metrics = state.metrics
+    url = f"http://127.0.0.1:{metrics.server.port}/metrics"
+
+    # Scraped all the time while the game runs and publishes every tick
+    scrape_errors = []
+    scrape_count = 0
+    running = True
+
+    def scrape():
+        nonlocal scrape_count
+        while running:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    response.read()
+                scrape_count += 1
+            except Exception as e:
+                scrape_errors.append(e)
+                return
+
+    scraper = threading.Thread(target=scrape)
+    try:
+        metrics.PUBLISH_INTERVAL = 0
+        scraper.start()
+        ticks = 120
+        for i in range(ticks):
+            state.update(1 / 60)
+            state.draw(0)
+        running = False
+        scraper.join()
+        if scrape_errors or scrape_count == 0:
+            print(f"{scrape_count} scrapes, errors: {scrape_errors}")
+            return TestResult(False)
+
+        gc.collect()
+        metrics.publish()
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode()
+        values = {}
+        for line in text.splitlines():
+            match = re.fullmatch(r"([a-z_]+(?:\{[^}]*\})?) (\S+)", line)
+            if match:
+                values[match.group(1)] = float(match.group(2))
+
+        expected = {
+            "amoeba_ticks_total": ticks,
+            "amoeba_frame_seconds_count": ticks,
+            "amoeba_draw_seconds_count": ticks,
+            'amoeba_entities{kind="food"}': state.world.entities.get_food_count(),
+            'amoeba_entities{kind="player_amoeba"}': len(state.world.entities.player_amoebae),
+            'amoeba_grid{stat="objects"}': len(state.world.entities.objects),
+            "amoeba_respawn_queue_length": len(state.world.respawn_queue),
+        }
+        wrong = {name: values.get(name) for name, value in expected.items() if values.get(name) != value}
+        if wrong or values.get("amoeba_eaten_total", 0) == 0 or values.get("amoeba_gc_pause_seconds_count", 0) == 0:
+            print(f"Wrong metrics: {wrong}")
+            print(text)
+            return TestResult(False)
+
+        # What collecting the metrics adds to each tick, compared to the frame budget,
+        # with publishing spread over the ticks in between
+        metrics.PUBLISH_INTERVAL = GameMetrics.PUBLISH_INTERVAL
+        start = perf_counter()
+        for i in range(10000):
+            metrics.on_update(1 / 60, 0.005, 3)
+        overhead = (perf_counter() - start) / 10000
+        start = perf_counter()
+        metrics.publish()
+        overhead += (perf_counter() - start) / (GameMetrics.PUBLISH_INTERVAL * state.TARGET_FRAMERATE)
+    finally:
+        running = False
+        if scraper.is_alive():
+            scraper.join()
+        metrics.close()
+        state.metrics = None
+        pygame.quit()
+
+    return TestResult(overhead < 0.01 / state.TARGET_FRAMERATE, overhead)
+
+
+def test_independent_worlds():
+    window_size = (1280, 720)
+    state.init_system(window_size, headless=True)
+
+    def start_match(seed: int) -> state.World:
+        world = state.World(window_size, seed)
+        state.set_world(world)
+        state.start_timers()
+        state.add_bots(4)
+        state.spawn_food(200)
+        return world
+
+    def get_board_state(world: state.World):
+        return [(type(obj).__name__, obj.uid, obj.pos_x, obj.pos_y, obj.radius) for obj in world.entities.objects]
+
+    start = perf_counter()
+    expected = []
+    for seed in (1, 2):
+        world = start_match(seed)
+        for tick in range(300):
+            state.update(1 / 30)
+        expected.append(get_board_state(world))
+
+    # The same matches again, taking turns tick by tick
+    worlds = [start_match(1), start_match(2)]
+    for tick in range(300):
+        for world in worlds:
+            state.set_world(world)
+            state.update(1 / 30)
+    elapsed = perf_counter() - start
+    pygame.quit()
+
+    if [get_board_state(world) for world in worlds] != expected:
+        print("Matches that take turns in one process differ from the same matches played one after the other")
+        return TestResult(False, elapsed)
+    return TestResult(True, elapsed)
+
+
+def test_batch_matches():
+    import dataclasses
+    import os
+    import batch
+    from entities import GravityGrenade
+
+    constants = {"entities.GravityGrenade.ARMING_DURATION": 1, "state.COLLISION_RADIUS_RATIO": 0.75}
+    configs = [batch.MatchConfig(seed, bot_count=6, duration=10, dt=1 / 30, window_size=(1280, 720),
+                                 constants=constants) for seed in range(4)]
+
+    def outcome(result: batch.MatchResult):
+        return dataclasses.replace(result, elapsed=0)
+
+    start = perf_counter()
+    results = batch.run_matches(configs, workers=2)
+    elapsed = perf_counter() - start
+
+    # The workers get the same results as a match in this process, and the constants are changed back afterwards
+    local_result = batch.run_match(configs[1])
+    pygame.quit()
+    if outcome(local_result) != outcome(results[1]):
+        print(f"Match in a worker process differs: {results[1]} != {local_result}")
+        return TestResult(False)
+    if GravityGrenade.ARMING_DURATION != 2 or state.COLLISION_RADIUS_RATIO != 0.8:
+        print("Constants weren't restored after the match")
+        return TestResult(False)
+    if [result.seed for result in results] != [0, 1, 2, 3] or len({result.eaten for result in results}) == 1:
+        print(f"Expected one different match per seed: {results}")
+        return TestResult(False)
+
+    stats = batch.aggregate(results)
+    if stats["eaten"]["min"] != min(result.eaten for result in results) or stats["max_radius"]["mean"] <= 0:
+        print(f"Wrong statistics: {stats}")
+        return TestResult(False)
+
+    # Twice the workers should take about the same time for twice the matches, if there are cores for them
+    if (os.cpu_count() or 1) >= 2:
+        start = perf_counter()
+        batch.run_matches(configs[:2], workers=1)
+        single_worker = perf_counter() - start
+        if elapsed > single_worker * 1.5:
+            print(f"No speedup from 2 workers: {round(elapsed, 2)} s for 4 matches, "
+                  f"{round(single_worker, 2)} s for 2 matches with 1 worker")
+            return TestResult(False, elapsed)
+
+    return TestResult(True, elapsed)
+
+
+def test_frame_capture():
+    import os
+    import tempfile
+    import capture
+
+    state.init_system((320, 180), headless=True, seed=48)
+    state.draw_debug = False
+    state.add_bots(4)
+    state.spawn_food(100)
+
+    def run(frame_capture: capture.FrameCapture, frames: int) -> float:
+        """
+        :return: The longest time a capture() call took
+        """
+        max_call_time = 0
+        for i in range(frames):
+            state.update(1 / 60)
+            state.draw(0)
+            start = perf_counter()
+            frame_capture.capture(state.window)
+            max_call_time = max(max_call_time, perf_counter() - start)
+        frame_capture.close()
+        return max_call_time
+
+    with tempfile.TemporaryDirectory() as directory:
+        frame_capture = capture.open_capture(directory, state.window.get_size(), 60)
+        run(frame_capture, 60)
+        files = os.listdir(directory)
+        if len(files) != frame_capture.captured or frame_capture.captured + frame_capture.dropped != 60:
+            print(f"{len(files)} files for {frame_capture.captured} captured and {frame_capture.dropped} dropped "
+                  f"frames")
+            pygame.quit()
+            return TestResult(False)
+
+    # A writer that can't keep up must not slow down the game, the frames it can't take are dropped
+    class SlowWriter:
+        def __init__(self):
+            self.frame_count = 0
+
+        def write(self, frame):
+            sleep(0.02)
+            self.frame_count += 1
+
+        def close(self):
+            pass
+
+    writer = SlowWriter()
+    frame_capture = capture.FrameCapture(writer, max_queued=4)
+    max_call_time = run(frame_capture, 60)
+    if max_call_time > 0.01 or frame_capture.dropped == 0 or writer.frame_count != frame_capture.captured:
+        print(f"Slow writer: longest capture() {round(max_call_time * 1000, 1)} ms, {frame_capture.dropped} dropped, "
+              f"{writer.frame_count} of {frame_capture.captured} captured frames written")
+        pygame.quit()
+        return TestResult(False)
+
+    # Stands in for ffmpeg, which might not be installed: counts the bytes of the raw video
+    with tempfile.TemporaryDirectory() as directory:
+        count_path = os.path.join(directory, "bytes.txt")
+        command = [sys.executable, "-c", "import sys; open(sys.argv[1], 'w').write(str(len(sys.stdin.buffer.read())))",
+                   count_path]
+        frame_capture = capture.FrameCapture(capture.VideoPipeWriter("", state.window.get_size(), 60, command))
+        start = perf_counter()
+        run(frame_capture, 60)
+        elapsed = perf_counter() - start
+        width, height = state.window.get_size()
+        with open(count_path) as file:
+            byte_count = int(file.read())
+    pygame.quit()
+    if byte_count != frame_capture.captured * width * height * 3:
+        print(f"Encoder got {byte_count} bytes for {frame_capture.captured} frames of {width}x{height}")
+        return TestResult(False)
+
+    return TestResult(True, elapsed)
+
+
+def test_startup_time():
+    import os
+    import re
+    import subprocess
+
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy")
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    # Servers and test runs restart all the time, with the font cache from earlier runs.
+    # The first run fills the cache, if this is the first run ever.
+    startup_times = []
+    for i in range(3):
+        result = subprocess.run([sys.executable, main_path, "--frames", "1"], env=env,
+                                capture_output=True, text=True, timeout=30)
+        match = re.search(r"Startup time ([\d.]+) s", result.stdout)
+        if not match:
+            print(result.stdout, result.stderr)
+            return TestResult(False)
+        startup_times.append(float(match.group(1)))
+
+    startup_time = min(startup_times[1:])
+    return TestResult(startup_time < 0.3, startup_time)
+
+
+def test_many_bots():
+    state.init_system((1920, 1080), headless=True, seed=8)
+    state.draw_debug = False
+    state.add_bots(200)
+    state.spawn_food(8000)
+    start_positions = {amoeba.uid: (amoeba.pos_x, amoeba.pos_y) for amoeba in state.world.entities.player_amoebae}
+
+    start = perf_counter()
+    min_framerate = 60
+    for i in range(min_framerate):
+        dt = state.clock.tick(1000) / 1000
+        dt_used_ms = state.clock.get_rawtime()
+        state.update(dt)
+        state.draw(dt_used_ms)
+        pygame.display.flip()
+    elapsed = perf_counter() - start
+
+    # Some bots were eaten, and respawned ones have a new uid
+    survivors = [amoeba for amoeba in state.world.entities.player_amoebae if amoeba.uid in start_positions]
+    moved = sum((amoeba.pos_x, amoeba.pos_y) != start_positions[amoeba.uid] for amoeba in survivors)
+    pygame.quit()
+
+    if moved < len(survivors) * 0.9:
+        print(f"Only {moved} of {len(survivors)} bots moved")
+        return TestResult(False, elapsed)
+
+    return TestResult(elapsed < 1.05, elapsed)
+
+
 def run_test(func, name):
     try:
         result = func()
@@ -120,6 +1512,33 @@ def main():
     run_test(test_many_entities, "1 s at 60 fps with many entities")
     run_test(test_many_entities2, "Various performance tests")
     run_test(test_grid, "Grid")
+    run_test(test_grid_segment_query, "Grid segment query")
+    run_test(test_spatial_hash_stress, "Spatial hash against brute force, 2000 frames")
+    run_test(test_spatial_hash, "Spatial hash in a world much bigger than the window")
+    run_test(test_nearest_queries, "1000 nearest neighbour queries among 100000 objects")
+    run_test(test_entity_index_consistency, "Index consistency during a match")
+    run_test(test_grenade_hits_at_low_framerate, "Grenade hits at low frame rate")
+    run_test(test_nucleus_hits, "Nucleus hits")
+    run_test(test_explosions, "Explosions and chain reactions")
+    run_test(test_object_pools, "Object pools")
+    run_test(test_metabolism, "Metabolism")
+    run_test(test_leaderboard, "Leaderboard")
+    run_test(test_lasers, "1 s at 60 fps with 6 lasers and 50000 food")
+    run_test(test_reserve_powerups, "1 s at 60 fps with 6 players carrying 500 powerups each")
+    run_test(test_powerup_queue, "Powerup queue with mixed powerups")
+    run_test(test_amoeba_collisions, "1 s at 60 fps with 400 colliding amoebae")
+    run_test(test_scheduler, "Scheduler")
+    run_test(test_remote_input, "Remote input")
+    run_test(test_replay_determinism, "Replay determinism")
+    run_test(test_snapshot_restore, "Snapshot restore")
+    run_test(test_pipelined_rendering, "1 s at 60 fps with pipelined rendering")
+    run_test(test_frame_governor, "Frame governor")
+    run_test(test_metrics, "Metrics")
+    run_test(test_independent_worlds, "Two matches taking turns in one process")
+    run_test(test_batch_matches, "Parallel batch matches")
+    run_test(test_frame_capture, "Frame capture")
+    run_test(test_startup_time, "Startup until the first frame")
+    run_test(test_many_bots, "1 s at 60 fps with 200 bots")
 
 
 
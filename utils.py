@@ -3,8 +3,11 @@ import math
 from math import sqrt
 
 
-def draw_text(window, text, position, font, color=(0, 0, 0), bg_color=None):
+def draw_text(window, text, position, font, color=(0, 0, 0), bg_color=None, centered=False):
     text_surface = font.render(text, True, color)
+    if centered:
+        position = (position[0] - text_surface.get_width() / 2,
+                    position[1] - text_surface.get_height() / 2)
 
     if bg_color:
         # (left, top), (width, height)
@@ -17,8 +20,23 @@ def draw_text(window, text, position, font, color=(0, 0, 0), bg_color=None):
     window.blit(text_surface, position)
 
 
+# Simulation time in seconds. It is advanced by state.update() instead of being read from the wall clock,
+# so that a match played back from a replay sees exactly the same timestamps.
+game_time = 0
+
+
 def get_time():
-    return pygame.time.get_ticks() / 1000
+    return game_time
+
+
+def advance_time(dt: float):
+    global game_time
+    game_time += dt
+
+
+def reset_time():
+    global game_time
+    game_time = 0
 
 
 def normalize(vec):
@@ -48,9 +66,15 @@ def lerp_angle(angle1: float, angle2: float, factor: float):
     Linear interpolation between two angles (in radians)
     :param factor: How much of angle2 to blend in. factor = 0 -> only use angle1, factor = 1 -> only use angle2
     """
+    return angle1 + calc_angle_difference(angle1, angle2) * factor
+
+
+def calc_angle_difference(angle1: float, angle2: float):
+    """
+    The shortest signed angle (in radians) to turn from angle1 to angle2
+    """
     difference = math.fmod(angle2 - angle1, math.tau)
-    distance = math.fmod(2 * difference, math.tau) - difference
-    return angle1 + distance * factor
+    return math.fmod(2 * difference, math.tau) - difference
 
 
 def smoothstep(value1: float, value2: float, factor: float):
@@ -87,6 +111,45 @@ def are_objs_colliding(obj1, obj2):
     return calc_distance_squared_objs(obj1, obj2) < (obj1.radius + obj2.radius)**2
 
 
+def calc_distance_squared_point_segment(x: float, y: float, x0: float, y0: float, x1: float, y1: float):
+    """
+    Squared distance from the point (x, y) to the closest point on the segment from (x0, y0) to (x1, y1).
+    """
+    dx = x1 - x0
+    dy = y1 - y0
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        return (x - x0)**2 + (y - y0)**2
+    t = clamp(((x - x0) * dx + (y - y0) * dy) / length_squared)
+    return (x - (x0 + t * dx))**2 + (y - (y0 + t * dy))**2
+
+
+def calc_time_of_impact(x: float, y: float, dx: float, dy: float, radius: float,
+                        other_x: float, other_y: float, other_radius: float):
+    """
+    When a circle moving from (x, y) by (dx, dy) first touches a resting circle.
+    :return: Fraction of the movement (0 to 1) at the moment of impact, or None if they don't touch
+    """
+    # Solve |(x, y) + t * (dx, dy) - (other_x, other_y)| = radius + other_radius for t
+    offset_x = x - other_x
+    offset_y = y - other_y
+    c = offset_x * offset_x + offset_y * offset_y - (radius + other_radius) ** 2
+    b = 2 * (offset_x * dx + offset_y * dy)
+    if c <= 0:
+        # Already touching at the start, that's only an impact if they move closer, not apart
+        return 0 if b < 0 else None
+    a = dx * dx + dy * dy
+    if a == 0:
+        return None
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        return None
+    t = (-b - sqrt(discriminant)) / (2 * a)
+    if 0 <= t <= 1:
+        return t
+    return None
+
+
 def get_square_around_point(x: float, y: float, size: float):
     halfsize = size / 2
     return x - halfsize, y - halfsize, size, size
@@ -98,3 +161,21 @@ def calc_gravitational_force(from_obj, from_obj_mass, to_obj, to_obj_mass):
     GRAVITY_CONSTANT = 1
     dist_squared = calc_distance_squared_objs(to_obj, from_obj)
     return (GRAVITY_CONSTANT * from_obj_mass * to_obj_mass) / dist_squared
+
+
+def calc_gravity_pull(x: float, y: float, radius: float, attractor_x: float, attractor_y: float,
+                      attractor_mass: float, max_force: float):
+    """
+    Pull of a gravity source on a round object. The area of the object is used as its mass.
+    :return: Normalized direction towards the attractor, and the strength of the pull
+    """
+    mass = (radius ** 2) * math.pi
+    # F = (G * m1 * m2) / dist_squared
+    GRAVITY_CONSTANT = 1
+    dist_squared = (attractor_x - x)**2 + (attractor_y - y)**2
+    if dist_squared == 0:
+        # Exactly on top of the attractor (e.g. both pushed into the same corner), no direction to pull in
+        return 0, 0, 0
+    force = clamp((GRAVITY_CONSTANT * mass * attractor_mass) / dist_squared, 0, max_force)
+    dir_x, dir_y = normalize((attractor_x - x, attractor_y - y))
+    return dir_x, dir_y, force